@@ -3,17 +3,26 @@
 # then use it to filter the national brownfield dataset, clean the results,
 # and save a single, master CSV file.
 
+import argparse
 import pandas as pd
-import geopandas as gpd
 import os
+import sys
 
-print("--- LOAD AND COMBINE ---")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nebula import boundary as boundary_engine
+from nebula import instrument
+from nebula import market_context
+from nebula import parcel_store
+from nebula import store
+from nebula import wkt
+from nebula.fingerprint import files_fingerprint
+from nebula.instrument import log, span
 
 # --- Configuration ---
 DATA_DIR = os.path.join('1_data_acquisition', 'raw_data')
 OUTPUT_DIR = 'reports'
-MASTER_CSV_PATH = os.path.join(OUTPUT_DIR, 'Brownsfrield_Cambridgeshire_Data.csv')
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+MASTER_CSV_PATH = os.path.join(OUTPUT_DIR, 'Master_Cambridgeshire_Data.csv')
+PRICE_DATA_PATH = os.path.join(OUTPUT_DIR, 'Cambridgeshire_Price_Data_2010-2023.csv')
 
 NATIONAL_SITES_PATH = os.path.join(DATA_DIR, 'brownfield_registers', 'uk_brownfield_sites.csv')
 
@@ -24,73 +33,142 @@ gml_paths = {
     "South_Cambs": os.path.join(GML_DIR, 'South_Cambridgeshire_District_Council', 'Land_Registry_Cadastral_Parcels.gml')
 }
 
-# --- Load and Create a Custom Cambridgeshire Boundary from GML files ---
-print("\nStep 1: Loading GML files to build a custom Cambridgeshire boundary...")
-all_parcels = []
-for council, path in gml_paths.items():
+
+def main():
+    instrument.start('brownfield')
+    log("--- LOAD AND COMBINE ---")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    parser = argparse.ArgumentParser(description="Filter the national brownfield register to Cambridgeshire.")
+    parser.add_argument('--osgb-columns', action='store_true',
+                        help="Also save each site's EPSG:27700 Easting/Northing in the master CSV.")
+    parser.add_argument('--market-context', action='store_true',
+                        help="Add nearby sales counts, median prices and year-on-year change to each site, "
+                             "from the sales already loaded by process_price_data.py.")
+    args = parser.parse_args()
+
+    # --- Load and Create a Custom Cambridgeshire Boundary from GML files ---
+    # The dissolved boundary is cached on disk and only rebuilt when a GML file
+    # (or the dissolve settings) change. It is only cached when every council
+    # loaded, so a failed GML file is retried (and warned about) on every run.
+    log("\nStep 1: Building a custom Cambridgeshire boundary from the GML files...")
+    boundary_fingerprint = files_fingerprint(
+        gml_paths.values(),
+        tile_size=boundary_engine.DEFAULT_TILE_SIZE,
+        tolerance=boundary_engine.DEFAULT_SIMPLIFY_TOLERANCE,
+    )
+    cambridgeshire_boundary = boundary_engine.load_boundary(boundary_fingerprint)
+
+    if cambridgeshire_boundary is not None:
+        log(" -> GML files are unchanged; using the cached boundary.")
+    else:
+        # Each council's parcels are kept in a GeoParquet store; only GML files
+        # that changed since the last run are parsed again, in parallel.
+        with span("Load parcels") as step:
+            ingest_status = parcel_store.refresh(gml_paths)
+            all_parcels = []
+            for council, result in ingest_status.items():
+                if result.failed:
+                    log(f" -> WARNING: Could not load GML for {council}. Check the path in the script. Error: {result.error}")
+                    continue
+                all_parcels.append(parcel_store.load(council))
+                source = "parcel store (unchanged)" if result.status == 'cached' else "GML"
+                log(f" -> Successfully loaded {council} from the {source}")
+            step.rows_out = sum(len(parcels) for parcels in all_parcels)
+        failed = [council for council, result in ingest_status.items() if result.failed]
+
+        if not all_parcels:
+            log(" -> FATAL ERROR: No GML files were loaded. Cannot create a boundary. Exiting.")
+            sys.exit(1)
+
+        combined_parcels_gdf = pd.concat(all_parcels, ignore_index=True)
+        log(f" -> Dissolving {len(combined_parcels_gdf):,} parcels tile by tile to create a single county shape...")
+        with span("Dissolve boundary", rows_in=len(combined_parcels_gdf)):
+            cambridgeshire_boundary = boundary_engine.build_boundary(combined_parcels_gdf.geometry.values)
+            if failed:
+                # The cached boundary was built from other GML files, and this
+                # one is incomplete, so neither is kept for later runs.
+                boundary_engine.discard_boundary()
+            else:
+                boundary_engine.save_boundary(cambridgeshire_boundary, boundary_fingerprint)
+        if failed:
+            log(f" -> WARNING: The boundary was built without {', '.join(failed)} and has not been cached. "
+                "Fix the GML file(s) and run again.")
+        else:
+            log(" -> Custom Cambridgeshire boundary created and cached successfully.")
+
+    boundary_index = boundary_engine.BoundaryIndex(cambridgeshire_boundary)
+
+    # --- Load National Brownfield Data ---
+    log("\nLoading national brownfield dataset...")
     try:
-        gdf = gpd.read_file(path)
-        all_parcels.append(gdf)
-        print(f" -> Successfully loaded GML for {council}")
+        with span("Load national register") as step:
+            # --- UPDATED: Using the correct column names from your file ---
+            use_cols = ['point', 'reference', 'site-address', 'planning-permission-date', 
+                        'hectares', 'planning-permission-status', 'maximum-net-dwellings', 'organisation']
+
+            national_df = pd.read_csv(NATIONAL_SITES_PATH, usecols=use_cols, low_memory=False)
+            step.rows_in = len(national_df)
+
+            log(" -> Extracting longitude and latitude from the 'point' column...")
+            national_df['longitude'], national_df['latitude'] = wkt.parse_points(national_df['point'])
+            national_df.dropna(subset=['longitude', 'latitude'], inplace=True)
+
+            # Project every site to the boundary's CRS (metres) in one vectorised call.
+            national_df['Easting'], national_df['Northing'] = wkt.lonlat_to_osgb(
+                national_df['longitude'].to_numpy(), national_df['latitude'].to_numpy())
+            step.rows_out = len(national_df)
+        log(f" -> Loaded and processed {len(national_df):,} sites from the national register.")
     except Exception as e:
-        print(f" -> WARNING: Could not load GML for {council}. Check the path in the script. Error: {e}")
-
-if not all_parcels:
-    print(" -> FATAL ERROR: No GML files were loaded. Cannot create a boundary. Exiting.")
-    exit()
-
-combined_parcels_gdf = pd.concat(all_parcels, ignore_index=True)
-print(" -> Dissolving internal boundaries to create a single county shape...")
-cambridgeshire_boundary = combined_parcels_gdf.union_all()
-cambridgeshire_boundary_gdf = gpd.GeoDataFrame(geometry=[cambridgeshire_boundary], crs="EPSG:27700")
-print(" -> Custom Cambridgeshire boundary created successfully.")
-
-# --- Load National Brownfield Data ---
-print("\nLoading national brownfield dataset...")
-try:
-    # --- UPDATED: Using the correct column names from your file ---
-    use_cols = ['point', 'reference', 'site-address', 'planning-permission-date', 
-                'hectares', 'planning-permission-status', 'maximum-net-dwellings', 'organisation']
-    
-    national_df = pd.read_csv(NATIONAL_SITES_PATH, usecols=use_cols, low_memory=False)
-    
-    print(" -> Extracting longitude and latitude from the 'point' column...")
-    coords = national_df['point'].str.extract(r'POINT\(([-\d\.]+) ([-\d\.]+)\)')
-    national_df['longitude'] = pd.to_numeric(coords[0], errors='coerce')
-    national_df['latitude'] = pd.to_numeric(coords[1], errors='coerce')
-    national_df.dropna(subset=['longitude', 'latitude'], inplace=True)
-    
-    national_gdf = gpd.GeoDataFrame(
-        national_df,
-        geometry=gpd.points_from_xy(national_df.longitude, national_df.latitude),
-        crs="EPSG:4326"
-    )
-    print(f" -> Loaded and processed {len(national_gdf):,} sites from the national register.")
-except Exception as e:
-    print(f" -> FATAL ERROR: Could not process national brownfield CSV. Error: {e}")
-    exit()
-
-# --- Spatially Filter to Cambridgeshire using our Custom Boundary ---
-print("\nGeographically filtering for sites within your custom boundary...")
-cambridgeshire_boundary_gdf = cambridgeshire_boundary_gdf.to_crs(national_gdf.crs)
-cambridgeshire_sites_gdf = gpd.sjoin(national_gdf, cambridgeshire_boundary_gdf, how="inner", predicate="within")
-print(f" -> Found {len(cambridgeshire_sites_gdf)} sites within the Cambridgeshire area.")
-
-# --- Clean, De-duplicate, and Save the Final Master CSV ---
-print("\nCleaning and de-duplicating the local dataset...")
-cambridgeshire_sites_gdf.rename(columns={
-    'reference': 'SiteReference', 'site-address': 'Address',
-    'planning-permission-date': 'PermissionDate', 'hectares': 'Hectares',
-    'planning-permission-status': 'PlanningStatus', 'maximum-net-dwellings': 'Dwellings',
-    'organisation': 'Council'
-}, inplace=True)
-
-cambridgeshire_sites_gdf['PermissionDate'] = pd.to_datetime(cambridgeshire_sites_gdf['PermissionDate'], errors='coerce')
-cambridgeshire_sites_gdf.sort_values(by='PermissionDate', ascending=False, inplace=True)
-cambridgeshire_sites_gdf.drop_duplicates(subset=['SiteReference'], keep='first', inplace=True)
-print(f" -> {len(cambridgeshire_sites_gdf)} unique sites remain after cleaning.")
-
-final_df = pd.DataFrame(cambridgeshire_sites_gdf.drop(columns=['geometry', 'index_right']))
-final_df.to_csv(MASTER_CSV_PATH, index=False)
-
-print(f"\n✅ SUCCESS: A clean master data file for Cambridgeshire has been created at: {MASTER_CSV_PATH}")
\ No newline at end of file
+        log(f" -> FATAL ERROR: Could not process national brownfield CSV. Error: {e}")
+        sys.exit(1)
+
+    # --- Spatially Filter to Cambridgeshire using our Custom Boundary ---
+    log("\nGeographically filtering for sites within your custom boundary...")
+    with span("Filter sites to the boundary", rows_in=len(national_df)) as step:
+        inside = boundary_index.contains_xy(national_df['Easting'].to_numpy(), national_df['Northing'].to_numpy())
+        cambridgeshire_sites_df = national_df[inside].copy()
+        step.rows_out = len(cambridgeshire_sites_df)
+    log(f" -> Found {len(cambridgeshire_sites_df)} sites within the Cambridgeshire area.")
+
+    # --- Clean, De-duplicate, and Save the Final Master CSV ---
+    log("\nCleaning and de-duplicating the local dataset...")
+    cambridgeshire_sites_df.rename(columns={
+        'reference': 'SiteReference', 'site-address': 'Address',
+        'planning-permission-date': 'PermissionDate', 'hectares': 'Hectares',
+        'planning-permission-status': 'PlanningStatus', 'maximum-net-dwellings': 'Dwellings',
+        'organisation': 'Council'
+    }, inplace=True)
+
+    cambridgeshire_sites_df['PermissionDate'] = pd.to_datetime(cambridgeshire_sites_df['PermissionDate'], errors='coerce')
+    cambridgeshire_sites_df.sort_values(by='PermissionDate', ascending=False, inplace=True)
+    cambridgeshire_sites_df.drop_duplicates(subset=['SiteReference'], keep='first', inplace=True)
+    log(f" -> {len(cambridgeshire_sites_df)} unique sites remain after cleaning.")
+
+    final_df = cambridgeshire_sites_df
+
+    if args.market_context:
+        # --- Add the local housing market around each site ---
+        log("\nMeasuring the housing market around each site...")
+        with span("Market context", rows_in=len(final_df)):
+            db_engine = store.connect()
+            if os.path.exists(PRICE_DATA_PATH):
+                store.load_prices(db_engine, PRICE_DATA_PATH)
+            recent_sales = store.recent_sales(db_engine, 2 * market_context.DEFAULT_WINDOW_DAYS)
+            site_context = market_context.site_market_context(final_df, recent_sales)
+        if site_context is None:
+            log(" -> WARNING: The sales have no coordinates (run process_price_data.py with --within-boundary); "
+                "skipping market context.")
+        else:
+            final_df = final_df.join(site_context)
+            log(f" -> Added sales within {', '.join(f'{r:,}m' for r in market_context.DEFAULT_RADII)} "
+                f"from {len(recent_sales):,} recent sales.")
+    if not args.osgb_columns:
+        final_df = final_df.drop(columns=['Easting', 'Northing'])
+    final_df.to_csv(MASTER_CSV_PATH, index=False)
+
+    log(f"\n✅ SUCCESS: A clean master data file for Cambridgeshire has been created at: {MASTER_CSV_PATH}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,62 +2,252 @@
 # PURPOSE: To process the enormous national Price Paid dataset,
 # filtering it down to a manageable CSV containing only Cambridgeshire sales
 # from 2010 to 2023.
+#
+# USAGE: python 2_data_processing/process_price_data.py [--mode stream|parallel|cache|full|delta]
+#                                                       [--chunksize N] [--workers N]
+#                                                       [--delta-file PATH | --delta-dir DIR] [--no-compact]
+#                                                       [--within-boundary [--postcodes PATH]]
+#   stream (default) reads the file in bounded chunks so peak memory depends on
+#   --chunksize rather than on the size of pp-complete.csv.
+#   parallel splits the file into line-aligned byte ranges and filters them in a
+#   pool of --workers processes; the output is identical to stream mode.
+#   cache converts pp-complete.csv once into a Parquet dataset partitioned by
+#   year and postcode area (rebuilt only when the file's size or mtime changes)
+#   and then reads only the partitions that match the filters.
+#   full loads the whole file into one DataFrame before filtering.
+#   delta applies a monthly update file (Record_Status A/C/D, keyed by
+#   TransactionID) to the existing cleaned data and aggregates instead, in
+#   time proportional to the update file. The changed sales are logged next
+#   to the cleaned CSV (see nebula/price_updates.py), which is only rewritten
+#   once the log has grown (never, with --no-compact). --delta-dir applies
+#   every .csv file in a folder in name order; files applied before, judged
+#   by their content, are skipped. Reprocessing pp-complete.csv in another
+#   mode discards applied updates; apply them again afterwards (run_pipeline.py
+#   does this itself).
+#   --within-boundary places each sale at its postcode centroid (from a local
+#   ONSPD or Code-Point Open file) and keeps only the sales inside the custom
+#   Cambridgeshire boundary built by load_and_combine.py, adding Easting and
+#   Northing columns. Without it, sales are kept by postcode prefix alone.
+#   In delta mode the update is always filtered the way the stored sales
+#   were, so --within-boundary is implied by a store built with it, and is an
+#   error against a store built without it.
 
-import pandas as pd
+import argparse
+import glob
 import os
+import sys
+
+import pandas as pd
 
-print("\n--- PRICE DATA PROCESSING SCRIPT ---")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nebula import instrument
+from nebula import price_paid
+from nebula import price_updates
+from nebula import store
+from nebula.instrument import log, span
 
 # --- Configuration ---
 INPUT_PRICE_PAID_PATH = os.path.join('1_data_acquisition', 'raw_data', 'land_registry_data', 'pp-complete.csv')
 OUTPUT_DIR = 'reports'
 OUTPUT_CLEAN_PRICE_PATH = os.path.join(OUTPUT_DIR, 'Cambridgeshire_Price_Data_2010-2023.csv')
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+DEFAULT_DELTA_PATH = os.path.join('1_data_acquisition', 'raw_data', 'land_registry_data', 'pp-monthly-update-new-version.csv')
+DEFAULT_POSTCODES_PATH = os.path.join('1_data_acquisition', 'raw_data', 'postcodes', 'ONSPD.csv')
 
 # Define the postcode prefixes for the Cambridgeshire area
-TARGET_POSTCODE_PREFIXES = ('CB', 'PE', 'SG')
-
-print(f"Loading national Price Paid data from: {INPUT_PRICE_PAID_PATH}")
-print("This will be slow as the file is very large...")
-
-try:
-    # --- Load the data efficiently ---
-    column_names = [
-        'TransactionID', 'Price', 'DateOfTransfer', 'Postcode', 'PropertyType',
-        'OldNew', 'Duration', 'PAON', 'SAON', 'Street', 'Locality',
-        'TownCity', 'District', 'County', 'PPD_Category', 'Record_Status'
-    ]
-    # We only load the columns we need to save memory.
-    use_cols = ['Price', 'DateOfTransfer', 'Postcode']
-    
-    df = pd.read_csv(INPUT_PRICE_PAID_PATH, header=None, names=column_names, usecols=use_cols)
-    
-    print(f" -> Loaded {len(df):,} records from the UK dataset.")
-
-except FileNotFoundError:
-    print(f" -> ERROR: File not found. Please check the filename in INPUT_PRICE_PAID_PATH.")
-    exit()
-
-# --- Filter by Postcode to get the Cambridgeshire Area ---
-print(f"\nStep 1: Filtering for Cambridgeshire area postcodes ({', '.join(TARGET_POSTCODE_PREFIXES)})...")
-df.dropna(subset=['Postcode'], inplace=True)
-df_cambs = df[df['Postcode'].str.startswith(TARGET_POSTCODE_PREFIXES)].copy()
-print(f" -> Found {len(df_cambs):,} sales records in the Cambridgeshire area.")
-
-# --- Filter by Date (2010-2023) ---
-print("\nStep 2: Filtering for sales between 2010 and 2023...")
-# Convert 'DateOfTransfer' to a proper datetime object for filtering
-df_cambs['DateOfTransfer'] = pd.to_datetime(df_cambs['DateOfTransfer'], errors='coerce')
-# Keep only the rows within our target date range
-df_cambs_filtered = df_cambs[
-    (df_cambs['DateOfTransfer'] >= '2010-01-01') & 
-    (df_cambs['DateOfTransfer'] <= '2023-12-31')
-].copy()
-print(f" -> {len(df_cambs_filtered):,} sales records remain after date filtering.")
-
-# --- Save the Clean, Focused Dataset ---
-df_cambs_filtered.to_csv(OUTPUT_CLEAN_PRICE_PATH, index=False)
-
-print("\n--- DATA PROCESSING COMPLETE ---")
-print(f"✅ SUCCESS: A clean, focused dataset of Cambridgeshire house sales has been saved to:")
-print(f"   -> {OUTPUT_CLEAN_PRICE_PATH}")
\ No newline at end of file
+TARGET_POSTCODE_PREFIXES = price_paid.TARGET_POSTCODE_PREFIXES
+
+
+def report_progress(stats):
+    log(f" -> {price_paid.format_stats(stats)}")
+
+
+def boundary_locator(postcodes_path):
+    """A function that geocodes a frame of sales by postcode (from the ONSPD
+    or Code-Point Open file at postcodes_path) and keeps those inside the
+    cached Cambridgeshire boundary."""
+    from nebula import boundary as boundary_engine
+    from nebula import postcodes
+    log("Preparing the postcode lookup and Cambridgeshire boundary...")
+    with span("Postcode lookup and boundary"):
+        cambridgeshire_boundary = boundary_engine.load_boundary()
+        if cambridgeshire_boundary is None:
+            log(" -> ERROR: No Cambridgeshire boundary has been built yet. Please run load_and_combine.py first.")
+            sys.exit(1)
+        if not os.path.exists(postcodes_path):
+            log(f" -> ERROR: Postcode file not found. Please check the path given to --postcodes.")
+            sys.exit(1)
+        if not postcodes.index_is_fresh(postcodes_path):
+            manifest = postcodes.build_index(postcodes_path)
+            log(f" -> Indexed {manifest['postcodes']:,} postcodes in {manifest['built_seconds']}s.")
+        index = postcodes.PostcodeIndex()
+        boundary_index = boundary_engine.BoundaryIndex(cambridgeshire_boundary)
+
+    def locate(sales):
+        located = postcodes.locate_sales(sales, index, boundary_index)
+        return located.astype({'Easting': 'int64', 'Northing': 'int64'})
+    return locate
+
+
+def main():
+    instrument.start('prices')
+    log("\n--- PRICE DATA PROCESSING SCRIPT ---")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    parser = argparse.ArgumentParser(description="Filter the national Price Paid file to Cambridgeshire sales.")
+    parser.add_argument('--mode', choices=['stream', 'parallel', 'cache', 'full', 'delta'], default='stream',
+                        help="'stream' filters in bounded chunks, 'parallel' filters byte ranges "
+                             "in a process pool, 'cache' reads from the partitioned Parquet cache, "
+                             "'full' loads the whole file first, 'delta' applies a monthly update file.")
+    parser.add_argument('--chunksize', type=int, default=price_paid.DEFAULT_CHUNKSIZE,
+                        help="Rows per chunk in stream mode.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="Worker processes in parallel mode.")
+    parser.add_argument('--range-mb', type=int, default=price_paid.DEFAULT_RANGE_BYTES // (1024 * 1024),
+                        help="Size of each byte range handed to a worker in parallel mode.")
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help="Rebuild the Parquet cache in cache mode even if it looks up to date.")
+    parser.add_argument('--delta-file', default=DEFAULT_DELTA_PATH,
+                        help="Monthly update file to apply in delta mode.")
+    parser.add_argument('--delta-dir',
+                        help="Apply every .csv file in this folder, in name order, instead of --delta-file.")
+    parser.add_argument('--no-compact', action='store_true',
+                        help="In delta mode, never fold the update log back into the cleaned CSV.")
+    parser.add_argument('--within-boundary', action='store_true',
+                        help="Keep only sales whose postcode lies inside the custom Cambridgeshire boundary.")
+    parser.add_argument('--postcodes', default=DEFAULT_POSTCODES_PATH,
+                        help="ONSPD CSV, or a Code-Point Open CSV or folder of CSVs, used by --within-boundary.")
+    args = parser.parse_args()
+
+    if args.mode == 'delta':
+        # --- Apply monthly updates to the existing cleaned data and aggregates ---
+        if args.delta_dir:
+            log(f"Applying the monthly Price Paid updates in: {args.delta_dir}")
+            delta_files = sorted(glob.glob(os.path.join(args.delta_dir, '*.csv')))
+        else:
+            log(f"Applying monthly Price Paid update from: {args.delta_file}")
+            if not os.path.exists(args.delta_file):
+                log(f" -> ERROR: File not found. Please check the path given to --delta-file.")
+                sys.exit(1)
+            delta_files = [args.delta_file]
+        if not os.path.exists(OUTPUT_CLEAN_PRICE_PATH):
+            log(f" -> ERROR: No cleaned price data to update. Please run a full processing mode first.")
+            sys.exit(1)
+        if not os.path.exists(price_updates.manifest_path(OUTPUT_CLEAN_PRICE_PATH)):
+            # Cleaned data from before update logs existed: nothing applied yet.
+            price_updates.reset(OUTPUT_CLEAN_PRICE_PATH)
+        if not delta_files:
+            log(" -> No update files found; nothing to do.")
+            return
+        from nebula import price_delta
+        db_engine = store.connect()
+        store.load_prices(db_engine, OUTPUT_CLEAN_PRICE_PATH)
+        # Filter the update the way the stored sales were, so the two never mix.
+        located = store.prices_located(db_engine)
+        if args.within_boundary and not located:
+            log(" -> ERROR: The stored sales were kept by postcode prefix, not by the boundary. Reprocess "
+                "pp-complete.csv with --within-boundary first, or apply the update without it.")
+            sys.exit(1)
+        if located and not args.within_boundary:
+            log(" -> The stored sales were kept by the custom boundary, so the update will be filtered the same way.")
+        locate = boundary_locator(args.postcodes) if located else None
+        for delta_file in delta_files:
+            with span("Apply monthly update", file=os.path.basename(delta_file)) as step:
+                result = price_delta.apply_delta(
+                    db_engine, delta_file, OUTPUT_CLEAN_PRICE_PATH, locate=locate,
+                    compact_fraction=None if args.no_compact else price_delta.COMPACT_FRACTION)
+                if result is not None:
+                    step.rows_in, step.rows_out = result['records'], result['added']
+            if result is None:
+                log(f" -> {os.path.basename(delta_file)} has already been applied; nothing to do.")
+                continue
+            log(f" -> {os.path.basename(delta_file)}: {result['records']:,} update records, "
+                f"{result['removed']:,} earlier versions removed, "
+                f"{result['added']:,} Cambridgeshire sales added ({result['rows']:,} in total).")
+            if result['compacted']:
+                log(f" -> Folded the update log into {OUTPUT_CLEAN_PRICE_PATH}.")
+        log("\n--- DATA PROCESSING COMPLETE ---")
+        log(f"✅ SUCCESS: The Cambridgeshire house sales dataset has been updated at:")
+        log(f"   -> {OUTPUT_CLEAN_PRICE_PATH}")
+        return
+
+    locate = boundary_locator(args.postcodes) if args.within_boundary else None
+
+    log(f"Loading national Price Paid data from: {INPUT_PRICE_PAID_PATH}")
+    if not os.path.exists(INPUT_PRICE_PAID_PATH):
+        log(f" -> ERROR: File not found. Please check the filename in INPUT_PRICE_PAID_PATH.")
+        sys.exit(1)
+    discarded = price_updates.reset(OUTPUT_CLEAN_PRICE_PATH)
+    if discarded:
+        log(f" -> Discarding {discarded} monthly update(s) applied to the previous cleaned data; "
+            "apply them again with --mode delta afterwards.")
+
+    if args.mode == 'stream':
+        # --- Stream the file chunk by chunk, filtering as we go ---
+        log(f"Streaming in chunks of {args.chunksize:,} rows, keeping postcodes "
+            f"({', '.join(TARGET_POSTCODE_PREFIXES)}) sold between 2010 and 2023...")
+        with span("Filter Price Paid (stream)") as step:
+            stats = price_paid.stream_filter(INPUT_PRICE_PAID_PATH, OUTPUT_CLEAN_PRICE_PATH,
+                                             chunksize=args.chunksize, progress=report_progress)
+            step.rows_in, step.rows_out = stats['rows_read'], stats['rows_kept']
+    elif args.mode == 'parallel':
+        # --- Filter line-aligned byte ranges of the file across a process pool ---
+        log(f"Scanning in {args.range_mb} MB byte ranges across {args.workers} worker processes...")
+        with span("Filter Price Paid (parallel)", workers=args.workers) as step:
+            stats = price_paid.parallel_filter(INPUT_PRICE_PAID_PATH, OUTPUT_CLEAN_PRICE_PATH,
+                                               workers=args.workers,
+                                               range_bytes=args.range_mb * 1024 * 1024,
+                                               progress=report_progress)
+            step.rows_in, step.rows_out = stats['rows_read'], stats['rows_kept']
+    elif args.mode == 'cache':
+        # --- Read only the matching partitions of the columnar cache ---
+        from nebula import price_cache
+        if args.rebuild_cache or not price_cache.cache_is_fresh(INPUT_PRICE_PAID_PATH):
+            log(f"Building the Parquet cache at {price_cache.DEFAULT_CACHE_DIR} (one-time, slow)...")
+            with span("Build Parquet cache") as step:
+                manifest = price_cache.build_cache(
+                    INPUT_PRICE_PAID_PATH, chunksize=args.chunksize,
+                    progress=lambda rows: log(f" -> {rows:,} rows converted"))
+                step.rows_in = manifest['rows']
+        else:
+            log(f"Using the up-to-date Parquet cache at {price_cache.DEFAULT_CACHE_DIR}.")
+        with span("Read matching partitions") as step:
+            df_cambs_filtered = price_cache.read_filtered()
+            price_paid.write_price_frame(df_cambs_filtered, OUTPUT_CLEAN_PRICE_PATH)
+            step.rows_out = len(df_cambs_filtered)
+    else:
+        log("This will be slow as the file is very large...")
+        with span("Load pp-complete.csv") as step:
+            df = price_paid.read_price_paid(INPUT_PRICE_PAID_PATH)
+            step.rows_out = len(df)
+
+        # --- Filter by Postcode and Date (2010-2023) to get the Cambridgeshire Area ---
+        log(f"\nFiltering for Cambridgeshire area postcodes ({', '.join(TARGET_POSTCODE_PREFIXES)}) "
+            "sold between 2010 and 2023...")
+        with span("Filter and save", rows_in=len(df)) as step:
+            df_cambs_filtered = price_paid.filter_price_frame(df)
+            # --- Save the Clean, Focused Dataset ---
+            price_paid.write_price_frame(df_cambs_filtered, OUTPUT_CLEAN_PRICE_PATH)
+            step.rows_out = len(df_cambs_filtered)
+
+    if locate is not None:
+        # --- Keep only sales whose postcode lies inside the custom boundary ---
+        with span("Keep sales inside the boundary") as step:
+            sales = pd.read_csv(OUTPUT_CLEAN_PRICE_PATH, dtype=str, keep_default_na=False)
+            located_sales = locate(sales)
+            price_paid.write_price_frame(located_sales, OUTPUT_CLEAN_PRICE_PATH)
+            step.rows_in, step.rows_out = len(sales), len(located_sales)
+
+    # --- Keep the persistent analytical store in step with the cleaned CSV ---
+    with span("Load the analytical store") as step:
+        step.rows_in = store.load_prices(store.connect(), OUTPUT_CLEAN_PRICE_PATH)
+    if step.rows_in is None:
+        log(f" -> The analytical store at {store.DEFAULT_STORE_PATH} already holds these sales.")
+
+    log("\n--- DATA PROCESSING COMPLETE ---")
+    log(f"✅ SUCCESS: A clean, focused dataset of Cambridgeshire house sales has been saved to:")
+    log(f"   -> {OUTPUT_CLEAN_PRICE_PATH}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,92 +3,147 @@
 # focusing on a consistent timeframe (2010-2023) and excluding any data
 # that cannot be reliably categorized into a known town/village sector.
 
-import pandas as pd
 import os
-from sqlalchemy import create_engine
-from openpyxl import Workbook
+import sys
 
-print("\n--- GENERATE DEFINITIVE MARKET REPORT ---")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nebula import binning, instrument, market_context, store
+from nebula.instrument import log, span
+from nebula.report_writer import DEFAULT_TABLES_DIR, ReportWriter
 
 # --- Configuration ---
 INPUT_MASTER_PATH = os.path.join('reports', 'Master_Cambridgeshire_Data.csv')
+INPUT_PRICE_DATA_PATH = os.path.join('reports', 'Cambridgeshire_Price_Data_2010-2023.csv')
 OUTPUT_DIR = 'reports'
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-db_engine = create_engine('sqlite:///:memory:')
-
-# ---  Load Master Data into SQL Database ---
-print(f"Loading master data from: {INPUT_MASTER_PATH}")
-try:
-    master_df = pd.read_csv(INPUT_MASTER_PATH)
-    master_df.to_sql('cambridge_sites', db_engine, if_exists='replace', index=False)
-    print(f" -> Successfully loaded {len(master_df)} sites into SQL database.")
-except Exception as e:
-    print(f" -> ERROR: Could not load master file. Please run script 1 first. Error: {e}")
-    exit()
-
-# --- 2. Use SQL to Query ALL Permissioned Sites ---
-print("Using SQL to query for all permissioned sites...")
-sql_query = "SELECT * FROM cambridge_sites WHERE PlanningStatus = 'permissioned';"
-all_activity_df = pd.read_sql_query(sql_query, db_engine, parse_dates=['PermissionDate'])
-all_activity_df['Dwellings'] = pd.to_numeric(all_activity_df['Dwellings'], errors='coerce').fillna(0)
-print(f" -> Found {len(all_activity_df)} permissioned sites for analysis.")
-
-
-# --- 3. Data Cleaning and Filtering ---
-print("\nCleaning data: Filtering for dates since 2010 and parsing sectors...")
-
-# --- Filter for a consistent timeframe from 2010 onwards ---
-analysis_df = all_activity_df[all_activity_df['PermissionDate'] >= '2010-01-01'].copy()
-print(f" -> Focusing on {len(analysis_df)} sites with permissions granted since 2010.")
-
-# ---  Intelligent Sector Parsing ---
-cambridgeshire_sectors = [
-    'FULBOURN', 'GREAT SHELFORD', 'HISTON', 'OAKINGTON', 'IMPINGTON', 'TEVERSHAM',
-    'LINTON', 'WATERBEACH', 'SAWSTON', 'MELDRETH', 'MELBOURN', 'FOXTON',
-    'HARDWICK', 'CALDECOTE', 'SWAVESEY', 'PAPWORTH EVERARD', 'MILTON', 'HARSTON',
-    'BASSINGBOURN', 'COTTENHAM', 'GAMLINGAY', 'COMBERTON', 'BARTON', 'ROYSTON', 'SANDY'
-]
-pattern = f'({"|".join(cambridgeshire_sectors)})'
-analysis_df['Sector'] = analysis_df['Address'].str.upper().str.extract(pattern)
-
-# --- Remove all uncategorized sites ---
-initial_count = len(analysis_df)
-analysis_df.dropna(subset=['Sector'], inplace=True)
-removed_count = initial_count - len(analysis_df)
-print(f" -> Removed {removed_count} sites that could not be categorized into a known sector.")
-print(f" -> {len(analysis_df)} categorized sites remain for final analysis.")
-
-
-# --- 4. Perform Final, Cleaned Analysis ---
-print("\nPerforming final analysis on cleaned data...")
-
-# Analysis A: Growth of Development Over Time (2010-Present)
-analysis_df['Year'] = analysis_df['PermissionDate'].dt.year
-growth_by_year = analysis_df.groupby('Year').agg(
-    Total_Permissions_Granted=('SiteReference', 'count'),
-    Total_Dwellings_in_Plans=('Dwellings', 'sum')
-).sort_values(by='Year', ascending=False)
-print(" -> Yearly growth analysis complete.")
-
-# Hotspot Analysis (for sites providing new dwellings)
-dwelling_dev_df = analysis_df[analysis_df['Dwellings'] >= 1].copy()
-hotspot_analysis = dwelling_dev_df.groupby('Sector').agg(
-    Total_Dwellings_Approved=('Dwellings', 'sum'),
-    Number_of_Projects=('Sector', 'count')
-).sort_values(by='Total_Dwellings_Approved', ascending=False)
-
-total_dwellings = hotspot_analysis['Total_Dwellings_Approved'].sum()
-hotspot_analysis['%_of_Total_Dwellings'] = ((hotspot_analysis['Total_Dwellings_Approved'] / total_dwellings) * 100).round(2)
-print(" -> Hotspot and % Growth analysis complete.")
-
-
-# --- Save the Final, Cleaned Intelligence Report ---
-output_excel_path = os.path.join(OUTPUT_DIR, 'Cambridgeshire_Market_Analysis_FINAL.xlsx')
-print(f"\nSaving final multi-tabbed Excel report to: {output_excel_path}")
-
-with pd.ExcelWriter(output_excel_path) as writer:
-    growth_by_year.to_excel(writer, sheet_name='Development Growth (2010-Present)')
-    hotspot_analysis.to_excel(writer, sheet_name='Hotspot Analysis by Sector')
-    analysis_df.to_excel(writer, sheet_name='Cleaned Data Used in Report', index=False)
-
-print("\n✅ SUCCESS: Final, cleaned Market Analysis Report Generated.")
\ No newline at end of file
+
+
+def main():
+    instrument.start('report')
+    log("\n--- GENERATE DEFINITIVE MARKET REPORT ---")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # A persistent, indexed SQLite store; the master CSV is only reloaded when it changes.
+    db_engine = store.connect()
+
+    # ---  Load Master Data into SQL Database ---
+    log(f"Loading master data from: {INPUT_MASTER_PATH}")
+    try:
+        with span("Load master data into SQL"):
+            loaded = store.load_sites(db_engine, INPUT_MASTER_PATH)
+        if loaded is None:
+            log(f" -> Master file unchanged; using the {store.count_sites(db_engine)} sites already in {store.DEFAULT_STORE_PATH}.")
+        else:
+            log(f" -> Successfully loaded {loaded} sites into SQL database at {store.DEFAULT_STORE_PATH}.")
+    except Exception as e:
+        log(f" -> ERROR: Could not load master file. Please run script 1 first. Error: {e}")
+        sys.exit(1)
+
+    # The sales are read from the store too; bring it in line with the cleaned
+    # price CSV and any monthly updates applied to it.
+    if os.path.exists(INPUT_PRICE_DATA_PATH):
+        with span("Sync the price store") as step:
+            step.rows_in = store.load_prices(db_engine, INPUT_PRICE_DATA_PATH)
+
+    # --- 2. Use SQL to Count ALL Permissioned Sites ---
+    log("Using SQL to query for all permissioned sites...")
+    permissioned_count = store.count_sites(db_engine, "PlanningStatus = 'permissioned'")
+    log(f" -> Found {permissioned_count} permissioned sites for analysis.")
+
+
+    # --- 3. Data Cleaning and Filtering ---
+    # Sectors are parsed when the sites are loaded (whole-word, longest-match lookup
+    # against the shared gazetteer in nebula/sectors.py); the filters run in SQL.
+    log("\nCleaning data: Filtering for dates since 2010 and parsing sectors...")
+    since_2010 = {'since': store.SINCE_DATE}
+    recent_count = store.count_sites(
+        db_engine, "PlanningStatus = 'permissioned' AND PermissionDate >= :since", **since_2010)
+    log(f" -> Focusing on {recent_count} sites with permissions granted since 2010.")
+
+    # --- Remove all uncategorized sites ---
+    categorized_count = store.count_sites(
+        db_engine, "PlanningStatus = 'permissioned' AND PermissionDate >= :since AND Sector IS NOT NULL",
+        **since_2010)
+    log(f" -> Removed {recent_count - categorized_count} sites that could not be categorized into a known sector.")
+    log(f" -> {categorized_count} categorized sites remain for final analysis.")
+
+
+    # --- 4. Perform Final, Cleaned Analysis (aggregated inside the database) ---
+    log("\nPerforming final analysis on cleaned data...")
+
+    # Analysis A: Growth of Development Over Time (2010-Present)
+    with span("Yearly growth"):
+        growth_by_year = store.yearly_growth(db_engine)
+
+    # Hotspot Analysis (for sites providing new dwellings)
+    with span("Sector hotspots"):
+        hotspot_analysis = store.sector_hotspots(db_engine)
+
+    # Analysis B: Hotspots by hexagonal grid cell. Unlike the sector table this
+    # uses every located site, including those whose address names no known village.
+    with span("Grid hotspots") as step:
+        development_sites = store.development_sites(db_engine)
+        grid_hotspots = {
+            size: binning.site_hotspots(development_sites['longitude'], development_sites['latitude'],
+                                        development_sites['Dwellings'], size)
+            for size in binning.DEFAULT_RESOLUTIONS
+        }
+        step.rows_in = len(development_sites)
+    log(f" -> Grid hotspot analysis complete for {len(development_sites)} located sites.")
+
+    # Analysis B2: Sales and total spend per hexagonal grid cell, from every
+    # geocoded sale. Only possible when the prices carry coordinates.
+    with span("Grid spend") as step:
+        located_sales = store.located_sales(db_engine)
+        grid_spend = {}
+        if located_sales is not None:
+            grid_spend = {
+                size: binning.sale_hotspots(located_sales['Easting'], located_sales['Northing'],
+                                            located_sales['Price'], size)
+                for size in binning.DEFAULT_RESOLUTIONS
+            }
+            step.rows_in = len(located_sales)
+    if located_sales is None:
+        log(" -> Skipped spend per grid cell: the sales have no coordinates "
+            "(run process_price_data.py with --within-boundary).")
+    else:
+        log(f" -> Grid spend analysis complete for {len(located_sales):,} located sales.")
+
+    # The row-level sites behind the report, for the detail sheet only.
+    analysis_df = store.analysis_sites(db_engine)
+
+    # Analysis C: The local market around each site - sales, median price and
+    # year-on-year change within several radii, from a KD-tree over located sales.
+    with span("Market context", rows_in=len(analysis_df)):
+        recent_sales = store.recent_sales(db_engine, 2 * market_context.DEFAULT_WINDOW_DAYS)
+        site_context = market_context.site_market_context(analysis_df, recent_sales)
+    if site_context is None:
+        log(" -> Skipped local market context: the sales have no coordinates "
+            "(run process_price_data.py with --within-boundary).")
+    else:
+        analysis_df = analysis_df.drop(columns=site_context.columns, errors='ignore').join(site_context)
+        log(f" -> Local market context added for {len(analysis_df)} sites from {len(recent_sales):,} recent sales.")
+
+
+    # --- Save the Final, Cleaned Intelligence Report ---
+    output_excel_path = os.path.join(OUTPUT_DIR, 'Cambridgeshire_Market_Analysis_FINAL.xlsx')
+    log(f"\nSaving final multi-tabbed Excel report to: {output_excel_path}")
+    # The workbook is streamed sheet by sheet; every table is also saved as Parquet
+    # in DEFAULT_TABLES_DIR, which is what the visualisation scripts read.
+    with span("Write report"), ReportWriter(output_excel_path) as report:
+        report.add('Development Growth by Year', growth_by_year, index=True)
+        report.add('Hotspot Analysis by Sector', hotspot_analysis, index=True)
+        for size, cells in grid_hotspots.items():
+            report.add(f'Hex Hotspots {size // 1000}km', cells)
+        for size, cells in grid_spend.items():
+            report.add(f'Hex Spend {size // 1000}km', cells)
+        shown = report.add('Cleaned Data Used in Report', analysis_df, row_level=True)
+    if shown < len(analysis_df):
+        log(f" -> The detail sheet shows the first {shown:,} of {len(analysis_df):,} sites; "
+            f"all of them are in {DEFAULT_TABLES_DIR}.")
+    log(f" -> Report tables saved for the next scripts in: {DEFAULT_TABLES_DIR}")
+
+    log("\n✅ SUCCESS: Final, cleaned Market Analysis Report Generated.")
+
+
+if __name__ == '__main__':
+    main()
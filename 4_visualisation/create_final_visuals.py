@@ -4,117 +4,127 @@
 # interactive map with zoomable, semi-transparent circles and individual site markers.
 
 import pandas as pd
-import geopandas as gpd
 import os
+import sys
 import folium
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-print("\n--- SCRIPT 3 (ADVANCED MAP): GENERATE FINAL VISUALS ---")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nebula import instrument, maps
+from nebula.instrument import log, span
+from nebula.report_writer import DEFAULT_TABLES_DIR, read_table
+from nebula.sectors import SectorMatcher
 
 # --- Configuration ---
-INPUT_REPORT_PATH = os.path.join('reports', 'Cambridgeshire_Market_Analysis_FINAL.xlsx')
+# The report's tables as Parquet, written alongside the Excel workbook.
+INPUT_REPORT_TABLES_DIR = DEFAULT_TABLES_DIR
 INPUT_MASTER_PATH = os.path.join('reports', 'Master_Cambridgeshire_Data.csv')
 OUTPUT_DIR = 'reports'
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-# --- 1. Load the Final Analysis Data ---
-print(f"Loading final analysis data from: {INPUT_REPORT_PATH}")
-try:
-    growth_by_year_df = pd.read_excel(INPUT_REPORT_PATH, sheet_name='Development Growth by Year')
-    hotspot_analysis_df = pd.read_excel(INPUT_REPORT_PATH, sheet_name='Hotspot Analysis by Sector')
-    all_sites_df = pd.read_csv(INPUT_MASTER_PATH)
-    print(" -> Successfully loaded analysis data.")
-except Exception as e:
-    print(f" -> FATAL ERROR: Could not load required files. Please run previous scripts first. Details: {e}")
-    exit()
-
-# --- 2. Create and Save the Yearly Growth Chart (.png) ---
-print("\nGenerating static bar chart for yearly development growth...")
-growth_by_year_df.set_index('Year', inplace=True)
-start_year = growth_by_year_df.index.min()
-end_year = growth_by_year_df.index.max()
-dynamic_title = f'Total Dwellings in Approved Plans per Year ({start_year}-{end_year})'
-
-sns.set_theme(style="whitegrid")
-plt.figure(figsize=(12, 7))
-barplot = sns.barplot(x=growth_by_year_df.index, y='Total_Dwellings_in_Plans', data=growth_by_year_df, palette='viridis')
-plt.title(dynamic_title, fontsize=16, weight='bold')
-plt.xlabel('Year of Planning Permission', fontsize=12)
-plt.ylabel('Total Number of Dwellings Approved', fontsize=12)
-plt.xticks(rotation=45)
-plt.tight_layout()
-chart_output_path = os.path.join(OUTPUT_DIR, 'Yearly_Development_Growth.png')
-plt.savefig(chart_output_path, dpi=300)
-print(f"✅ SUCCESS: Yearly growth chart saved to: {chart_output_path}")
-
-
-# --- 3. Create the Advanced Interactive Hotspot Map (.html) ---
-print("\nGenerating advanced interactive map with multiple layers...")
-
-# Prepare data for mapping
-all_sites_df['Sector'] = all_sites_df['Address'].str.upper().str.extract(f"({'|'.join(hotspot_analysis_df.Sector.unique())})")
-all_sites_df.dropna(subset=['Sector', 'longitude', 'latitude'], inplace=True)
-
-all_sites_gdf = gpd.GeoDataFrame(
-    all_sites_df,
-    geometry=gpd.points_from_xy(all_sites_df.longitude, all_sites_df.latitude),
-    crs="EPSG:4326"
-)
-
-sector_locations = all_sites_gdf.groupby('Sector')[['longitude', 'latitude']].mean().reset_index()
-hotspot_map_data = pd.merge(hotspot_analysis_df, sector_locations, on='Sector', how='left')
-hotspot_map_gdf = gpd.GeoDataFrame(
-    hotspot_map_data,
-    geometry=gpd.points_from_xy(hotspot_map_data.longitude, hotspot_map_data.latitude),
-    crs="EPSG:4326"
-)
-
-# Create the base map
-map_center = [52.3, 0.1]
-site_map = folium.Map(location=map_center, zoom_start=10, tiles='CartoDB positron')
-
-# --- LAYER 1: Hotspot Circles ---
-hotspot_layer = folium.FeatureGroup(name='Development Hotspots (by Sector)', show=True)
-for idx, row in hotspot_map_gdf.iterrows():
-    total_dwellings = row['Total_Dwellings_Approved']
-    radius_in_meters = (total_dwellings**0.5) * 100
-    color = 'green' if total_dwellings <= 10 else 'orange' if total_dwellings <= 50 else 'red'
-    popup_text = f"<h3>{row['Sector']}</h3><b>Total Dwellings Approved:</b> {int(total_dwellings)}"
-    
-    if pd.notna(row.geometry.y) and pd.notna(row.geometry.x):
-        folium.Circle(
-            location=[row.geometry.y, row.geometry.x],
-            radius=radius_in_meters,
-            color=color,
-            fill=True,
-            fill_opacity=0.5, # Make circles semi-transparent
-            popup=folium.Popup(popup_text, max_width=300)
-        ).add_to(hotspot_layer)
-hotspot_layer.add_to(site_map)
-
-# --- LAYER 2: Individual Project Markers ---
-projects_layer = folium.FeatureGroup(name='Individual Projects', show=False) # Off by default
-for idx, row in all_sites_gdf.iterrows():
-    dwellings = row['Dwellings']
-    if pd.notna(dwellings) and dwellings >= 1:
-        popup_text = f"<b>Address:</b> {row['Address']}<br><b>Dwellings:</b> {int(dwellings)}"
-        folium.CircleMarker(
-            location=[row.geometry.y, row.geometry.x],
-            radius=3, # Small, consistent size
-            color='navy',
-            fill=True,
-            fill_opacity=0.8,
-            popup=popup_text
-        ).add_to(projects_layer)
-projects_layer.add_to(site_map)
-
-# Add the Layer Control panel to the map
-folium.LayerControl().add_to(site_map)
-
-# Save the final map
-map_output_path = os.path.join(OUTPUT_DIR, 'Final_Interactive_Dashboard_Map.html')
-site_map.save(map_output_path)
-print(f"✅ SUCCESS: Advanced Interactive Map saved to: {map_output_path}")
-
-print("\n--- PROJECT VISUALS COMPLETE ---")
\ No newline at end of file
+HEX_SIZE = 1_000  # metres; must match one of the report's hex hotspot and spend sheets
+
+
+def main():
+    instrument.start('visuals')
+    log("\n--- SCRIPT 3 (ADVANCED MAP): GENERATE FINAL VISUALS ---")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # --- 1. Load the Final Analysis Data ---
+    log(f"Loading final analysis data from: {INPUT_REPORT_TABLES_DIR}")
+    try:
+        growth_by_year_df = read_table('Development Growth by Year', INPUT_REPORT_TABLES_DIR)
+        hotspot_analysis_df = read_table('Hotspot Analysis by Sector', INPUT_REPORT_TABLES_DIR)
+        hex_hotspots_df = read_table(f'Hex Hotspots {HEX_SIZE // 1000}km', INPUT_REPORT_TABLES_DIR)
+        with span("Read master CSV") as step:
+            all_sites_df = pd.read_csv(INPUT_MASTER_PATH)
+            step.rows_out = len(all_sites_df)
+        log(" -> Successfully loaded analysis data.")
+    except Exception as e:
+        log(f" -> FATAL ERROR: Could not load required files. Please run previous scripts first. Details: {e}")
+        sys.exit(1)
+    # Only in the report when the sales were geocoded (--within-boundary).
+    try:
+        hex_spend_df = read_table(f'Hex Spend {HEX_SIZE // 1000}km', INPUT_REPORT_TABLES_DIR)
+    except ValueError:
+        hex_spend_df = None
+
+    # --- 2. Create and Save the Yearly Growth Chart (.png) ---
+    log("\nGenerating static bar chart for yearly development growth...")
+    growth_by_year_df.set_index('Year', inplace=True)
+    start_year = growth_by_year_df.index.min()
+    end_year = growth_by_year_df.index.max()
+    dynamic_title = f'Total Dwellings in Approved Plans per Year ({start_year}-{end_year})'
+
+    sns.set_theme(style="whitegrid")
+    plt.figure(figsize=(12, 7))
+    barplot = sns.barplot(x=growth_by_year_df.index, y='Total_Dwellings_in_Plans', data=growth_by_year_df, palette='viridis')
+    plt.title(dynamic_title, fontsize=16, weight='bold')
+    plt.xlabel('Year of Planning Permission', fontsize=12)
+    plt.ylabel('Total Number of Dwellings Approved', fontsize=12)
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    chart_output_path = os.path.join(OUTPUT_DIR, 'Yearly_Development_Growth.png')
+    with span("Render growth chart"):
+        plt.savefig(chart_output_path, dpi=300)
+    log(f"✅ SUCCESS: Yearly growth chart saved to: {chart_output_path}")
+
+
+    # --- 3. Create the Advanced Interactive Hotspot Map (.html) ---
+    log("\nGenerating advanced interactive map with multiple layers...")
+
+    # Prepare data for mapping
+    sector_matcher = SectorMatcher(hotspot_analysis_df.Sector.unique())
+    all_sites_df['Sector'] = sector_matcher.match(all_sites_df['Address'])
+    all_sites_df.dropna(subset=['Sector', 'longitude', 'latitude'], inplace=True)
+
+    sector_locations = all_sites_df.groupby('Sector')[['longitude', 'latitude']].mean().reset_index()
+    hotspot_map_data = pd.merge(hotspot_analysis_df, sector_locations, on='Sector', how='left')
+
+    # Create the base map
+    map_center = [52.3, 0.1]
+    site_map = folium.Map(location=map_center, zoom_start=10, tiles='CartoDB positron')
+
+    # --- LAYER 1: Hotspot Circles ---
+    hotspot_layer = maps.hotspot_circle_layer(
+        hotspot_map_data['Sector'], hotspot_map_data['latitude'], hotspot_map_data['longitude'],
+        hotspot_map_data['Total_Dwellings_Approved'])
+    hotspot_layer.add_to(site_map)
+
+    # --- LAYER 2: Hexagonal Density of Approved Dwellings ---
+    # Built from every located site, not just those in a named sector.
+    density_layer = maps.grid_density_layer(
+        hex_hotspots_df, HEX_SIZE, 'Total_Dwellings_Approved',
+        name=f'Dwellings Approved per {HEX_SIZE // 1000} km Hexagon', show=False)
+    density_layer.add_to(site_map)
+
+    # --- LAYER 2b: Hexagonal Density of Market Spend (geocoded sales only) ---
+    if hex_spend_df is not None:
+        spend_layer = maps.grid_density_layer(
+            hex_spend_df, HEX_SIZE, 'Total_Spend',
+            name=f'Sales Spend per {HEX_SIZE // 1000} km Hexagon', show=False)
+        spend_layer.add_to(site_map)
+
+    # --- LAYER 3: Individual Project Markers ---
+    # Clustered by zoom level and sent to the browser as one compact array; popups
+    # are only built when a marker is clicked.
+    project_sites = all_sites_df[pd.to_numeric(all_sites_df['Dwellings'], errors='coerce') >= 1]
+    projects_layer = maps.site_cluster_layer(
+        project_sites['latitude'], project_sites['longitude'],
+        project_sites['Address'], project_sites['Dwellings'],
+        name='Individual Projects', show=False)  # Off by default
+    projects_layer.add_to(site_map)
+
+    # Add the Layer Control panel to the map
+    folium.LayerControl().add_to(site_map)
+
+    # Save the final map
+    map_output_path = os.path.join(OUTPUT_DIR, 'Final_Interactive_Dashboard_Map.html')
+    with span("Save map"):
+        site_map.save(map_output_path)
+    log(f"✅ SUCCESS: Advanced Interactive Map saved to: {map_output_path}")
+
+    log("\n--- PROJECT VISUALS COMPLETE ---")
+
+
+if __name__ == '__main__':
+    main()
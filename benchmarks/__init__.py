@@ -0,0 +1,4 @@
+# benchmarks/__init__.py
+# PURPOSE: A benchmark harness for the pipeline: seeded generators for
+# synthetic inputs in the real file layouts (generators.py) and a runner that
+# times each stage and keeps a history of the results (run.py).
@@ -0,0 +1,299 @@
+# benchmarks/generators.py
+# PURPOSE: Seeded generators for synthetic inputs in the real file layouts, so
+# the pipeline can be run and timed without the multi-GB downloads:
+#   - pp-complete.csv (Price Paid: 16 quoted columns, no header), written in
+#     chunks so 30M rows never sit in memory at once;
+#   - a national brownfield register CSV with POINT(lon lat) WKT, a share of
+#     whose sites fall inside the synthetic county;
+#   - cadastral parcel GML (the OGR GML 3.2 layout of the INSPIRE downloads),
+#     one file per council, cut from one jittered lattice so neighbouring
+#     parcels (and councils) share their edges exactly.
+# The same seed and sizes always give byte-identical files.
+#
+# USAGE: python -m benchmarks.generators --out DIR [--price-rows N] [--sites N]
+#                                        [--parcels N] [--seed N]
+#   DIR takes the place of 1_data_acquisition/raw_data.
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from nebula.sectors import CAMBRIDGESHIRE_SECTORS
+from nebula.wkt import osgb_to_lonlat
+
+GENERATOR_VERSION = 1
+MANIFEST_NAME = '_synthetic.json'
+COUNCILS = ('Cambridge_City_Council', 'East_Cambridgeshire_District_Council',
+            'South_Cambridgeshire_District_Council')
+# South-west corner of the synthetic county (British National Grid metres).
+COUNTY_ORIGIN = (520_000, 230_000)
+DEFAULT_PARCEL_SIZE = 60  # metres
+DEFAULT_CHUNK_ROWS = 1_000_000
+# Postcode areas and their relative share of sales. CB, PE and SG are the ones
+# the price filter keeps.
+POSTCODE_AREAS = {
+    'CB': 2, 'PE': 3, 'SG': 2, 'B': 5, 'M': 5, 'LS': 4, 'S': 4, 'SW': 4, 'SE': 4,
+    'N': 3, 'E': 3, 'BS': 4, 'NG': 4, 'LE': 4, 'CV': 3, 'RG': 4, 'GU': 5, 'BN': 4,
+    'PO': 4, 'SO': 4, 'OX': 3, 'MK': 3, 'NR': 4, 'IP': 4, 'CM': 4, 'CO': 3, 'LU': 2, 'YO': 3,
+}
+POSTCODE_UNIT_LETTERS = list('ABDEFGHJLNPQRSTUWXYZ')
+OTHER_PLACES = ['CAMBRIDGE', 'ELY', 'ST IVES', 'HUNTINGDON', 'NEWMARKET', 'HAVERHILL', 'SOHAM']
+STREETS = ['HIGH STREET', 'STATION ROAD', 'CHURCH LANE', 'MILL LANE', 'THE GREEN', 'LONDON ROAD',
+           'MAIN STREET', 'PARK ROAD', 'VICTORIA ROAD', 'NEW ROAD']
+BROWNFIELD_COLUMNS = [
+    'dataset', 'end-date', 'entity', 'entry-date', 'start-date', 'name', 'organisation',
+    'point', 'reference', 'site-address', 'hectares', 'ownership-status',
+    'planning-permission-status', 'planning-permission-type', 'planning-permission-date',
+    'maximum-net-dwellings', 'minimum-net-dwellings', 'deliverable', 'notes',
+]
+# Roughly England, in lon/lat.
+NATIONAL_BOUNDS = (-5.5, 50.1, 1.7, 55.5)
+
+
+def _choice(rng, options, size, p=None):
+    options = np.asarray(options, dtype=object)
+    if p is not None:
+        p = np.asarray(p, dtype='float64') / np.sum(p)
+    return options[rng.choice(len(options), size=size, p=p)]
+
+
+def _as_str(values):
+    return pd.Series(values).astype(str)
+
+
+# --- Price Paid ---
+
+def price_paid_chunk(first_row, rows, seed=0):
+    """Synthetic Price Paid rows first_row .. first_row + rows - 1, as a
+    DataFrame of strings in file column order."""
+    rng = np.random.default_rng([seed, first_row])
+    postcode = (_as_str(_choice(rng, list(POSTCODE_AREAS), rows, p=list(POSTCODE_AREAS.values())))
+                + _as_str(rng.integers(1, 30, rows)) + ' ' + _as_str(rng.integers(0, 10, rows))
+                + _as_str(_choice(rng, POSTCODE_UNIT_LETTERS, rows))
+                + _as_str(_choice(rng, POSTCODE_UNIT_LETTERS, rows)))
+    postcode[rng.random(rows) < 0.005] = ''  # a few sales have no postcode
+    days = np.datetime64('1995-01-01') + rng.integers(0, 30 * 365, rows).astype('timedelta64[D]')
+    row_ids = pd.Series(np.arange(first_row, first_row + rows))
+    return pd.DataFrame({
+        'TransactionID': row_ids.map(lambda i: f'{{{i:08X}-0000-4000-8000-{seed:012X}}}'),
+        'Price': _as_str(np.exp(rng.normal(12.4, 0.6, rows)).astype(np.int64)),
+        'DateOfTransfer': _as_str(np.datetime_as_string(days, unit='D')) + ' 00:00',
+        'Postcode': postcode,
+        'PropertyType': _choice(rng, list('DSTFO'), rows, p=[25, 28, 28, 17, 2]),
+        'OldNew': _choice(rng, ['N', 'Y'], rows, p=[9, 1]),
+        'Duration': _choice(rng, ['F', 'L'], rows, p=[3, 1]),
+        'PAON': _as_str(rng.integers(1, 200, rows)),
+        'SAON': '',
+        'Street': _choice(rng, STREETS, rows),
+        'Locality': '',
+        'TownCity': _choice(rng, OTHER_PLACES, rows),
+        'District': 'SOUTH CAMBRIDGESHIRE',
+        'County': 'CAMBRIDGESHIRE',
+        'PPD_Category': _choice(rng, ['A', 'B'], rows, p=[19, 1]),
+        'Record_Status': 'A',
+    })
+
+
+def write_price_paid(path, rows, seed=0, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Write a synthetic pp-complete.csv of `rows` rows with every field
+    quoted, as in the Land Registry download."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        for first_row in range(0, rows, chunk_rows):
+            chunk = price_paid_chunk(first_row, min(chunk_rows, rows - first_row), seed)
+            chunk.to_csv(f, header=False, index=False, quoting=csv.QUOTE_ALL)
+    return rows
+
+
+# --- Cadastral parcels ---
+
+def parcel_lattice(parcels, seed=0, origin=COUNTY_ORIGIN, parcel_size=DEFAULT_PARCEL_SIZE):
+    """Corner coordinates of a roughly square grid of at least `parcels`
+    cells, each interior corner nudged by up to a quarter of a cell. Returns
+    two (rows + 1, columns + 1) arrays."""
+    columns = int(np.ceil(np.sqrt(parcels)))
+    rows = int(np.ceil(parcels / columns))
+    rng = np.random.default_rng([seed, parcels])
+    x, y = np.meshgrid(origin[0] + parcel_size * np.arange(columns + 1, dtype='float64'),
+                       origin[1] + parcel_size * np.arange(rows + 1, dtype='float64'))
+    jitter = rng.uniform(-0.25, 0.25, (2,) + x.shape) * parcel_size
+    # The outline of the county stays straight.
+    jitter[:, [0, -1], :] = 0
+    jitter[:, :, [0, -1]] = 0
+    return (x + jitter[0]).round(3), (y + jitter[1]).round(3)
+
+
+_GML_HEADER = """<?xml version="1.0" encoding="utf-8" ?>
+<ogr:FeatureCollection
+     gml:id="aFeatureCollection"
+     xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+     xmlns:ogr="http://ogr.maptools.org/"
+     xmlns:gml="http://www.opengis.net/gml/3.2">
+"""
+_GML_FEATURE = """  <ogr:featureMember>
+    <ogr:Land_Registry_Cadastral_Parcels gml:id="Land_Registry_Cadastral_Parcels.{fid}">
+      <ogr:geometryProperty><gml:Polygon srsName="urn:ogc:def:crs:EPSG::27700" gml:id="Land_Registry_Cadastral_Parcels.geom.{fid}"><gml:exterior><gml:LinearRing><gml:posList>{pos}</gml:posList></gml:LinearRing></gml:exterior></gml:Polygon></ogr:geometryProperty>
+      <ogr:INSPIREID>{inspire_id}</ogr:INSPIREID>
+      <ogr:LABEL>{inspire_id}</ogr:LABEL>
+      <ogr:NATIONALCADASTRALREFERENCE>{inspire_id}</ogr:NATIONALCADASTRALREFERENCE>
+      <ogr:VALIDFROM>2009-01-01T00:00:00</ogr:VALIDFROM>
+    </ogr:Land_Registry_Cadastral_Parcels>
+  </ogr:featureMember>
+"""
+_GML_FOOTER = "</ogr:FeatureCollection>\n"
+
+
+def write_cadastral_gml(path, corner_x, corner_y, columns, limit=None, first_id=0):
+    """Write the parcels in lattice `columns` (a range) to one GML file, row
+    by row, stopping after `limit` parcels. Returns the number written."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    written = 0
+    with open(path, 'w') as f:
+        f.write(_GML_HEADER)
+        for row in range(corner_x.shape[0] - 1):
+            c = np.arange(columns.start, columns.stop)
+            if limit is not None:
+                c = c[:max(limit - written, 0)]
+            if len(c) == 0:
+                break
+            # Corners anticlockwise from the south-west, closed.
+            ring_x = np.stack([corner_x[row, c], corner_x[row, c + 1], corner_x[row + 1, c + 1],
+                               corner_x[row + 1, c], corner_x[row, c]], axis=1)
+            ring_y = np.stack([corner_y[row, c], corner_y[row, c + 1], corner_y[row + 1, c + 1],
+                               corner_y[row + 1, c], corner_y[row, c]], axis=1)
+            for x, y in zip(ring_x.tolist(), ring_y.tolist()):
+                fid = first_id + written
+                f.write(_GML_FEATURE.format(fid=written, inspire_id=fid,
+                                            pos=' '.join(f'{a} {b}' for a, b in zip(x, y))))
+                written += 1
+        f.write(_GML_FOOTER)
+    return written
+
+
+def write_council_parcels(land_registry_dir, parcels, seed=0, councils=COUNCILS,
+                          parcel_size=DEFAULT_PARCEL_SIZE):
+    """Split one county lattice of `parcels` parcels into side-by-side
+    council GML files. Returns {council: path} and the county's bounds."""
+    corner_x, corner_y = parcel_lattice(parcels, seed=seed, parcel_size=parcel_size)
+    total_columns = corner_x.shape[1] - 1
+    splits = np.linspace(0, total_columns, len(councils) + 1).round().astype(int)
+    rows = corner_x.shape[0] - 1
+    paths, first_id = {}, 0
+    for council, start, stop in zip(councils, splits[:-1], splits[1:]):
+        path = os.path.join(land_registry_dir, council, 'Land_Registry_Cadastral_Parcels.gml')
+        # Spread the parcel count over the councils in proportion to their width.
+        limit = int(round(parcels * stop / total_columns)) - first_id if stop < total_columns else parcels - first_id
+        first_id += write_cadastral_gml(path, corner_x, corner_y, range(start, stop),
+                                        limit=min(limit, rows * (stop - start)), first_id=first_id)
+        paths[council] = path
+    bounds = (corner_x.min(), corner_y.min(), corner_x.max(), corner_y.max())
+    return paths, bounds
+
+
+# --- Brownfield register ---
+
+def brownfield_register(sites, seed=0, county_bounds=None, county_share=0.05):
+    """A synthetic national brownfield register. `county_share` of the sites
+    are placed inside county_bounds (minx, miny, maxx, maxy in EPSG:27700),
+    with addresses that mostly name a known sector; the rest are spread over
+    England."""
+    rng = np.random.default_rng([seed, sites])
+    lon = rng.uniform(NATIONAL_BOUNDS[0], NATIONAL_BOUNDS[2], sites)
+    lat = rng.uniform(NATIONAL_BOUNDS[1], NATIONAL_BOUNDS[3], sites)
+    in_county = np.zeros(sites, dtype=bool)
+    if county_bounds is not None:
+        in_county = rng.random(sites) < county_share
+        minx, miny, maxx, maxy = county_bounds
+        lon[in_county], lat[in_county] = osgb_to_lonlat(rng.uniform(minx, maxx, in_county.sum()),
+                                                        rng.uniform(miny, maxy, in_county.sum()))
+    point = 'POINT(' + _as_str(lon) + ' ' + _as_str(lat) + ')'
+    point[rng.random(sites) < 0.01] = ''  # some entries have no point
+
+    sector_names = [s.title() for s in CAMBRIDGESHIRE_SECTORS]
+    other_names = [p.title() for p in OTHER_PLACES] + ['Leeds', 'Bristol', 'Norwich', 'Reading']
+    place = np.where(in_county & (rng.random(sites) < 0.8), _choice(rng, sector_names, sites),
+                     _choice(rng, other_names, sites))
+    address = (_as_str(rng.integers(1, 200, sites)) + ' ' + _as_str(_choice(rng, [s.title() for s in STREETS], sites))
+               + ', ' + _as_str(place))
+
+    # A few references repeat, as when a site is re-entered with a new date.
+    reference = np.arange(sites)
+    repeats = rng.random(sites) < 0.02
+    reference[repeats] = rng.integers(0, sites, repeats.sum())
+    permission_days = np.datetime64('2008-01-01') + rng.integers(0, 16 * 365, sites).astype('timedelta64[D]')
+    permission_date = _as_str(np.datetime_as_string(permission_days, unit='D'))
+    permission_date[rng.random(sites) < 0.05] = ''
+    dwellings = rng.integers(0, 200, sites)
+    return pd.DataFrame({
+        'dataset': 'brownfield-land',
+        'end-date': '',
+        'entity': 1_700_000 + np.arange(sites),
+        'entry-date': '2024-01-01',
+        'start-date': '',
+        'name': '',
+        'organisation': _choice(rng, ['local-authority:CAB', 'local-authority:ECA', 'local-authority:SCA',
+                                      'local-authority:LDS', 'local-authority:BST'], sites),
+        'point': point,
+        'reference': 'BF' + pd.Series(reference).map('{:07d}'.format),
+        'site-address': address,
+        'hectares': rng.uniform(0.05, 10, sites).round(2),
+        'ownership-status': _choice(rng, ['owned by a public authority', 'not owned by a public authority',
+                                          'mixed ownership'], sites),
+        'planning-permission-status': _choice(rng, ['permissioned', 'not permissioned', 'pending decision'],
+                                              sites, p=[5, 3, 2]),
+        'planning-permission-type': _choice(rng, ['full planning permission', 'outline planning permission', ''],
+                                            sites),
+        'planning-permission-date': permission_date,
+        'maximum-net-dwellings': dwellings,
+        'minimum-net-dwellings': (dwellings * 0.8).astype(int),
+        'deliverable': _choice(rng, ['yes', ''], sites),
+        'notes': '',
+    }, columns=BROWNFIELD_COLUMNS)
+
+
+# --- Everything at once ---
+
+def generate_inputs(raw_dir, price_rows, sites, parcels, seed=0, force=False):
+    """Write a full set of synthetic raw inputs under `raw_dir` (laid out like
+    1_data_acquisition/raw_data). Skipped when the files there were already
+    generated with the same settings. Returns {'price_paid', 'brownfield',
+    'gml': {council: path}}."""
+    land_registry_dir = os.path.join(raw_dir, 'land_registry_data')
+    paths = {
+        'price_paid': os.path.join(land_registry_dir, 'pp-complete.csv'),
+        'brownfield': os.path.join(raw_dir, 'brownfield_registers', 'uk_brownfield_sites.csv'),
+        'gml': {c: os.path.join(land_registry_dir, c, 'Land_Registry_Cadastral_Parcels.gml') for c in COUNCILS},
+    }
+    settings = {'version': GENERATOR_VERSION, 'price_rows': price_rows, 'sites': sites,
+                'parcels': parcels, 'seed': seed}
+    manifest_path = os.path.join(raw_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path) as f:
+            if not force and json.load(f) == settings:
+                return paths
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    _, county_bounds = write_council_parcels(land_registry_dir, parcels, seed=seed)
+    os.makedirs(os.path.dirname(paths['brownfield']), exist_ok=True)
+    brownfield_register(sites, seed=seed, county_bounds=county_bounds).to_csv(paths['brownfield'], index=False)
+    write_price_paid(paths['price_paid'], price_rows, seed=seed)
+    with open(manifest_path, 'w') as f:
+        json.dump(settings, f, indent=2)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write synthetic pipeline inputs in the real layouts.")
+    parser.add_argument('--out', required=True, help="Directory to use in place of 1_data_acquisition/raw_data.")
+    parser.add_argument('--price-rows', type=int, default=1_000_000)
+    parser.add_argument('--sites', type=int, default=40_000)
+    parser.add_argument('--parcels', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_inputs(args.out, args.price_rows, args.sites, args.parcels, seed=args.seed, force=True)
+    print(f"Synthetic inputs written to {args.out}")
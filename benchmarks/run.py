@@ -0,0 +1,319 @@
+# benchmarks/run.py
+# PURPOSE: Time the pipeline's heavy stages on synthetic inputs of a fixed
+# size, and keep a history so a slowdown shows up as a regression rather than
+# a hunch. Each stage runs in a fresh child process, so its peak memory is its
+# own; wall time, CPU time, peak RSS and rows/sec are appended to a JSON
+# history and compared with the previous run of the same scale on the same
+# host.
+#
+# USAGE: python -m benchmarks.run [--scale smoke|1m|10m|30m] [--stages NAME ...]
+#                                 [--price-rows N] [--sites N] [--parcels N] [--seed N]
+#                                 [--tolerance 0.2] [--fail-on-regression] [--regenerate]
+#   Run from the repository root. Inputs are generated once per scale under
+#   1_data_acquisition/cache/benchmarks/ and reused while the settings match.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import generators
+from nebula import instrument
+
+DEFAULT_DATA_DIR = os.path.join('1_data_acquisition', 'cache', 'benchmarks')
+DEFAULT_HISTORY_PATH = os.path.join('benchmarks', 'history.json')
+DEFAULT_TOLERANCE = 0.2
+# Differences smaller than these are noise, whatever the percentage.
+MIN_WALL_DELTA_S = 0.5
+MIN_RSS_DELTA_MB = 50
+
+SCALES = {
+    'smoke': {'price_rows': 100_000, 'sites': 5_000, 'parcels': 5_000},
+    '1m': {'price_rows': 1_000_000, 'sites': 20_000, 'parcels': 50_000},
+    '10m': {'price_rows': 10_000_000, 'sites': 50_000, 'parcels': 200_000},
+    '30m': {'price_rows': 30_000_000, 'sites': 100_000, 'parcels': 500_000},
+}
+
+
+# --- Stages. Each takes the run's paths and returns (rows_in, rows_out). ---
+
+def _price_filter(paths):
+    from nebula import price_paid
+    stats = price_paid.stream_filter(paths['price_paid'], paths['prices'])
+    return stats['rows_read'], stats['rows_kept']
+
+
+def _gml_parse(paths):
+    from nebula import parcel_store
+    shutil.rmtree(paths['parcels'], ignore_errors=True)
+    status = parcel_store.refresh(paths['gml'], store_dir=paths['parcels'])
+    failed = {council: result.error or result.status for council, result in status.items()
+              if result.status != 'parsed'}
+    if failed:
+        raise RuntimeError(f"GML parse failed: {failed}")
+    rows = 0
+    for council in paths['gml']:
+        with open(os.path.join(paths['parcels'], f'{council}.json')) as f:
+            rows += json.load(f)['parcels']
+    return rows, rows
+
+
+def _boundary_dissolve(paths):
+    import pandas as pd
+    import shapely
+    from nebula import boundary, parcel_store
+    parcels = pd.concat([parcel_store.load(c, paths['parcels']) for c in paths['gml']], ignore_index=True)
+    county = boundary.build_boundary(parcels.geometry.values)
+    boundary.save_boundary(county, 'benchmark', cache_dir=paths['boundary'])
+    return len(parcels), int(shapely.get_num_geometries(county))
+
+
+def _sjoin(paths):
+    import pandas as pd
+    from nebula import boundary, wkt
+    sites = pd.read_csv(paths['brownfield'], usecols=['point', 'reference', 'site-address', 'maximum-net-dwellings'],
+                        low_memory=False)
+    sites['longitude'], sites['latitude'] = wkt.parse_points(sites['point'])
+    x, y = wkt.lonlat_to_osgb(sites['longitude'].to_numpy(), sites['latitude'].to_numpy())
+    index = boundary.BoundaryIndex(boundary.load_boundary(cache_dir=paths['boundary']))
+    inside = sites[index.contains_xy(x, y)]
+    inside.drop(columns='point').to_parquet(paths['sites'], index=False)
+    return len(sites), len(inside)
+
+
+def _sector_parsing(paths):
+    import pandas as pd
+    from nebula.sectors import SectorMatcher
+    # Every address in the register, not just the county's, so the matcher
+    # is measured at the size of the national file.
+    addresses = pd.read_csv(paths['brownfield'], usecols=['site-address'])['site-address']
+    matched = SectorMatcher().match(addresses)
+    return len(addresses), int(matched.notna().sum())
+
+
+def _aggregation(paths):
+    from nebula import cube, store
+    if os.path.exists(paths['store']):
+        os.remove(paths['store'])
+    engine = store.connect(paths['store'])
+    rows = store.load_prices(engine, paths['prices'])
+    rolled = cube.rollup(engine, by=('Year', 'PropertyType'))
+    return rows, len(rolled)
+
+
+def _map_rendering(paths):
+    import folium
+    import pandas as pd
+    from nebula import binning, maps
+    sites = pd.read_parquet(paths['sites'])
+    dwellings = pd.to_numeric(sites['maximum-net-dwellings'], errors='coerce').fillna(0)
+    site_map = folium.Map(location=[sites['latitude'].mean(), sites['longitude'].mean()], zoom_start=10)
+    cells = binning.site_hotspots(sites['longitude'].to_numpy(), sites['latitude'].to_numpy(),
+                                  dwellings.to_numpy(), binning.DEFAULT_RESOLUTIONS[0])
+    maps.grid_density_layer(cells, binning.DEFAULT_RESOLUTIONS[0], 'Total_Dwellings_Approved',
+                            name='Hex Density').add_to(site_map)
+    maps.site_cluster_layer(sites['latitude'], sites['longitude'], sites['site-address'], dwellings).add_to(site_map)
+    folium.LayerControl().add_to(site_map)
+    site_map.save(paths['map'])
+    return len(sites), len(cells)
+
+
+# name -> (function, stages whose outputs it reads)
+STAGES = {
+    'price_filter': (_price_filter, []),
+    'gml_parse': (_gml_parse, []),
+    'boundary_dissolve': (_boundary_dissolve, ['gml_parse']),
+    'sjoin': (_sjoin, ['boundary_dissolve']),
+    'sector_parsing': (_sector_parsing, []),
+    'aggregation': (_aggregation, ['price_filter']),
+    'map_rendering': (_map_rendering, ['sjoin']),
+}
+
+
+def with_dependencies(names):
+    """The stages named plus everything they read from, in STAGES order."""
+    wanted = set()
+
+    def add(name):
+        if name not in wanted:
+            wanted.add(name)
+            for dependency in STAGES[name][1]:
+                add(dependency)
+    for name in names:
+        add(name)
+    return [name for name in STAGES if name in wanted]
+
+
+def run_paths(data_dir):
+    raw_dir = os.path.join(data_dir, 'raw_data')
+    work_dir = os.path.join(data_dir, 'work')
+    land_registry_dir = os.path.join(raw_dir, 'land_registry_data')
+    return {
+        'raw': raw_dir,
+        'price_paid': os.path.join(land_registry_dir, 'pp-complete.csv'),
+        'brownfield': os.path.join(raw_dir, 'brownfield_registers', 'uk_brownfield_sites.csv'),
+        'gml': {c: os.path.join(land_registry_dir, c, 'Land_Registry_Cadastral_Parcels.gml')
+                for c in generators.COUNCILS},
+        'prices': os.path.join(work_dir, 'prices.csv'),
+        'parcels': os.path.join(work_dir, 'parcels'),
+        'boundary': os.path.join(work_dir, 'boundary'),
+        'sites': os.path.join(work_dir, 'sites.parquet'),
+        'store': os.path.join(work_dir, 'store.sqlite'),
+        'map': os.path.join(work_dir, 'map.html'),
+    }
+
+
+def measure(name, paths):
+    """Run one stage in this process and return its metrics. Meant to be
+    called in a fresh child, so the peak RSS belongs to the stage (plus the
+    interpreter it started from) and any worker pools it used."""
+    os.makedirs(os.path.dirname(paths['prices']), exist_ok=True)
+    with instrument.span(name, report=False) as step:
+        step.rows_in, step.rows_out = (int(rows) for rows in STAGES[name][0](paths))
+    metrics = step.metrics()
+    # Worker pools count towards the stage's memory.
+    children = metrics.pop('children_peak_rss_mb', None)
+    if children is not None and (metrics['peak_rss_mb'] is None or children > metrics['peak_rss_mb']):
+        metrics['peak_rss_mb'] = children
+    return {'status': 'ok', **metrics}
+
+
+def in_child(function, *args):
+    """Call function(*args) in a new child process and return its result."""
+    with ProcessPoolExecutor(1) as executor:
+        return executor.submit(function, *args).result()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+
+def previous_run(history, run):
+    """The latest earlier run with the same scale, sizes and host."""
+    for earlier in reversed(history):
+        if all(earlier.get(k) == run[k] for k in ('scale', 'params', 'host')):
+            return earlier
+    return None
+
+
+def find_regressions(run, previous, tolerance=DEFAULT_TOLERANCE):
+    """(stage, metric, before, after) for each wall time or peak RSS that grew
+    by more than `tolerance` (and by more than the noise floor) since the
+    previous run."""
+    regressions = []
+    if previous is None:
+        return regressions
+    for name, metrics in run['stages'].items():
+        before = previous['stages'].get(name)
+        if metrics['status'] != 'ok' or not before or before.get('status') != 'ok':
+            continue
+        for metric, floor in (('wall_s', MIN_WALL_DELTA_S), ('peak_rss_mb', MIN_RSS_DELTA_MB)):
+            old, new = before.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > floor:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def format_table(run, previous):
+    lines = [f"{'stage':<18}{'wall s':>9}{'cpu s':>9}{'peak MB':>9}{'rows in':>13}{'rows/sec':>13}{'vs prev':>9}"]
+    for name, m in run['stages'].items():
+        if m['status'] != 'ok':
+            lines.append(f"{name:<18}  {m['status']}")
+            continue
+        before = (previous or {}).get('stages', {}).get(name, {})
+        change = f"{m['wall_s'] / before['wall_s'] - 1:+.0%}" if before.get('wall_s') else ''
+        rss = f"{m['peak_rss_mb']:,.0f}" if m['peak_rss_mb'] is not None else 'n/a'
+        rate = f"{m['rows_per_sec']:,}" if m['rows_per_sec'] is not None else 'n/a'
+        lines.append(f"{name:<18}{m['wall_s']:>9.2f}{m['cpu_s']:>9.2f}{rss:>9}{m['rows_in']:>13,}{rate:>13}{change:>9}")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument('--scale', default='smoke', choices=list(SCALES),
+                        help="Preset input sizes; --price-rows/--sites/--parcels override them.")
+    parser.add_argument('--price-rows', type=int)
+    parser.add_argument('--sites', type=int)
+    parser.add_argument('--parcels', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES),
+                        help="Stages to time (default: all). Stages they read from are run too.")
+    parser.add_argument('--data-dir', help=f"Where inputs are generated (default: {DEFAULT_DATA_DIR}/<scale>).")
+    parser.add_argument('--history', default=DEFAULT_HISTORY_PATH)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative slowdown or memory growth that counts as a regression.")
+    parser.add_argument('--regenerate', action='store_true', help="Regenerate the inputs even if they exist.")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Exit with status 1 on a regression.")
+    args = parser.parse_args()
+
+    params = dict(SCALES[args.scale], seed=args.seed)
+    for key in ('price_rows', 'sites', 'parcels'):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    # Overridden sizes are not the preset any more, so they get their own history line.
+    scale = args.scale if params == dict(SCALES[args.scale], seed=args.seed) else 'custom'
+    paths = run_paths(args.data_dir or os.path.join(DEFAULT_DATA_DIR, scale if scale != 'custom' else
+                                                    '_'.join(str(params[k]) for k in ('price_rows', 'sites', 'parcels'))))
+
+    print(f"--- BENCHMARK ({scale}: {params['price_rows']:,} sales, {params['sites']:,} sites, "
+          f"{params['parcels']:,} parcels) ---")
+    started = time.perf_counter()
+    in_child(generators.generate_inputs, paths['raw'], params['price_rows'], params['sites'], params['parcels'],
+             params['seed'], args.regenerate)
+    print(f" -> Inputs ready in {paths['raw']} ({time.perf_counter() - started:.1f}s)")
+
+    run = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'scale': scale,
+        'params': params,
+        'stages': {},
+    }
+    for name in with_dependencies(args.stages or list(STAGES)):
+        print(f" -> {name}...", flush=True)
+        try:
+            run['stages'][name] = in_child(measure, name, paths)
+        except Exception as e:
+            run['stages'][name] = {'status': f'failed: {e}'}
+
+    history = load_history(args.history)
+    previous = previous_run(history, run)
+    history.append(run)
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=2)
+
+    print("\n" + format_table(run, previous))
+    regressions = find_regressions(run, previous, args.tolerance)
+    if previous is None:
+        print(f"\nNo earlier {scale} run on this host to compare with; saved as the baseline in {args.history}.")
+    for name, metric, old, new in regressions:
+        print(f"REGRESSION: {name} {metric} {old:,} -> {new:,} ({new / old - 1:+.0%}, "
+              f"tolerance {args.tolerance:.0%}) since {previous['commit'] or previous['timestamp']}")
+    if previous is not None and not regressions:
+        print(f"\nNo regressions against {previous['commit'] or previous['timestamp']}.")
+    failed = [name for name, m in run['stages'].items() if m['status'] != 'ok']
+    sys.exit(1 if failed or (regressions and args.fail_on_regression) else 0)
@@ -0,0 +1,3 @@
+# nebula/__init__.py
+# PURPOSE: Shared helpers used by the numbered pipeline scripts. The scripts
+# put the repository root on sys.path so they can import from here.
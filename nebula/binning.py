@@ -0,0 +1,137 @@
+# nebula/binning.py
+# PURPOSE: Assign points to hexagonal or square grid cells on British National
+# Grid (EPSG:27700, metres) and total them per cell with NumPy bincount, so
+# hotspot tables and density maps come from every located site or sale, at
+# whatever resolution is asked for, without needing a known village name.
+#
+# Hexagons are pointy-topped and addressed by axial coordinates (q, r); `size`
+# is the distance from a hexagon's centre to its corners. Square cells are
+# addressed by (column, row) and `size` is the side length.
+
+import numpy as np
+import pandas as pd
+
+from nebula.instrument import traced
+from nebula.wkt import lonlat_to_osgb, osgb_to_lonlat
+
+SQRT3 = np.sqrt(3.0)
+DEFAULT_RESOLUTIONS = (1_000, 5_000)
+
+
+def hex_cells(x, y, size):
+    """Axial (q, r) of the hexagon containing each point."""
+    x = np.asarray(x, dtype='float64') / size
+    y = np.asarray(y, dtype='float64') / size
+    q = (SQRT3 / 3) * x - y / 3
+    r = (2 / 3) * y
+    # Round in cube coordinates (q + r + s == 0) and fix the worst-rounded axis.
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype('int64'), rr.astype('int64')
+
+
+def hex_centers(q, r, size):
+    q = np.asarray(q, dtype='float64')
+    r = np.asarray(r, dtype='float64')
+    return size * SQRT3 * (q + r / 2), size * 1.5 * r
+
+
+def hex_corners(q, r, size):
+    """Corner coordinates of each hexagon, as two (n, 6) arrays."""
+    cx, cy = hex_centers(q, r, size)
+    angles = np.deg2rad(60 * np.arange(6) - 30)
+    return (cx[:, None] + size * np.cos(angles)[None, :],
+            cy[:, None] + size * np.sin(angles)[None, :])
+
+
+def square_cells(x, y, size):
+    """(column, row) of the square containing each point."""
+    return (np.floor(np.asarray(x, dtype='float64') / size).astype('int64'),
+            np.floor(np.asarray(y, dtype='float64') / size).astype('int64'))
+
+
+def square_centers(col, row, size):
+    return (np.asarray(col) + 0.5) * size, (np.asarray(row) + 0.5) * size
+
+
+def square_corners(col, row, size):
+    x0 = np.asarray(col, dtype='float64') * size
+    y0 = np.asarray(row, dtype='float64') * size
+    dx = np.array([0, size, size, 0])
+    dy = np.array([0, 0, size, size])
+    return x0[:, None] + dx[None, :], y0[:, None] + dy[None, :]
+
+
+def bin_points(x, y, size, weights=None, shape='hex'):
+    """Total points into grid cells.
+
+    `weights` maps output column names to arrays aligned with x/y (e.g.
+    {'Dwellings': ...}); NaN weights count as zero. Points with a missing
+    coordinate are ignored. Returns one row per occupied cell with the cell
+    address (CellA, CellB), its centre (Easting, Northing), Count and a sum
+    column per weight, sorted by cell address."""
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    located = ~(np.isnan(x) | np.isnan(y))
+    cells = hex_cells if shape == 'hex' else square_cells
+    centers = hex_centers if shape == 'hex' else square_centers
+    a, b = cells(x[located], y[located], size)
+
+    keys, inverse = np.unique(np.stack([a, b], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    n_cells = len(keys)
+    cx, cy = centers(keys[:, 0], keys[:, 1], size) if n_cells else (np.array([]), np.array([]))
+    out = pd.DataFrame({
+        'CellA': keys[:, 0], 'CellB': keys[:, 1],
+        'Easting': cx, 'Northing': cy,
+        'Count': np.bincount(inverse, minlength=n_cells),
+    })
+    for name, values in (weights or {}).items():
+        values = np.nan_to_num(np.asarray(values, dtype='float64')[located])
+        out[name] = np.bincount(inverse, weights=values, minlength=n_cells)
+    return out
+
+
+def bin_multi(x, y, sizes=DEFAULT_RESOLUTIONS, weights=None, shape='hex'):
+    """bin_points at several resolutions. Returns {size: DataFrame}."""
+    return {size: bin_points(x, y, size, weights=weights, shape=shape) for size in sizes}
+
+
+def _hotspot_table(cells, count_column, value_column, share_column):
+    """Name a bin_points result's count, add lon/lat cell centres and each
+    cell's share of the total value, and sort biggest first."""
+    cells = cells.rename(columns={'Count': count_column})
+    cells['Longitude'], cells['Latitude'] = osgb_to_lonlat(cells['Easting'], cells['Northing'])
+    total = cells[value_column].sum()
+    cells[share_column] = ((cells[value_column] / total) * 100).round(2) if total else 0.0
+    return cells.sort_values(value_column, ascending=False, kind='stable').reset_index(drop=True)
+
+
+@traced(rows_in=len, rows_out=len)
+def site_hotspots(lon, lat, dwellings, size, shape='hex'):
+    """Development hotspots by grid cell: projects and dwellings approved per
+    cell with each cell's share of all dwellings, biggest first. Cell centres
+    are given in lon/lat as well as easting/northing."""
+    x, y = lonlat_to_osgb(lon, lat)
+    cells = bin_points(x, y, size, weights={'Total_Dwellings_Approved': dwellings}, shape=shape)
+    return _hotspot_table(cells, 'Number_of_Projects', 'Total_Dwellings_Approved', '%_of_Total_Dwellings')
+
+
+@traced(rows_in=len, rows_out=len)
+def sale_hotspots(easting, northing, prices, size, shape='hex'):
+    """Market hotspots by grid cell: sales and total spend per cell with each
+    cell's share of all spend, biggest first. Sales are already on the
+    National Grid (their postcode centroids), so no projection is needed."""
+    cells = bin_points(easting, northing, size, weights={'Total_Spend': prices}, shape=shape)
+    return _hotspot_table(cells, 'Number_of_Sales', 'Total_Spend', '%_of_Total_Spend')
+
+
+def cell_polygons(cells, size, shape='hex'):
+    """Corner coordinates for each row of a bin_points result."""
+    corners = hex_corners if shape == 'hex' else square_corners
+    return corners(cells['CellA'].to_numpy(), cells['CellB'].to_numpy(), size)
@@ -0,0 +1,151 @@
+# nebula/boundary.py
+# PURPOSE: Build the custom Cambridgeshire boundary from cadastral parcels
+# and answer "is this point inside it?" quickly.
+#   - Parcels are dissolved tile by tile in a process pool, and the tile
+#     results are then unioned once more (a cascaded union).
+#   - The dissolved boundary is simplified and saved to disk with a
+#     fingerprint of the GML inputs, so it is only rebuilt when they change.
+#   - Point membership uses a bounding-box prefilter and an STRtree over
+#     small tiled pieces of the boundary.
+
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import shapely
+
+from nebula.instrument import span, traced
+
+DEFAULT_CACHE_DIR = os.path.join('1_data_acquisition', 'cache', 'boundary')
+BOUNDARY_CRS = 'EPSG:27700'
+# Tiles are in metres (EPSG:27700). Parcels are small, so 5 km tiles hold a
+# few thousand parcels each: big enough to be worth a process, small enough
+# that each union is cheap.
+DEFAULT_TILE_SIZE = 5_000
+# 1 m of simplification is invisible at county scale but removes most of the
+# vertices left over from the parcel edges.
+DEFAULT_SIMPLIFY_TOLERANCE = 1.0
+# Pieces of the boundary handed to the STRtree are clipped to this grid.
+INDEX_TILE_SIZE = 2_000
+
+
+def _union_tile(wkb_parts):
+    parts = shapely.from_wkb(wkb_parts)
+    return shapely.to_wkb(shapely.union_all(parts))
+
+
+@traced(rows_in=len)
+def dissolve(geometries, tile_size=DEFAULT_TILE_SIZE, workers=None):
+    """Union an array of polygons into one (multi)polygon.
+
+    Geometries are grouped by the grid tile their representative point falls
+    in, each tile is unioned in a worker process, and the per-tile results
+    are unioned together at the end. Geometries cross the process boundary
+    as WKB."""
+    geometries = np.asarray(geometries, dtype=object)
+    geometries = geometries[~shapely.is_missing(geometries) & ~shapely.is_empty(geometries)]
+    if len(geometries) == 0:
+        return shapely.Polygon()
+
+    points = shapely.point_on_surface(geometries)
+    tile_x = np.floor(shapely.get_x(points) / tile_size).astype(np.int64)
+    tile_y = np.floor(shapely.get_y(points) / tile_size).astype(np.int64)
+    _, tile_ids = np.unique(np.stack([tile_x, tile_y], axis=1), axis=0, return_inverse=True)
+    tile_ids = tile_ids.ravel()
+    order = np.argsort(tile_ids, kind='stable')
+    splits = np.flatnonzero(np.diff(tile_ids[order])) + 1
+    tiles = [shapely.to_wkb(geometries[idx]) for idx in np.split(order, splits)]
+
+    with span('boundary.union_tiles', rows_in=len(geometries), report=False) as step:
+        if workers == 1 or len(tiles) == 1:
+            tile_unions = [_union_tile(t) for t in tiles]
+        else:
+            with multiprocessing.Pool(workers) as pool:
+                tile_unions = pool.map(_union_tile, tiles)
+        step.rows_out = len(tile_unions)
+    with span('boundary.union_all', rows_in=len(tile_unions), report=False):
+        return shapely.union_all(shapely.from_wkb(tile_unions))
+
+
+def build_boundary(geometries, tile_size=DEFAULT_TILE_SIZE,
+                   tolerance=DEFAULT_SIMPLIFY_TOLERANCE, workers=None):
+    """Dissolve the parcels and simplify the result."""
+    boundary = dissolve(geometries, tile_size=tile_size, workers=workers)
+    if tolerance:
+        boundary = shapely.simplify(boundary, tolerance, preserve_topology=True)
+    return boundary
+
+
+def save_boundary(boundary, fingerprint, cache_dir=DEFAULT_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'boundary.wkb'), 'wb') as f:
+        f.write(shapely.to_wkb(boundary))
+    with open(os.path.join(cache_dir, 'boundary.json'), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'crs': BOUNDARY_CRS}, f, indent=2)
+
+
+def discard_boundary(cache_dir=DEFAULT_CACHE_DIR):
+    """Remove the cached boundary, e.g. when it no longer matches its inputs
+    and a complete replacement could not be built."""
+    for name in ('boundary.wkb', 'boundary.json'):
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+
+
+def load_boundary(fingerprint=None, cache_dir=DEFAULT_CACHE_DIR):
+    """The cached boundary if it was built from the same inputs, else None.
+    Without a fingerprint, whatever boundary was cached last is returned."""
+    try:
+        with open(os.path.join(cache_dir, 'boundary.json')) as f:
+            meta = json.load(f)
+        if fingerprint is not None and meta.get('fingerprint') != fingerprint:
+            return None
+        with open(os.path.join(cache_dir, 'boundary.wkb'), 'rb') as f:
+            return shapely.from_wkb(f.read())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class BoundaryIndex:
+    """Fast point-in-boundary tests against one large (multi)polygon.
+
+    The boundary is cut into small pieces on a grid and the pieces go into an
+    STRtree, so each point is only tested against the one or two pieces whose
+    box it falls in. Points exactly on the boundary line count as inside."""
+
+    def __init__(self, boundary, tile_size=INDEX_TILE_SIZE):
+        self.boundary = boundary
+        self.bounds = shapely.bounds(boundary)
+        self.pieces = self._tile(boundary, tile_size)
+        shapely.prepare(self.pieces)
+        self.tree = shapely.STRtree(self.pieces)
+
+    @staticmethod
+    def _tile(boundary, tile_size):
+        if shapely.is_empty(boundary):
+            return np.array([], dtype=object)
+        minx, miny, maxx, maxy = shapely.bounds(boundary)
+        xs = np.arange(np.floor(minx / tile_size) * tile_size, maxx, tile_size)
+        ys = np.arange(np.floor(miny / tile_size) * tile_size, maxy, tile_size)
+        gx, gy = np.meshgrid(xs, ys)
+        gx, gy = gx.ravel(), gy.ravel()
+        pieces = shapely.intersection(boundary, shapely.box(gx, gy, gx + tile_size, gy + tile_size))
+        return pieces[~shapely.is_empty(pieces)]
+
+    @traced(rows_in=len, rows_out=lambda inside: int(inside.sum()), arg=1)
+    def contains_xy(self, x, y):
+        """Boolean array: which of the points (x, y) lie inside the boundary."""
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        inside = np.zeros(len(x), dtype=bool)
+        minx, miny, maxx, maxy = self.bounds
+        candidates = np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+        if len(candidates) == 0 or len(self.pieces) == 0:
+            return inside
+        points = shapely.points(x[candidates], y[candidates])
+        point_idx, _ = self.tree.query(points, predicate='intersects')
+        inside[candidates[np.unique(point_idx)]] = True
+        return inside
@@ -0,0 +1,127 @@
+# nebula/cube.py
+# PURPOSE: A small, materialised aggregate "cube" of the Cambridgeshire price
+# data at the grain Year x Month x PostcodeDistrict x PropertyType, kept in the
+# analytical store next to the raw sales. Charts and reports roll it up
+# instead of rescanning every transaction.
+#
+# Each cell holds a sale count, the total spend and a mergeable quantile
+# sketch of prices. The sketch puts every price in a logarithmic bucket (each
+# bucket is ~1% wide), so sketches from different cells, or from a later
+# monthly file, combine by simply adding bucket counts, and any median read
+# back from it is within ~1% of the true value. Removing sales subtracts
+# them, which is what the monthly change/delete records need.
+
+import math
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from nebula.instrument import traced
+from nebula.price_paid import postcode_district
+
+CELL_KEYS = ['Year', 'Month', 'PostcodeDistrict', 'PropertyType']
+SKETCH_RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+
+_KEY_COLUMNS = "Year INTEGER NOT NULL, Month INTEGER NOT NULL, PostcodeDistrict TEXT NOT NULL, PropertyType TEXT NOT NULL"
+_KEY_LIST = ", ".join(CELL_KEYS)
+
+
+def bucket_of(prices):
+    """The sketch bucket of each price."""
+    prices = np.maximum(np.asarray(prices, dtype='float64'), 1.0)
+    return np.ceil(np.log(prices) / _LOG_GAMMA).astype('int64')
+
+
+def bucket_value(buckets):
+    """A representative price for each bucket, within the sketch's relative
+    accuracy of every price that falls in it."""
+    return 2 * np.power(GAMMA, np.asarray(buckets, dtype='float64')) / (GAMMA + 1)
+
+
+def create_tables(conn):
+    conn.exec_driver_sql(f"""
+        CREATE TABLE IF NOT EXISTS price_cube (
+            {_KEY_COLUMNS}, Count INTEGER NOT NULL, Sum INTEGER NOT NULL,
+            PRIMARY KEY ({_KEY_LIST}))""")
+    conn.exec_driver_sql(f"""
+        CREATE TABLE IF NOT EXISTS price_cube_sketch (
+            {_KEY_COLUMNS}, Bucket INTEGER NOT NULL, Count INTEGER NOT NULL,
+            PRIMARY KEY ({_KEY_LIST}, Bucket))""")
+
+
+def reset(conn):
+    conn.exec_driver_sql("DROP TABLE IF EXISTS price_cube")
+    conn.exec_driver_sql("DROP TABLE IF EXISTS price_cube_sketch")
+    create_tables(conn)
+
+
+def aggregate(df):
+    """Aggregate sales (Price, DateOfTransfer, Postcode, PropertyType) into
+    cube cells and sketch buckets. Returns (cells, sketch) DataFrames."""
+    dates = pd.to_datetime(df['DateOfTransfer'], errors='coerce')
+    keyed = pd.DataFrame({
+        'Year': dates.dt.year,
+        'Month': dates.dt.month,
+        'PostcodeDistrict': postcode_district(df['Postcode']),
+        'PropertyType': df['PropertyType'] if 'PropertyType' in df else 'U',
+        'Price': pd.to_numeric(df['Price'], errors='coerce'),
+    }).dropna()
+    keyed['Bucket'] = bucket_of(keyed['Price'].to_numpy())
+    cells = keyed.groupby(CELL_KEYS, sort=False).agg(Count=('Price', 'size'), Sum=('Price', 'sum')).reset_index()
+    sketch = keyed.groupby(CELL_KEYS + ['Bucket'], sort=False).size().rename('Count').reset_index()
+    for frame in (cells, sketch):
+        frame[['Year', 'Month']] = frame[['Year', 'Month']].astype('int64')
+    cells['Sum'] = cells['Sum'].astype('int64')
+    return cells, sketch
+
+
+def apply(conn, df, sign=1):
+    """Add (sign=1) or remove (sign=-1) a batch of sales from the cube.
+    Cells and buckets whose count drops to zero are deleted."""
+    create_tables(conn)
+    cells, sketch = aggregate(df)
+    if cells.empty:
+        return
+    cells[['Count', 'Sum']] *= sign
+    sketch['Count'] *= sign
+    conn.execute(text(f"""
+        INSERT INTO price_cube ({_KEY_LIST}, Count, Sum)
+        VALUES (:Year, :Month, :PostcodeDistrict, :PropertyType, :Count, :Sum)
+        ON CONFLICT ({_KEY_LIST}) DO UPDATE
+        SET Count = Count + excluded.Count, Sum = Sum + excluded.Sum"""),
+        cells.to_dict('records'))
+    conn.execute(text(f"""
+        INSERT INTO price_cube_sketch ({_KEY_LIST}, Bucket, Count)
+        VALUES (:Year, :Month, :PostcodeDistrict, :PropertyType, :Bucket, :Count)
+        ON CONFLICT ({_KEY_LIST}, Bucket) DO UPDATE SET Count = Count + excluded.Count"""),
+        sketch.to_dict('records'))
+    if sign < 0:
+        conn.exec_driver_sql("DELETE FROM price_cube WHERE Count <= 0")
+        conn.exec_driver_sql("DELETE FROM price_cube_sketch WHERE Count <= 0")
+
+
+@traced(rows_out=len)
+def rollup(engine, by=('Year',), where="1 = 1", **params):
+    """Roll the cube up to the `by` columns. Returns a DataFrame with Count,
+    Sum (total spend) and Median_Price (from the sketch) per group."""
+    by = list(by)
+    group = ", ".join(by)
+    with engine.connect() as conn:
+        cells = pd.read_sql_query(text(f"""
+            SELECT {group}, SUM(Count) AS Count, SUM(Sum) AS Sum
+            FROM price_cube WHERE {where} GROUP BY {group} ORDER BY {group}"""), conn, params=params)
+        sketch = pd.read_sql_query(text(f"""
+            SELECT {group}, Bucket, SUM(Count) AS Count
+            FROM price_cube_sketch WHERE {where} GROUP BY {group}, Bucket ORDER BY {group}, Bucket"""),
+            conn, params=params)
+    if cells.empty:
+        return cells.assign(Median_Price=pd.Series(dtype='float64'))
+    # The median is the first bucket whose running count reaches half the total.
+    sketch['Running'] = sketch.groupby(by)['Count'].cumsum()
+    sketch['Half'] = sketch.groupby(by)['Count'].transform('sum') / 2
+    medians = sketch[sketch['Running'] >= sketch['Half']].groupby(by, as_index=False).first()
+    medians['Median_Price'] = bucket_value(medians['Bucket'])
+    return cells.merge(medians[by + ['Median_Price']], on=by, how='left')
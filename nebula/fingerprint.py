@@ -0,0 +1,21 @@
+# nebula/fingerprint.py
+# PURPOSE: Cheap fingerprints of input files, used to decide whether a cached
+# artifact was built from the inputs we have now.
+
+import hashlib
+import json
+import os
+
+
+def files_fingerprint(paths, **params):
+    """A hash of each input file's path, size and mtime plus any build
+    parameters. Missing files are recorded as missing."""
+    entries = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+            entries.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            entries.append([os.path.abspath(path), None, None])
+    payload = json.dumps({'inputs': entries, 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
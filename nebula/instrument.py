@@ -0,0 +1,296 @@
+# nebula/instrument.py
+# PURPOSE: Lightweight instrumentation shared by every stage. Steps are
+# wrapped in spans - a context manager, or a decorator for library functions -
+# that record wall and CPU time, peak memory and rows in/out, and progress
+# messages go through log() so they land in the same trace as the timings.
+# When a script exits, its spans and messages are written as a Chrome trace
+# (open it in chrome://tracing or https://ui.perfetto.dev); the pipeline
+# runner merges the traces of the stages it ran into reports/run_trace.json.
+#
+# On Linux a span's peak memory is its own: the kernel's resident-set
+# high-water mark is reset when a span opens (via /proc/self/clear_refs) and
+# folded into the spans around it. Elsewhere it is the process peak so far.
+#
+# Set NEBULA_PROFILE=cprofile (or pyinstrument, if it is installed) to profile
+# a whole script as well; the profile is saved next to its trace.
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+DEFAULT_TRACE_DIR = os.path.join('reports', 'traces')
+RUN_TRACE_PATH = os.path.join('reports', 'run_trace.json')
+# Set by the pipeline runner for each stage it starts.
+TRACE_ENV = 'NEBULA_TRACE'
+PROFILE_ENV = 'NEBULA_PROFILE'
+PROFILERS = ('cprofile', 'pyinstrument')
+
+_events = []
+_local = threading.local()
+_run = {}
+
+
+def peak_rss_mb(children=False):
+    """Peak resident set size of this process in MB, or None where the
+    `resource` module is not available (Windows). With children=True this is
+    the largest peak among finished child processes instead."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def memory_mb():
+    """(current, peak) resident set size of this process in MB. The peak is
+    since the last reset where that is supported; current is None where it
+    cannot be read."""
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]) / 1024, int(fields['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        return None, peak_rss_mb()
+
+
+def _reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _max(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _now_us():
+    return time.time_ns() // 1_000
+
+
+class Span:
+    """One timed step. rows_in, rows_out and attrs can be set while it is
+    open; the timings are filled in when it closes."""
+
+    def __init__(self, name, rows_in=None, attrs=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.attrs = dict(attrs or {})
+        self.wall = self.cpu = 0.0
+        self.peak_mb = None
+        self.children_peak_mb = None
+
+    def metrics(self):
+        metrics = {
+            'wall_s': round(self.wall, 3),
+            'cpu_s': round(self.cpu, 3),
+            'peak_rss_mb': round(self.peak_mb, 1) if self.peak_mb is not None else None,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rows_per_sec': round(self.rows_in / self.wall) if self.rows_in and self.wall > 0 else None,
+        }
+        if self.children_peak_mb is not None:
+            metrics['children_peak_rss_mb'] = round(self.children_peak_mb, 1)
+        return metrics
+
+    def summary(self):
+        parts = [f"{self.wall:.1f}s ({self.cpu:.1f}s CPU)"]
+        if self.peak_mb is not None:
+            parts.append(f"peak {self.peak_mb:,.0f} MB")
+        if self.rows_in is not None:
+            parts.append(f"{self.rows_in:,} rows in")
+        if self.rows_out is not None:
+            parts.append(f"{self.rows_out:,} rows out")
+        return f" -> {self.name}: " + ", ".join(parts)
+
+
+@contextmanager
+def span(name, rows_in=None, report=True, **attrs):
+    """Time the enclosed block as one span and yield it. With report=True a
+    one-line summary is printed when the block finishes."""
+    current = Span(name, rows_in, attrs)
+    stack = _stack()
+    rss, peak = memory_mb()
+    for outer in stack:
+        outer.peak_mb = _max(outer.peak_mb, peak)
+    # The high-water mark is process-wide, so only the main thread moves it.
+    if threading.current_thread() is threading.main_thread():
+        _reset_peak()
+    stack.append(current)
+    start_us, started, before = _now_us(), time.perf_counter(), os.times()
+    _counter(start_us, rss)
+    try:
+        yield current
+    except BaseException as e:
+        if not (isinstance(e, SystemExit) and e.code in (None, 0)):
+            current.attrs['error'] = f"exit {e.code}" if isinstance(e, SystemExit) else f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.wall = time.perf_counter() - started
+        after = os.times()
+        current.cpu = (after.user - before.user) + (after.system - before.system) \
+            + (after.children_user - before.children_user) + (after.children_system - before.children_system)
+        rss, peak = memory_mb()
+        current.peak_mb = _max(current.peak_mb, peak)
+        if after.children_user + after.children_system > before.children_user + before.children_system:
+            current.children_peak_mb = peak_rss_mb(children=True)
+        stack.pop()
+        if stack:
+            stack[-1].peak_mb = _max(stack[-1].peak_mb, current.peak_mb)
+        end_us = _now_us()
+        _events.append({'name': current.name, 'cat': 'span', 'ph': 'X', 'ts': start_us, 'dur': end_us - start_us,
+                        'pid': os.getpid(), 'tid': threading.get_ident(),
+                        'args': {**current.metrics(), **current.attrs}})
+        _counter(end_us, rss)
+    if report:
+        print(current.summary())
+
+
+def _counter(ts, rss):
+    if rss is not None:
+        _events.append({'name': 'RSS MB', 'ph': 'C', 'ts': ts, 'pid': os.getpid(),
+                        'args': {'rss': round(rss, 1)}})
+
+
+def traced(name=None, rows_in=None, rows_out=None, arg=0):
+    """Decorator form of span() for library functions. rows_in (e.g. len) is
+    called with the positional argument at index `arg` (1 for the first
+    argument of a method) and rows_out with the result. These spans go to the
+    trace only, not the console."""
+    def decorate(function):
+        label = name or f"{function.__module__.rsplit('.', 1)[-1]}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            rows = rows_in(args[arg]) if rows_in and len(args) > arg else None
+            with span(label, rows_in=rows, report=False) as current:
+                result = function(*args, **kwargs)
+                if rows_out:
+                    current.rows_out = rows_out(result)
+                return result
+        return wrapper
+    return decorate
+
+
+def log(message=""):
+    """Print a progress message and record it in the trace."""
+    print(message)
+    text = message.strip()
+    if text:
+        _events.append({'name': text, 'cat': 'log', 'ph': 'i', 's': 't', 'ts': _now_us(),
+                        'pid': os.getpid(), 'tid': threading.get_ident()})
+
+
+# --- Whole-script runs ---
+
+def start(stage):
+    """Trace the rest of this script as `stage`: everything after this call
+    runs inside one span, the profiler named in NEBULA_PROFILE is started,
+    and the trace (and profile) are written when the interpreter exits. The
+    trace goes to NEBULA_TRACE if set, else reports/traces/<stage>.json."""
+    if _run:
+        return
+    _run['stage'] = stage
+    _run['path'] = os.environ.get(TRACE_ENV) or os.path.join(DEFAULT_TRACE_DIR, f'{stage}.json')
+    _run['started_us'] = _now_us()
+    _run['profiler'] = _start_profiler(os.environ.get(PROFILE_ENV, '').strip().lower())
+    _run['root'] = ExitStack()
+    _run['root'].enter_context(span(stage, report=False))
+    atexit.register(_finish)
+
+
+def _start_profiler(kind):
+    if not kind:
+        return None
+    if kind not in PROFILERS:
+        print(f" -> WARNING: Unknown {PROFILE_ENV} value {kind!r}; expected one of {', '.join(PROFILERS)}.")
+        return None
+    if kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print(" -> WARNING: pyinstrument is not installed; running without a profile.")
+            return None
+        profiler = Profiler()
+        profiler.start()
+        return kind, profiler
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return kind, profiler
+
+
+def _finish():
+    _run['root'].close()
+    base = os.path.splitext(_run['path'])[0]
+    os.makedirs(os.path.dirname(os.path.abspath(_run['path'])), exist_ok=True)
+    if _run['profiler'] is not None:
+        kind, profiler = _run['profiler']
+        if kind == 'cprofile':
+            profiler.disable()
+            profile_path = base + '.prof'
+            profiler.dump_stats(profile_path)
+        else:
+            profiler.stop()
+            profile_path = base + '.html'
+            with open(profile_path, 'w') as f:
+                f.write(profiler.output_html())
+        print(f" -> Profile saved to {profile_path}")
+    write_trace(_run['path'], _run['stage'], _events, started_us=_run['started_us'])
+
+
+def write_trace(path, stage, events, started_us=None):
+    """Write events as a Chrome trace file."""
+    trace = {
+        'traceEvents': [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': stage}}] + events,
+        'displayTimeUnit': 'ms',
+        'otherData': {'stage': stage, 'argv': sys.argv[1:], 'started_us': started_us},
+    }
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(trace, f)
+    os.replace(tmp, path)
+
+
+def merge_traces(stage_runs, path=RUN_TRACE_PATH):
+    """Combine the traces of one pipeline run into a single Chrome trace: a
+    'pipeline' track with a span per stage, and each stage's own trace on a
+    track of its own. stage_runs is Pipeline.runs. Traces left over from
+    earlier runs are ignored. Returns the number of stage traces merged."""
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 0, 'args': {'name': 'pipeline'}}]
+    merged = 0
+    for number, (name, run) in enumerate(stage_runs.items(), start=1):
+        events.append({'name': name, 'cat': 'stage', 'ph': 'X', 'ts': run['start_us'],
+                       'dur': round(run['seconds'] * 1_000_000), 'pid': 0, 'tid': number,
+                       'args': {'returncode': run['returncode']}})
+        try:
+            with open(run['trace']) as f:
+                trace = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if (trace.get('otherData', {}).get('started_us') or 0) < run['start_us']:
+            continue
+        for event in trace['traceEvents']:
+            events.append({**event, 'pid': number})
+        merged += 1
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return merged
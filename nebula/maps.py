@@ -0,0 +1,121 @@
+# nebula/maps.py
+# PURPOSE: Build folium map layers from column arrays rather than one Python
+# object (and one block of inline HTML/JS) per point.
+#
+# Point layers are emitted as a single compact JSON array inside a
+# FastMarkerCluster: the browser clusters the points by zoom level and only
+# creates a marker for what is on screen, and popups are built from the row
+# data when a marker is clicked. The page costs a few dozen bytes per point
+# instead of a few hundred, and loading it does not create one DOM element
+# per site.
+
+import numpy as np
+import folium
+from folium.plugins import FastMarkerCluster
+
+from nebula import binning
+from nebula.instrument import traced
+from nebula.wkt import osgb_to_lonlat
+
+# Six decimal places is ~10 cm, more than enough for a site marker.
+COORD_DECIMALS = 6
+
+# Runs in the browser once per point that is actually drawn. Text fields are
+# escaped before they go into the popup HTML.
+_SITE_MARKER_CALLBACK = """
+function (row) {
+    var escape = function (text) {
+        var div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    };
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 3, color: 'navy', fill: true, fillOpacity: 0.8
+    });
+    marker.bindPopup(function () {
+        return '<b>Address:</b> ' + escape(row[2]) + '<br><b>Dwellings:</b> ' + row[3];
+    });
+    return marker;
+}
+"""
+
+
+@traced(rows_in=len)
+def site_cluster_layer(lat, lon, addresses, dwellings, name='Individual Projects', show=False):
+    """A zoom-clustered layer of site markers with lazily built popups.
+
+    All arguments are equal-length array-likes; dwellings are shown as
+    whole numbers."""
+    lat = np.round(np.asarray(lat, dtype='float64'), COORD_DECIMALS)
+    lon = np.round(np.asarray(lon, dtype='float64'), COORD_DECIMALS)
+    addresses = np.asarray(addresses, dtype=object).astype(str)
+    dwellings = np.asarray(dwellings, dtype='float64').astype('int64')
+    data = list(zip(lat.tolist(), lon.tolist(), addresses.tolist(), dwellings.tolist()))
+    return FastMarkerCluster(data, callback=_SITE_MARKER_CALLBACK, name=name, show=show,
+                             options={'disableClusteringAtZoom': 15, 'chunkedLoading': True})
+
+
+# Light-to-dark classes for grid density layers (ColorBrewer YlOrRd).
+DENSITY_COLORS = ['#ffffb2', '#fecc5c', '#fd8d3c', '#f03b20', '#bd0026']
+
+
+@traced(rows_in=len)
+def grid_density_layer(cells, size, value_column, name, shape='hex', show=False):
+    """A GeoJSON layer of grid cells (a binning.bin_points result) shaded by
+    `value_column` in quantile classes, with the values in a tooltip."""
+    xs, ys = binning.cell_polygons(cells, size, shape)
+    lon, lat = osgb_to_lonlat(xs.ravel(), ys.ravel())
+    rings = np.round(np.stack([lon, lat], axis=-1).reshape(len(cells), -1, 2), COORD_DECIMALS)
+    rings = np.concatenate([rings, rings[:, :1]], axis=1)  # close each ring
+
+    values = cells[value_column].to_numpy(dtype='float64')
+    edges = np.unique(np.quantile(values, np.linspace(0, 1, len(DENSITY_COLORS) + 1)[1:-1])) if len(values) else []
+    classes = np.searchsorted(edges, values, side='right')
+    colors = np.array(DENSITY_COLORS)[np.minimum(classes, len(DENSITY_COLORS) - 1)]
+
+    tooltip_fields = [value_column] + [c for c in ('Number_of_Projects', 'Number_of_Sales', 'Count') if c in cells]
+    properties = cells[tooltip_fields].to_dict('records')
+    features = [
+        {'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+         'properties': {**props, 'color': color}}
+        for ring, props, color in zip(rings.tolist(), properties, colors.tolist())
+    ]
+    return folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        name=name, show=show,
+        style_function=lambda feature: {'fillColor': feature['properties']['color'], 'color': 'none',
+                                        'fillOpacity': 0.6},
+        tooltip=folium.GeoJsonTooltip(fields=tooltip_fields),
+    )
+
+
+def hotspot_color(total_dwellings):
+    total_dwellings = np.asarray(total_dwellings, dtype='float64')
+    return np.where(total_dwellings <= 10, 'green', np.where(total_dwellings <= 50, 'orange', 'red'))
+
+
+def hotspot_circle_layer(sectors, lat, lon, total_dwellings,
+                         name='Development Hotspots (by Sector)', show=True):
+    """One semi-transparent circle per sector, sized by dwellings approved.
+    Sectors without a location are left off the map."""
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+    total_dwellings = np.asarray(total_dwellings, dtype='float64')
+    radius_in_meters = np.sqrt(total_dwellings) * 100
+    colors = hotspot_color(total_dwellings)
+    located = ~(np.isnan(lat) | np.isnan(lon))
+
+    layer = folium.FeatureGroup(name=name, show=show)
+    for sector, y, x, radius, color, total in zip(
+            np.asarray(sectors)[located], lat[located], lon[located],
+            radius_in_meters[located], colors[located], total_dwellings[located]):
+        popup_text = f"<h3>{sector}</h3><b>Total Dwellings Approved:</b> {int(total)}"
+        folium.Circle(
+            location=[float(y), float(x)],
+            radius=float(radius),
+            color=str(color),
+            fill=True,
+            fill_opacity=0.5,  # Make circles semi-transparent
+            popup=folium.Popup(popup_text, max_width=300)
+        ).add_to(layer)
+    return layer
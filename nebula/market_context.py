@@ -0,0 +1,153 @@
+# nebula/market_context.py
+# PURPOSE: Give every brownfield site the state of the housing market around
+# it: how many homes sold within each radius over the last year, their median
+# price, and how that median moved against the year before.
+#
+# Sales from the latest window and the one before it are put in a KD-tree
+# (scipy cKDTree) on British National Grid metres. The sites get a tree too,
+# and one dual-tree pass finds every (site, sale) pair within the largest
+# radius, with its distance, so all radii come from the same pairs. Medians
+# are taken for all sites at once by sorting the pairs by site and price.
+# Sites are processed in batches sized by their pair counts, so a dense city
+# centre cannot blow up memory.
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from nebula import postcodes
+from nebula.instrument import traced
+
+DEFAULT_RADII = (500, 1_000, 2_000)
+DEFAULT_WINDOW_DAYS = 365
+# Upper bound on (site, sale) pairs held in memory at once.
+MAX_PAIRS_PER_BATCH = 20_000_000
+
+
+def context_columns(radii=DEFAULT_RADII):
+    columns = []
+    for radius in radii:
+        columns += [f'Sales_{radius}m', f'Median_Price_{radius}m', f'YoY_Price_Change_%_{radius}m']
+    return columns
+
+
+def sale_coordinates(sales, index_dir=postcodes.DEFAULT_INDEX_DIR):
+    """Easting/Northing of each sale: the columns saved by
+    `process_price_data.py --within-boundary` if present, otherwise a lookup
+    in the postcode index if one has been built. None if neither exists."""
+    if {'Easting', 'Northing'} <= set(sales.columns):
+        return sales['Easting'].to_numpy(dtype='float64'), sales['Northing'].to_numpy(dtype='float64')
+    try:
+        index = postcodes.PostcodeIndex(index_dir)
+    except FileNotFoundError:
+        return None
+    return index.lookup(sales['Postcode'])
+
+
+def group_medians(groups, values, n_groups):
+    """Median of `values` per group, for pairs already sorted by (group, value).
+    NaN for empty groups."""
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    has_values = counts > 0
+    lo = (starts + (counts - 1) // 2)[has_values]
+    hi = (starts + counts // 2)[has_values]
+    medians = np.full(n_groups, np.nan)
+    medians[has_values] = (values[lo] + values[hi]) / 2
+    return counts, medians
+
+
+class SaleIndex:
+    """A KD-tree over the located sales in the latest window (ending at
+    `end`, default the latest sale) and the window before it, answering
+    multi-radius market context queries for batches of sites."""
+
+    @traced(name='market_context.SaleIndex', rows_in=len, arg=1)
+    def __init__(self, x, y, price, date, end=None, window_days=DEFAULT_WINDOW_DAYS):
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        day = pd.to_datetime(pd.Series(date), errors='coerce').to_numpy('datetime64[D]')
+        located = ~(np.isnan(x) | np.isnan(y))
+        if end is None:
+            days = day[located & ~np.isnat(day)]
+            end = days.max() if len(days) else np.datetime64('NaT', 'D')
+        else:
+            end = np.datetime64(pd.Timestamp(end).date(), 'D')
+        window = np.timedelta64(window_days, 'D')
+        # 0 = the latest window, 1 = the window before.
+        period = np.where(day > end - window, 0, 1)
+        keep = located & (day > end - 2 * window) & (day <= end)
+
+        # Sales are held in price order, so sorting pairs by (site, sale)
+        # also sorts each site's sales by price.
+        price = np.asarray(price, dtype='float64')[keep]
+        order = np.argsort(price, kind='stable')
+        self.end = end
+        self.x = x[keep][order]
+        self.y = y[keep][order]
+        self.price = price[order]
+        self.period = period[keep][order]
+        self.tree = cKDTree(np.column_stack([self.x, self.y]))
+
+    def __len__(self):
+        return self.tree.n
+
+    def context(self, site_x, site_y, radii=DEFAULT_RADII, max_pairs=MAX_PAIRS_PER_BATCH):
+        """A DataFrame with one row per site (in input order) and, for each
+        radius: sales in the latest window, their median price, and the %
+        change of that median against the window before. Sites without a
+        location get NaN."""
+        site_x = np.asarray(site_x, dtype='float64')
+        site_y = np.asarray(site_y, dtype='float64')
+        out = pd.DataFrame(np.nan, index=np.arange(len(site_x)), columns=context_columns(radii))
+        located = np.flatnonzero(~(np.isnan(site_x) | np.isnan(site_y)))
+        if len(located) and len(self):
+            self._fill(out, located, np.column_stack([site_x[located], site_y[located]]), radii, max_pairs)
+        counts = [f'Sales_{radius}m' for radius in radii]
+        out[counts] = out[counts].astype('Int64')
+        return out
+
+    def _fill(self, out, located, points, radii, max_pairs):
+        max_radius = max(radii)
+        pair_counts = self.tree.query_ball_point(points, max_radius, return_length=True, workers=-1)
+        batch_ids = np.cumsum(pair_counts) // max(max_pairs, 1)
+        for batch in np.unique(batch_ids):
+            rows = np.flatnonzero(batch_ids == batch)
+            pairs = self.tree.sparse_distance_matrix(cKDTree(points[rows]), max_radius, output_type='ndarray')
+            # One sort of a combined integer key serves every radius and
+            # window (masking keeps the order); distances are cheaper to
+            # recompute than to carry through the sort.
+            key = np.sort(pairs['j'].astype(np.int64) * len(self) + pairs['i'])
+            site, sale = np.divmod(key, len(self))
+            distance = np.hypot(self.x[sale] - points[rows, 0][site], self.y[sale] - points[rows, 1][site])
+            price, period = self.price[sale], self.period[sale]
+
+            target = located[rows]
+            for radius in radii:
+                within = distance <= radius
+                current = within & (period == 0)
+                previous = within & (period == 1)
+                counts, medians = group_medians(site[current], price[current], len(rows))
+                _, previous_medians = group_medians(site[previous], price[previous], len(rows))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    change = ((medians / previous_medians - 1) * 100).round(1)
+                out.loc[target, f'Sales_{radius}m'] = counts
+                out.loc[target, f'Median_Price_{radius}m'] = medians
+                out.loc[target, f'YoY_Price_Change_%_{radius}m'] = change
+
+
+@traced(rows_in=len)
+def site_market_context(sites, sales, radii=DEFAULT_RADII, window_days=DEFAULT_WINDOW_DAYS):
+    """Market context columns for a frame of sites (with longitude/latitude)
+    from a frame of sales (Price, DateOfTransfer and Postcode or
+    Easting/Northing), aligned to the sites' index. None if the sales cannot
+    be located."""
+    from nebula.wkt import lonlat_to_osgb
+    coordinates = sale_coordinates(sales)
+    if coordinates is None:
+        return None
+    index = SaleIndex(*coordinates, sales['Price'], sales['DateOfTransfer'], window_days=window_days)
+    site_x, site_y = lonlat_to_osgb(sites['longitude'].to_numpy(), sites['latitude'].to_numpy())
+    context = index.context(site_x, site_y, radii=radii)
+    context.index = sites.index
+    return context
@@ -0,0 +1,102 @@
+# nebula/parcel_store.py
+# PURPOSE: A persisted store of each council's cadastral parcels as GeoParquet,
+# so the slow XML GML parse only happens when a council's file changes (or a
+# new council is added to gml_paths). Stale councils can be parsed in
+# parallel, one process per file.
+
+import json
+import multiprocessing
+import os
+from dataclasses import dataclass
+
+import geopandas as gpd
+
+from nebula.fingerprint import files_fingerprint
+from nebula.instrument import traced
+
+DEFAULT_STORE_DIR = os.path.join('1_data_acquisition', 'cache', 'parcels')
+PARCEL_CRS = 'EPSG:27700'
+
+
+@dataclass
+class IngestResult:
+    """How refresh() brought one council up to date: status is 'cached',
+    'parsed' or 'failed', and error holds the parse error when it failed."""
+    status: str
+    error: str = None
+
+    @property
+    def failed(self):
+        return self.status == 'failed'
+
+
+def _paths(council, store_dir):
+    return (os.path.join(store_dir, f'{council}.parquet'),
+            os.path.join(store_dir, f'{council}.json'))
+
+
+def is_fresh(council, gml_path, store_dir=DEFAULT_STORE_DIR):
+    """True if the store holds parcels parsed from this exact GML file."""
+    parquet_path, meta_path = _paths(council, store_dir)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return os.path.exists(parquet_path) and meta.get('fingerprint') == files_fingerprint([gml_path])
+
+
+def ingest(council, gml_path, store_dir=DEFAULT_STORE_DIR):
+    """Parse one council's GML and write it to the store. Returns the number
+    of parcels stored."""
+    os.makedirs(store_dir, exist_ok=True)
+    parquet_path, meta_path = _paths(council, store_dir)
+    gdf = gpd.read_file(gml_path)
+    if gdf.crs is not None:
+        gdf = gdf.to_crs(PARCEL_CRS)
+    else:
+        gdf = gdf.set_crs(PARCEL_CRS)
+    gdf.to_parquet(parquet_path, index=False)
+    # The metadata is written last, so a half-written parquet is never trusted.
+    with open(meta_path, 'w') as f:
+        json.dump({'council': council, 'source': os.path.abspath(gml_path),
+                   'fingerprint': files_fingerprint([gml_path]), 'parcels': len(gdf)}, f, indent=2)
+    return len(gdf)
+
+
+def _ingest_task(task):
+    council, gml_path, store_dir = task
+    try:
+        return council, ingest(council, gml_path, store_dir), None
+    except Exception as e:
+        return council, None, str(e)
+
+
+@traced(rows_in=len)
+def refresh(gml_paths, store_dir=DEFAULT_STORE_DIR, workers=None):
+    """Reparse only the councils whose GML changed since they were stored.
+
+    Returns {council: IngestResult}, in the order of gml_paths."""
+    status = {}
+    stale = []
+    for council, path in gml_paths.items():
+        if is_fresh(council, path, store_dir):
+            status[council] = IngestResult('cached')
+        else:
+            stale.append((council, path, store_dir))
+
+    if len(stale) > 1 and workers != 1:
+        with multiprocessing.Pool(min(workers or len(stale), len(stale))) as pool:
+            results = pool.map(_ingest_task, stale)
+    else:
+        results = [_ingest_task(task) for task in stale]
+
+    for council, _, error in results:
+        status[council] = IngestResult('parsed') if error is None else IngestResult('failed', error)
+    return {council: status[council] for council in gml_paths}
+
+
+@traced(rows_out=len)
+def load(council, store_dir=DEFAULT_STORE_DIR):
+    parquet_path, _ = _paths(council, store_dir)
+    return gpd.read_parquet(parquet_path)
@@ -0,0 +1,218 @@
+# nebula/pipeline.py
+# PURPOSE: A small DAG runner for the numbered pipeline scripts. Each stage
+# declares the files it reads and writes; a stage depends on whichever stages
+# produce its inputs. We fingerprint a stage's script, the shared code it
+# imports, its parameters and the content of its inputs, and skip it when
+# nothing changed since the last successful run and its outputs are still the
+# ones it wrote. That check is made only once the stage's upstream stages have
+# finished, so a stage whose upstream reran but wrote identical files is still
+# skipped. Stages whose dependencies are satisfied run in parallel, each as its
+# own Python process, so one stage's memory is returned when it ends. With a
+# trace_dir, each stage is told where to write its trace (see
+# nebula/instrument.py) and the runs are kept in Pipeline.runs for merging.
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from nebula import instrument
+
+DEFAULT_STATE_PATH = os.path.join('1_data_acquisition', 'cache', 'pipeline_state.json')
+_HASH_BLOCK = 8 * 1024 * 1024
+
+
+@dataclass
+class Stage:
+    name: str
+    script: str
+    inputs: list
+    outputs: list
+    args: list = field(default_factory=list)
+    # Source files the script imports (e.g. nebula/*.py), hashed like the script.
+    code: list = field(default_factory=list)
+
+
+class ContentHasher:
+    """SHA-256 of file contents, remembered per (size, mtime) so a large
+    unchanged input such as pp-complete.csv is only read once."""
+
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+
+    def __call__(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = os.path.abspath(path)
+        cached = self.known.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+                digest.update(block)
+        self.known[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, stages, state_path=DEFAULT_STATE_PATH, python=sys.executable, trace_dir=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.python = python
+        self.trace_dir = trace_dir
+        # {stage: {'start_us', 'seconds', 'returncode', 'trace'}} for the stages run by run().
+        self.runs = {}
+        self.state = self._load_state()
+        self.hasher = ContentHasher(self.state.get('hashes'))
+        producers = {os.path.normpath(out): stage.name for stage in stages for out in stage.outputs}
+        self.deps = {
+            stage.name: sorted({producers[os.path.normpath(i)] for i in stage.inputs
+                                if os.path.normpath(i) in producers} - {stage.name})
+            for stage in stages
+        }
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_state(self):
+        self.state['hashes'] = self.hasher.known
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.state_path)
+
+    def stage_key(self, stage):
+        """Fingerprint of everything that determines a stage's outputs."""
+        payload = {
+            'script': self.hasher(stage.script),
+            'code': {os.path.normpath(p): self.hasher(p) for p in stage.code},
+            'args': stage.args,
+            'inputs': {os.path.normpath(p): self.hasher(p) for p in stage.inputs},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def is_up_to_date(self, stage):
+        record = self.state.get('stages', {}).get(stage.name)
+        if not record or record.get('key') != self.stage_key(stage):
+            return False
+        return all(self.hasher(out) is not None and self.hasher(out) == record['outputs'].get(os.path.normpath(out))
+                   for out in stage.outputs)
+
+    def _run_stage(self, stage):
+        env = None
+        if self.trace_dir:
+            env = {**os.environ, instrument.TRACE_ENV: os.path.join(self.trace_dir, f'{stage.name}.json')}
+        start_us = time.time_ns() // 1_000
+        started = time.perf_counter()
+        proc = subprocess.run([self.python, stage.script, *stage.args],
+                              capture_output=True, text=True, env=env)
+        seconds = time.perf_counter() - started
+        self.runs[stage.name] = {'start_us': start_us, 'seconds': seconds, 'returncode': proc.returncode,
+                                 'trace': env[instrument.TRACE_ENV] if env else None}
+        return proc, seconds
+
+    def order(self, targets=None):
+        """Stage names in dependency order, limited to `targets` and what they need."""
+        wanted = set()
+        pending = list(targets or self.stages)
+        while pending:
+            name = pending.pop()
+            if name not in wanted:
+                wanted.add(name)
+                pending.extend(self.deps[name])
+        ordered, done = [], set()
+        while len(ordered) < len(wanted):
+            ready = sorted(n for n in wanted - done if set(self.deps[n]) <= done)
+            if not ready:
+                raise ValueError("The pipeline stages contain a dependency cycle.")
+            ordered.extend(ready)
+            done.update(ready)
+        return ordered
+
+    def run(self, targets=None, force=False, jobs=None, dry_run=False, log=print):
+        """Run the stages needed for `targets` (default: all). Returns
+        {stage: 'skipped' | 'ran' | 'failed' | 'blocked' | 'would run' | 'may run'}."""
+        names = self.order(targets)
+        if dry_run:
+            return self._dry_run(names, force, log)
+
+        results = {}
+        remaining = list(names)
+        running = {}
+        with ThreadPoolExecutor(max_workers=jobs or len(names) or 1) as pool:
+            while remaining or running:
+                # In dependency order, so a stage skipped here frees the ones after it.
+                for name in list(remaining):
+                    dep_states = [results.get(d) for d in self.deps[name]]
+                    if any(s in ('failed', 'blocked') for s in dep_states):
+                        results[name] = 'blocked'
+                        remaining.remove(name)
+                        log(f"[{name}] not run because an upstream stage failed.")
+                    elif all(s in ('skipped', 'ran') for s in dep_states):
+                        remaining.remove(name)
+                        # Decided now rather than up front: the inputs are
+                        # re-hashed, so an upstream rerun that wrote the same
+                        # files does not make this stage run.
+                        if not force and self.is_up_to_date(self.stages[name]):
+                            results[name] = 'skipped'
+                            log(f"[{name}] up to date, skipping.")
+                        else:
+                            log(f"[{name}] running {self.stages[name].script} ...")
+                            running[pool.submit(self._run_stage, self.stages[name])] = name
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    proc, seconds = future.result()
+                    self._report(name, proc, seconds, log)
+                    results[name] = 'ran' if proc.returncode == 0 else 'failed'
+                    if proc.returncode == 0:
+                        self._record(self.stages[name])
+        self._save_state()
+        return results
+
+    def _dry_run(self, names, force, log):
+        """What run() would do. A stage that is up to date but reads from a
+        stage that would run 'may run': that depends on what the upstream
+        stage writes."""
+        results = {}
+        for name in names:
+            upstream = [d for d in self.deps[name] if results.get(d) in ('would run', 'may run')]
+            if force or not self.is_up_to_date(self.stages[name]):
+                results[name] = 'would run'
+                log(f"[{name}] would run: {self.stages[name].script}")
+            elif upstream:
+                results[name] = 'may run'
+                log(f"[{name}] may run, depending on the outputs of {', '.join(upstream)}.")
+            else:
+                results[name] = 'skipped'
+                log(f"[{name}] up to date, skipping.")
+        return results
+
+    def _record(self, stage):
+        self.state.setdefault('stages', {})[stage.name] = {
+            'key': self.stage_key(stage),
+            'outputs': {os.path.normpath(out): self.hasher(out) for out in stage.outputs},
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        self._save_state()
+
+    @staticmethod
+    def _report(name, proc, seconds, log):
+        for line in (proc.stdout + proc.stderr).splitlines():
+            log(f"[{name}] {line}")
+        status = "finished" if proc.returncode == 0 else f"FAILED (exit code {proc.returncode})"
+        log(f"[{name}] {status} in {seconds:.1f}s.")
@@ -0,0 +1,241 @@
+# nebula/postcodes.py
+# PURPOSE: Turn postcodes into British National Grid coordinates offline, in
+# bulk, so Price Paid sales can be tested against the Cambridgeshire boundary
+# and joined spatially with the brownfield sites.
+#
+# A local postcode centroid file (ONSPD, or a Code-Point Open CSV/folder of
+# CSVs) is converted once into three NumPy arrays on disk: sorted integer
+# postcode keys and the matching eastings/northings. Lookups memory-map those
+# arrays and binary-search them with np.searchsorted, so only the pages that
+# are touched get read and a batch of postcodes is resolved without a
+# Python-level loop.
+#
+# Keys are the 7-character ONS "pcd7" form of a postcode (outward code padded
+# to four characters, then the inward code: 'CB1 2AB' -> 'CB1 2AB',
+# 'CB24 8AB' -> 'CB248AB'), read as a base-37 number.
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from nebula.fingerprint import files_fingerprint
+from nebula.instrument import traced
+
+DEFAULT_SOURCE_PATH = os.path.join('1_data_acquisition', 'raw_data', 'postcodes', 'ONSPD.csv')
+DEFAULT_INDEX_DIR = os.path.join('1_data_acquisition', 'cache', 'postcodes')
+# Bump this when the index layout changes so old indexes are rebuilt.
+INDEX_VERSION = 1
+
+PCD7_LENGTH = 7
+MISSING_KEY = -1
+_ALPHABET = b' 0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_CHAR_CODES = np.full(256, -1, dtype=np.int64)
+_CHAR_CODES[np.frombuffer(_ALPHABET, dtype=np.uint8)] = np.arange(len(_ALPHABET))
+_PLACE_VALUES = len(_ALPHABET) ** np.arange(PCD7_LENGTH - 1, -1, -1, dtype=np.int64)
+
+# ONSPD has a header row; Code-Point Open data files do not.
+ONSPD_COLUMNS = {'postcode': ('pcds', 'pcd', 'pcd7', 'pcd8'), 'easting': 'oseast1m', 'northing': 'osnrth1m'}
+CODE_POINT_COLUMNS = {'postcode': 0, 'easting': 2, 'northing': 3}
+
+
+def encode(postcodes):
+    """int64 keys for an array of postcodes (any case and spacing);
+    MISSING_KEY where a value cannot be a postcode."""
+    if isinstance(postcodes, pd.Series):
+        postcodes = pa.array(postcodes, type=pa.string(), from_pandas=True)
+    elif not isinstance(postcodes, (pa.Array, pa.ChunkedArray)):
+        postcodes = pa.array(postcodes, type=pa.string())
+    compact = pc.replace_substring(pc.ascii_upper(postcodes), ' ', '')
+    if isinstance(compact, pa.ChunkedArray):
+        compact = compact.combine_chunks()
+    valid = pc.is_valid(compact).to_numpy(zero_copy_only=False)
+    compact = pc.fill_null(compact, '')
+    _, offsets_buf, data_buf = compact.buffers()
+    if data_buf is None or data_buf.size == 0:
+        return np.full(len(compact), MISSING_KEY, dtype=np.int64)
+
+    # Gather the pcd7 characters of every value straight from the Arrow
+    # buffers: the outward code from the front, padded with spaces to four
+    # characters, then the three-character inward code from the back.
+    offsets = np.frombuffer(offsets_buf, dtype=np.int32)[compact.offset:compact.offset + len(compact) + 1]
+    start, length = offsets[:-1], np.diff(offsets)
+    data = np.frombuffer(data_buf, dtype=np.uint8)
+    valid &= (length >= 5) & (length <= PCD7_LENGTH)
+    outward_length = length - 3
+    inward_start = start + outward_length - (PCD7_LENGTH - 3)
+    keys = np.zeros(len(compact), dtype=np.int64)
+    for position in range(PCD7_LENGTH):
+        if position < PCD7_LENGTH - 3:
+            byte = data[np.minimum(start + position, len(data) - 1)]
+            code = np.where(position < outward_length, _CHAR_CODES[byte], 0)
+        else:
+            code = _CHAR_CODES[data[np.clip(inward_start + position, 0, len(data) - 1)]]
+        valid &= code >= 0
+        keys = keys * len(_ALPHABET) + code
+    keys[~valid] = MISSING_KEY
+    return keys
+
+
+def _source_files(source_path):
+    if os.path.isdir(source_path):
+        return sorted(glob.glob(os.path.join(source_path, '**', '*.csv'), recursive=True))
+    return [source_path]
+
+
+def _read_source_file(path, chunksize):
+    """Yield (postcode, easting, northing) frames from one ONSPD or
+    Code-Point Open file."""
+    with open(path, encoding='utf-8-sig') as f:
+        header = [name.strip().strip('"').lower() for name in f.readline().split(',')]
+    if ONSPD_COLUMNS['easting'] in header:
+        postcode_col = next(c for c in ONSPD_COLUMNS['postcode'] if c in header)
+        names = [postcode_col, ONSPD_COLUMNS['easting'], ONSPD_COLUMNS['northing']]
+        reader = pd.read_csv(path, usecols=names, dtype=str, chunksize=chunksize, encoding='utf-8-sig')
+    else:
+        names = [CODE_POINT_COLUMNS[c] for c in ('postcode', 'easting', 'northing')]
+        reader = pd.read_csv(path, header=None, usecols=names, dtype=str, chunksize=chunksize)
+    for chunk in reader:
+        yield chunk[names].set_axis(['postcode', 'easting', 'northing'], axis=1)
+
+
+@traced(rows_out=lambda manifest: manifest['postcodes'])
+def build_index(source_path=DEFAULT_SOURCE_PATH, index_dir=DEFAULT_INDEX_DIR, chunksize=1_000_000):
+    """Convert a postcode centroid file (or a folder of them) into the sorted
+    on-disk index. Postcodes without a grid reference are left out. Returns
+    the manifest."""
+    started = time.perf_counter()
+    keys, eastings, northings = [], [], []
+    for path in _source_files(source_path):
+        for chunk in _read_source_file(path, chunksize):
+            easting = pd.to_numeric(chunk['easting'], errors='coerce').to_numpy(dtype='float64')
+            northing = pd.to_numeric(chunk['northing'], errors='coerce').to_numpy(dtype='float64')
+            key = encode(chunk['postcode'])
+            # ONSPD leaves the grid reference blank, and Code-Point Open
+            # gives 0,0, for postcodes that have no location.
+            located = (key != MISSING_KEY) & ~np.isnan(easting) & ~np.isnan(northing) \
+                & ((easting > 0) | (northing > 0))
+            keys.append(key[located])
+            eastings.append(easting[located])
+            northings.append(northing[located])
+
+    key = np.concatenate(keys) if keys else np.array([], dtype=np.int64)
+    easting = np.concatenate(eastings) if eastings else np.array([], dtype='float64')
+    northing = np.concatenate(northings) if northings else np.array([], dtype='float64')
+    # Sort by key; where a postcode appears twice, the last record wins.
+    order = np.argsort(key, kind='stable')
+    key, easting, northing = key[order], easting[order], northing[order]
+    last = np.append(key[1:] != key[:-1], True) if len(key) else np.array([], dtype=bool)
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, 'keys.npy'), key[last])
+    np.save(os.path.join(index_dir, 'easting.npy'), easting[last].round().astype(np.int32))
+    np.save(os.path.join(index_dir, 'northing.npy'), northing[last].round().astype(np.int32))
+    manifest = {
+        'fingerprint': source_fingerprint(source_path),
+        'postcodes': int(last.sum()),
+        'built_seconds': round(time.perf_counter() - started, 1),
+    }
+    with open(os.path.join(index_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def source_fingerprint(source_path):
+    return files_fingerprint(_source_files(source_path), version=INDEX_VERSION)
+
+
+def index_is_fresh(source_path=DEFAULT_SOURCE_PATH, index_dir=DEFAULT_INDEX_DIR):
+    try:
+        with open(os.path.join(index_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return manifest.get('fingerprint') == source_fingerprint(source_path)
+
+
+class PostcodeIndex:
+    """Vectorised postcode -> (easting, northing) lookups against an index
+    written by build_index. The arrays are memory-mapped, not loaded."""
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR):
+        self.keys = np.load(os.path.join(index_dir, 'keys.npy'), mmap_mode='r')
+        self.easting = np.load(os.path.join(index_dir, 'easting.npy'), mmap_mode='r')
+        self.northing = np.load(os.path.join(index_dir, 'northing.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def positions(self, postcodes):
+        """Row of each postcode in the index, or -1 if it is not there."""
+        keys = encode(postcodes)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        # Searching in key order walks the index forwards instead of jumping
+        # around it, which is several times faster on large batches.
+        order = np.argsort(keys)
+        pos = np.empty(len(keys), dtype=np.int64)
+        pos[order] = np.searchsorted(self.keys, keys[order])
+        pos = np.minimum(pos, len(self.keys) - 1)
+        found = (keys != MISSING_KEY) & (self.keys[pos] == keys)
+        return np.where(found, pos, -1)
+
+    @traced(rows_in=len, arg=1)
+    def lookup(self, postcodes):
+        """Two float64 arrays (easting, northing) in metres; NaN where the
+        postcode is unknown or malformed."""
+        pos = self.positions(postcodes)
+        found = pos >= 0
+        easting = np.full(len(pos), np.nan)
+        northing = np.full(len(pos), np.nan)
+        easting[found] = self.easting[pos[found]]
+        northing[found] = self.northing[pos[found]]
+        return easting, northing
+
+
+def ensure_index(source_path=DEFAULT_SOURCE_PATH, index_dir=DEFAULT_INDEX_DIR, rebuild=False):
+    """Open the index, (re)building it first if the source file changed."""
+    if rebuild or not index_is_fresh(source_path, index_dir):
+        build_index(source_path, index_dir)
+    return PostcodeIndex(index_dir)
+
+
+@traced(rows_in=len, rows_out=len)
+def locate_sales(df, index, boundary_index=None):
+    """Add Easting/Northing columns from each sale's postcode centroid. With a
+    boundary_index (nebula.boundary.BoundaryIndex), only the sales whose
+    postcode lies inside the boundary are kept; unknown postcodes are dropped
+    because they cannot be tested."""
+    easting, northing = index.lookup(df['Postcode'])
+    df = df.assign(Easting=easting, Northing=northing)
+    if boundary_index is not None:
+        df = df[boundary_index.contains_xy(easting, northing)]
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the postcode index and time a bulk lookup.")
+    parser.add_argument('--source', default=DEFAULT_SOURCE_PATH,
+                        help="ONSPD CSV, or a Code-Point Open CSV or folder of CSVs.")
+    parser.add_argument('--rows', type=int, default=5_000_000, help="Postcodes to look up in the benchmark.")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    index = ensure_index(args.source, rebuild=True)
+    print(f"Indexed {len(index):,} postcodes in {time.perf_counter() - started:.1f}s.")
+    rng = np.random.default_rng(0)
+    sample = rng.choice(np.asarray(index.keys), args.rows)
+    digits = (sample[:, None] // _PLACE_VALUES) % len(_ALPHABET)
+    queries = np.frombuffer(np.frombuffer(_ALPHABET, dtype=np.uint8)[digits].tobytes(), dtype=f'S{PCD7_LENGTH}')
+    queries = pd.Series(queries.astype(str))
+    started = time.perf_counter()
+    easting, _ = index.lookup(queries)
+    seconds = time.perf_counter() - started
+    print(f"Looked up {args.rows:,} postcodes in {seconds:.3f}s ({args.rows / seconds:,.0f}/sec), "
+          f"{np.isnan(easting).mean():.1%} unmatched.")
@@ -0,0 +1,194 @@
+# nebula/price_cache.py
+# PURPOSE: A one-time conversion of the national Price Paid CSV into a typed,
+# columnar Parquet dataset partitioned by year and postcode area, so later runs
+# only read the partitions that can match the Cambridgeshire filters instead
+# of reparsing millions of text rows.
+
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from nebula import price_paid
+from nebula.instrument import traced
+
+DEFAULT_CACHE_DIR = os.path.join('1_data_acquisition', 'cache', 'price_paid_parquet')
+MANIFEST_NAME = '_manifest.json'
+# Bump this when the cached layout changes so old caches are rebuilt.
+CACHE_VERSION = 1
+
+CACHE_COLUMNS = [
+    'TransactionID', 'Price', 'DateOfTransfer', 'Postcode', 'PropertyType',
+    'OldNew', 'Duration', 'TownCity', 'District', 'County'
+]
+CACHE_SCHEMA = pa.schema([
+    ('RowNumber', pa.int64()),  # position in the source file, to restore its order
+    ('TransactionID', pa.string()),
+    ('Price', pa.int32()),
+    ('DateOfTransfer', pa.date32()),
+    ('Postcode', pa.string()),
+    ('PropertyType', pa.string()),
+    ('OldNew', pa.string()),
+    ('Duration', pa.string()),
+    ('TownCity', pa.string()),
+    ('District', pa.string()),
+    ('County', pa.string()),
+    ('Year', pa.int16()),
+    ('PostcodeArea', pa.string()),
+])
+PARTITION_COLUMNS = ['Year', 'PostcodeArea']
+# Rows with no postcode still need a partition value.
+NO_POSTCODE_AREA = 'NONE'
+
+
+def source_fingerprint(source_path):
+    """The size and mtime of the source file; the cache is stale if either changes."""
+    stat = os.stat(source_path)
+    return {'source': os.path.abspath(source_path), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns, 'version': CACHE_VERSION}
+
+
+def load_manifest(cache_dir=DEFAULT_CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def cache_is_fresh(source_path, cache_dir=DEFAULT_CACHE_DIR):
+    manifest = load_manifest(cache_dir)
+    if manifest is None or not os.path.exists(source_path):
+        return False
+    return manifest.get('fingerprint') == source_fingerprint(source_path)
+
+
+def postcode_area(postcodes):
+    """The leading letters of each postcode ('CB24 8AB' -> 'CB')."""
+    area = postcodes.str.extract(r'^([A-Z]{1,2})', expand=False)
+    return area.fillna(NO_POSTCODE_AREA)
+
+
+def _to_record_batch(chunk, first_row):
+    dates = pd.to_datetime(chunk['DateOfTransfer'], errors='coerce')
+    frame = pd.DataFrame({
+        'RowNumber': pd.RangeIndex(first_row, first_row + len(chunk)),
+        **{col: chunk[col].to_numpy() for col in CACHE_COLUMNS if col != 'DateOfTransfer'},
+        'DateOfTransfer': dates.dt.date,
+        'Year': dates.dt.year.astype('Int16'),
+        'PostcodeArea': postcode_area(chunk['Postcode']).to_numpy(),
+    })
+    # safe=True makes the int32 price cast fail loudly rather than wrap.
+    return pa.RecordBatch.from_pandas(frame, schema=CACHE_SCHEMA, preserve_index=False)
+
+
+@traced(rows_out=lambda manifest: manifest['rows'])
+def build_cache(source_path, cache_dir=DEFAULT_CACHE_DIR,
+                chunksize=price_paid.DEFAULT_CHUNKSIZE, progress=None):
+    """Convert the Price Paid CSV into the partitioned Parquet cache.
+
+    The CSV is streamed in chunks, and the new cache is written next to the
+    old one and swapped in only once it is complete. Returns the manifest."""
+    started = time.perf_counter()
+    fingerprint = source_fingerprint(source_path)
+    building_dir = cache_dir.rstrip(os.sep) + '.building'
+    shutil.rmtree(building_dir, ignore_errors=True)
+    counts = {'rows': 0}
+
+    def batches():
+        reader = pd.read_csv(source_path, header=None, names=price_paid.PRICE_PAID_COLUMNS,
+                             usecols=CACHE_COLUMNS, dtype=str, chunksize=chunksize)
+        for chunk in reader:
+            chunk['Price'] = pd.to_numeric(chunk['Price'])
+            yield _to_record_batch(chunk, counts['rows'])
+            counts['rows'] += len(chunk)
+            if progress is not None:
+                progress(counts['rows'])
+
+    ds.write_dataset(
+        batches(), building_dir, schema=CACHE_SCHEMA, format='parquet',
+        partitioning=PARTITION_COLUMNS, partitioning_flavor='hive',
+        # Keep every partition open so each one ends up as a single file.
+        max_open_files=8192, max_rows_per_group=1_000_000,
+    )
+
+    manifest = {
+        'fingerprint': fingerprint,
+        'rows': counts['rows'],
+        'built_seconds': round(time.perf_counter() - started, 2),
+    }
+    with open(os.path.join(building_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(os.path.abspath(cache_dir)), exist_ok=True)
+    os.replace(building_dir, cache_dir)
+    return manifest
+
+
+def ensure_cache(source_path, cache_dir=DEFAULT_CACHE_DIR, **kwargs):
+    """Build the cache unless it already matches the source file. Returns
+    True if a (re)build happened."""
+    if cache_is_fresh(source_path, cache_dir):
+        return False
+    build_cache(source_path, cache_dir, **kwargs)
+    return True
+
+
+def open_dataset(cache_dir=DEFAULT_CACHE_DIR):
+    return ds.dataset(cache_dir, format='parquet', partitioning='hive',
+                      schema=CACHE_SCHEMA, exclude_invalid_files=False,
+                      ignore_prefixes=['_', '.'])
+
+
+@traced(rows_out=len)
+def read_filtered(cache_dir=DEFAULT_CACHE_DIR, prefixes=price_paid.TARGET_POSTCODE_PREFIXES,
+                  start=price_paid.START_DATE, end=price_paid.END_DATE, columns=None):
+    """Read the cached sales matching the postcode prefixes and date window.
+
+    Partitions are pruned on Year and PostcodeArea before any data is read;
+    the exact postcode and date tests then run on what is left. Rows come
+    back in source-file order with DateOfTransfer as datetime64, so the
+    result matches price_paid.filter_price_frame on the CSV."""
+    columns = list(columns or price_paid.USE_COLS)
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    dataset = open_dataset(cache_dir)
+
+    areas = _matching_areas(dataset, prefixes)
+    postcode = pc.field('Postcode')
+    prefix_test = None
+    for prefix in prefixes:
+        test = pc.starts_with(postcode, prefix)
+        prefix_test = test if prefix_test is None else (prefix_test | test)
+    row_filter = (
+        (pc.field('Year') >= start.year) & (pc.field('Year') <= end.year)
+        & pc.field('PostcodeArea').isin(areas)
+        & (pc.field('DateOfTransfer') >= pa.scalar(start.date()))
+        & (pc.field('DateOfTransfer') <= pa.scalar(end.date()))
+        & prefix_test
+    )
+
+    table = dataset.to_table(columns=columns + ['RowNumber'], filter=row_filter)
+    df = table.to_pandas().sort_values('RowNumber', kind='stable')
+    if 'DateOfTransfer' in df:
+        df['DateOfTransfer'] = pd.to_datetime(df['DateOfTransfer'])
+    if 'Price' in df:
+        df['Price'] = df['Price'].astype('int64')
+    return df.drop(columns='RowNumber').reset_index(drop=True)
+
+
+def _matching_areas(dataset, prefixes):
+    # A prefix can be shorter than an area ('C' -> CB, CM, ...) or longer
+    # ('CB2' -> CB), so test both directions against the areas on disk.
+    known = set()
+    for fragment in dataset.get_fragments():
+        expression = ds.get_partition_keys(fragment.partition_expression)
+        if 'PostcodeArea' in expression:
+            known.add(expression['PostcodeArea'])
+    return sorted(area for area in known
+                  if any(area.startswith(p) or p.startswith(area) for p in prefixes))
@@ -0,0 +1,122 @@
+# nebula/price_delta.py
+# PURPOSE: Apply a Land Registry monthly update file to the existing
+# Cambridgeshire price data instead of reprocessing pp-complete.csv.
+#
+# Monthly files use the Price Paid layout plus a Record_Status of
+#   A (add), C (change: the row replaces the earlier version) or D (delete),
+# keyed by TransactionID. The prices table and the aggregate cube in the
+# analytical store are updated through the TransactionID index, and the
+# changed sales are appended to the cleaned CSV's update log (see
+# nebula/price_updates.py) rather than rewriting the CSV, so the work is
+# proportional to the size of the delta. Once the log has grown past a
+# fraction of the data it is folded back into the CSV.
+#
+# Which files have been applied is recorded, by content hash, in the log's
+# manifest. Reprocessing pp-complete.csv discards the log, so a file applied
+# before a full reprocess is applied again afterwards.
+
+import os
+
+import pandas as pd
+from sqlalchemy import text
+
+from nebula import cube, price_paid, price_updates, store
+from nebula.instrument import traced
+
+DELTA_COLUMNS = price_paid.USE_COLS + ['Record_Status']
+# Fold the log into the CSV once it holds this fraction of the stored rows.
+COMPACT_FRACTION = 0.2
+
+
+def read_delta(path):
+    """Read a monthly update file. If a TransactionID appears more than once,
+    its last record wins."""
+    delta = price_paid.read_price_paid(path, columns=DELTA_COLUMNS)
+    delta['Record_Status'] = delta['Record_Status'].str.strip().str.upper()
+    return delta.drop_duplicates(subset='TransactionID', keep='last')
+
+
+def _fetch_existing(conn, transaction_ids):
+    conn.exec_driver_sql("DROP TABLE IF EXISTS temp.delta_ids")
+    conn.exec_driver_sql("CREATE TEMP TABLE delta_ids (TransactionID TEXT PRIMARY KEY)")
+    conn.execute(text("INSERT INTO delta_ids (TransactionID) VALUES (:id)"),
+                 [{'id': tid} for tid in transaction_ids])
+    return pd.read_sql_query(text(
+        "SELECT p.* FROM prices p JOIN delta_ids d ON p.TransactionID = d.TransactionID"), conn)
+
+
+@traced(rows_out=lambda result: result['added'] if result else None)
+def apply_delta(engine, delta_path, clean_csv_path, locate=None, compact_fraction=COMPACT_FRACTION):
+    """Apply one monthly update file. Returns a dict of counts, or None if
+    this exact file has already been applied.
+
+    `locate`, if given, is applied to the new sales after the usual filters
+    (e.g. to geocode them and keep only those inside the boundary). It must
+    be given exactly when the stored prices were located the same way
+    (store.prices_located); otherwise ValueError is raised. With
+    compact_fraction=None the log is never folded into the CSV here."""
+    # Bring the store in line with the CSV and its log first, in case either
+    # changed since the store was loaded.
+    store.load_prices(engine, clean_csv_path)
+    if (locate is not None) != store.prices_located(engine):
+        raise ValueError("The update must be filtered the way the stored prices were: with a locate "
+                         "function exactly when they carry Easting/Northing.")
+    digest = price_updates.file_digest(delta_path)
+    if digest in {entry['sha256'] for entry in price_updates.read_manifest(clean_csv_path)['applied']}:
+        return None
+
+    delta = read_delta(delta_path)
+    additions = price_paid.filter_price_frame(delta[delta['Record_Status'].isin(['A', 'C'])])
+    additions = additions[price_paid.USE_COLS]
+    if locate is not None:
+        additions = locate(additions)
+    header = pd.read_csv(clean_csv_path, nrows=0).columns
+
+    with engine.begin() as conn:
+        # Every record, whatever its status, supersedes the stored version.
+        existing = _fetch_existing(conn, delta['TransactionID'].dropna().unique().tolist())
+        if not existing.empty:
+            cube.apply(conn, existing, sign=-1)
+            conn.exec_driver_sql(
+                "DELETE FROM prices WHERE TransactionID IN (SELECT TransactionID FROM delta_ids)")
+        conn.exec_driver_sql("DROP TABLE temp.delta_ids")
+        store.append_prices(conn, additions)
+        cube.apply(conn, additions)
+        rows = conn.exec_driver_sql("SELECT COUNT(*) FROM prices").scalar()
+
+        # Log a tombstone for each stored sale the update removes, and the
+        # new version of each one it adds or changes. Records for sales we
+        # never held are left out.
+        removed = existing[~existing['TransactionID'].isin(additions['TransactionID'])]
+        changed = additions['TransactionID'].isin(existing['TransactionID'])
+        dates = pd.to_datetime(additions['DateOfTransfer']).dt.strftime('%Y-%m-%d')
+        records = pd.concat([
+            removed.reindex(columns=header).assign(Record_Status='D'),
+            additions.assign(DateOfTransfer=dates).reindex(columns=header)
+                     .assign(Record_Status=changed.map({True: 'C', False: 'A'})),
+        ], ignore_index=True)
+        price_updates.append(clean_csv_path, records, {
+            'sha256': digest,
+            'file': os.path.basename(delta_path),
+            'records': len(delta),
+        })
+        # The log now matches the store, so the next load can be skipped.
+        # If this transaction fails, the fingerprint no longer matches and
+        # the next load syncs the store from the CSV and log.
+        store.record_load(conn, 'prices', price_updates.fingerprint(clean_csv_path), rows)
+
+    log_rows = price_updates.read_manifest(clean_csv_path)['log_rows']
+    compacted = compact_fraction is not None and log_rows > compact_fraction * rows
+    if compacted:
+        price_updates.compact(clean_csv_path)
+        # Same rows, new files.
+        with engine.begin() as conn:
+            store.record_load(conn, 'prices', price_updates.fingerprint(clean_csv_path), rows)
+
+    return {
+        'records': len(delta),
+        'removed': len(existing),
+        'added': len(additions),
+        'rows': rows,
+        'compacted': compacted,
+    }
@@ -0,0 +1,177 @@
+# nebula/price_paid.py
+# PURPOSE: Reading and filtering the national Land Registry Price Paid file
+# (pp-complete.csv) down to Cambridgeshire sales, either in one go or as a
+# bounded-memory stream of chunks.
+
+import io
+import multiprocessing
+import os
+import time
+
+import pandas as pd
+
+from nebula.instrument import peak_rss_mb, traced
+
+# The national file has no header row, so we name the columns ourselves.
+PRICE_PAID_COLUMNS = [
+    'TransactionID', 'Price', 'DateOfTransfer', 'Postcode', 'PropertyType',
+    'OldNew', 'Duration', 'PAON', 'SAON', 'Street', 'Locality',
+    'TownCity', 'District', 'County', 'PPD_Category', 'Record_Status'
+]
+# We only load the columns we need to save memory.
+USE_COLS = ['TransactionID', 'Price', 'DateOfTransfer', 'Postcode', 'PropertyType']
+READ_DTYPES = {'TransactionID': 'object', 'Price': 'int64', 'DateOfTransfer': 'object',
+               'Postcode': 'object', 'PropertyType': 'object', 'Record_Status': 'object'}
+
+# Define the postcode prefixes for the Cambridgeshire area
+TARGET_POSTCODE_PREFIXES = ('CB', 'PE', 'SG')
+START_DATE = '2010-01-01'
+END_DATE = '2023-12-31'
+
+DEFAULT_CHUNKSIZE = 1_000_000
+# Byte ranges are kept small enough that a worker can hold one in memory,
+# and plentiful enough that the pool stays busy until the end of the file.
+DEFAULT_RANGE_BYTES = 64 * 1024 * 1024
+
+
+def read_price_paid(path, columns=USE_COLS, **kwargs):
+    """Read the headerless Price Paid CSV with our column names and dtypes."""
+    return pd.read_csv(path, header=None, names=PRICE_PAID_COLUMNS, usecols=columns,
+                       dtype={c: READ_DTYPES[c] for c in columns if c in READ_DTYPES}, **kwargs)
+
+
+@traced(rows_in=len, rows_out=len)
+def filter_price_frame(df, prefixes=TARGET_POSTCODE_PREFIXES,
+                       start=START_DATE, end=END_DATE):
+    """Keep the rows whose postcode starts with one of the prefixes and whose
+    transfer date falls inside [start, end]. The cheap string test runs first
+    so we only parse dates for the rows that survive it."""
+    df = df.dropna(subset=['Postcode'])
+    df = df[df['Postcode'].str.startswith(prefixes)].copy()
+    # Convert 'DateOfTransfer' to a proper datetime object for filtering
+    df['DateOfTransfer'] = pd.to_datetime(df['DateOfTransfer'], errors='coerce')
+    # Keep only the rows within our target date range
+    return df[(df['DateOfTransfer'] >= start) & (df['DateOfTransfer'] <= end)]
+
+
+def postcode_district(postcodes):
+    """The outward code of each postcode ('CB24 8AB' -> 'CB24')."""
+    return postcodes.str.split(' ', n=1).str[0]
+
+
+@traced(rows_in=len)
+def write_price_frame(df, path, append=False):
+    """Write filtered rows in the layout of the cleaned price CSV. Dates are
+    written as plain days so appended chunks always format the same way."""
+    df.to_csv(path, mode='a' if append else 'w', header=not append,
+              index=False, date_format='%Y-%m-%d')
+
+
+@traced(rows_out=lambda stats: stats['rows_kept'])
+def stream_filter(input_path, output_path, chunksize=DEFAULT_CHUNKSIZE, progress=None):
+    """Filter the Price Paid file chunk by chunk, appending matches to
+    output_path. Peak memory depends on chunksize, not on the file size.
+
+    `progress`, if given, is called after every chunk with the running stats.
+    Returns a dict with rows_read, rows_kept, seconds, rows_per_sec and
+    peak_rss_mb."""
+    stats = {'rows_read': 0, 'rows_kept': 0}
+    started = time.perf_counter()
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    wrote_header = False
+
+    for chunk in read_price_paid(input_path, chunksize=chunksize):
+        kept = filter_price_frame(chunk)
+        write_price_frame(kept, output_path, append=wrote_header)
+        wrote_header = True
+        stats['rows_read'] += len(chunk)
+        stats['rows_kept'] += len(kept)
+        if progress is not None:
+            progress(_finish_stats(stats, started))
+
+    if not wrote_header:
+        # An empty input still produces a CSV with the expected header.
+        write_price_frame(pd.DataFrame(columns=USE_COLS), output_path)
+    return _finish_stats(stats, started)
+
+
+def split_byte_ranges(path, range_bytes=DEFAULT_RANGE_BYTES):
+    """Split a file into (start, end) byte ranges that each begin at the start
+    of a line and end just after a newline (or at EOF). Price Paid rows never
+    contain embedded newlines, so a range always holds whole records."""
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            target = start + range_bytes
+            if target >= size:
+                end = size
+            else:
+                f.seek(target)
+                f.readline()  # move to the end of the line we landed in
+                end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _scan_range(task):
+    """Worker: parse and filter one byte range. Returns (rows_read, kept_df)."""
+    path, start, end = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    chunk = read_price_paid(io.BytesIO(data))
+    return len(chunk), filter_price_frame(chunk)
+
+
+@traced(rows_out=lambda stats: stats['rows_kept'])
+def parallel_filter(input_path, output_path, workers=None,
+                    range_bytes=DEFAULT_RANGE_BYTES, progress=None):
+    """Filter the Price Paid file with a process pool, one line-aligned byte
+    range per task. Results are written back in file order, so the output is
+    identical to stream_filter. Returns the same stats dict."""
+    workers = workers or os.cpu_count() or 1
+    stats = {'rows_read': 0, 'rows_kept': 0}
+    started = time.perf_counter()
+    tasks = [(input_path, start, end) for start, end in split_byte_ranges(input_path, range_bytes)]
+    wrote_header = False
+
+    with multiprocessing.Pool(workers) as pool:
+        # imap hands results back in submission order, which keeps the merge deterministic.
+        for rows_read, kept in pool.imap(_scan_range, tasks):
+            write_price_frame(kept, output_path, append=wrote_header)
+            wrote_header = True
+            stats['rows_read'] += rows_read
+            stats['rows_kept'] += len(kept)
+            if progress is not None:
+                progress(_finish_stats(stats, started))
+
+    if not wrote_header:
+        write_price_frame(pd.DataFrame(columns=USE_COLS), output_path)
+    return _finish_stats(stats, started)
+
+
+def _finish_stats(stats, started):
+    seconds = time.perf_counter() - started
+    return {
+        **stats,
+        'seconds': seconds,
+        'rows_per_sec': stats['rows_read'] / seconds if seconds > 0 else 0.0,
+        'peak_rss_mb': _max_or_none(peak_rss_mb(), peak_rss_mb(children=True)),
+    }
+
+
+def _max_or_none(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def format_stats(stats):
+    """One-line human summary of the stats dict returned by the scanners."""
+    rss = stats.get('peak_rss_mb')
+    rss_text = f"{rss:,.0f} MB" if rss is not None else "n/a"
+    return (f"{stats['rows_read']:,} rows read, {stats['rows_kept']:,} kept in "
+            f"{stats['seconds']:.1f}s ({stats['rows_per_sec']:,.0f} rows/sec, peak RSS {rss_text})")
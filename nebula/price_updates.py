@@ -0,0 +1,148 @@
+# nebula/price_updates.py
+# PURPOSE: The log of monthly updates applied to the cleaned price CSV (see
+# nebula/price_delta.py). The CSV written by a full processing mode is never
+# edited in place: each update appends its changed sales to a log next to it
+# (<name>.updates.csv, with a Record_Status of A, C or D, where D is a
+# tombstone), so applying one costs time in proportion to the update. Readers
+# take the CSV with the log laid over it: the last logged record of a sale
+# replaces the CSV's version, and a tombstone removes it. compact() folds the
+# log back into the CSV once it has grown.
+#
+# A manifest (<name>.updates.json) records which update files were applied,
+# by content hash, and how many bytes of the log they wrote. It is replaced
+# atomically after the log is appended to, so it is the commit point: a log
+# tail past the recorded length is from an interrupted update and is ignored,
+# then cut off by the next one.
+
+import hashlib
+import io
+import json
+import os
+
+import pandas as pd
+
+from nebula import price_paid
+from nebula.fingerprint import files_fingerprint
+from nebula.instrument import traced
+
+_HASH_BLOCK = 8 * 1024 * 1024
+
+
+def log_path(clean_csv_path):
+    root, ext = os.path.splitext(clean_csv_path)
+    return f'{root}.updates{ext}'
+
+
+def manifest_path(clean_csv_path):
+    root, _ = os.path.splitext(clean_csv_path)
+    return f'{root}.updates.json'
+
+
+def file_digest(path):
+    """SHA-256 of a file's content; every monthly download has the same name."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _empty_manifest():
+    return {'applied': [], 'log_bytes': 0, 'log_rows': 0}
+
+
+def read_manifest(clean_csv_path):
+    try:
+        with open(manifest_path(clean_csv_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return _empty_manifest()
+
+
+def _write_manifest(clean_csv_path, manifest):
+    path = manifest_path(clean_csv_path)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def fingerprint(clean_csv_path):
+    """Changes whenever the cleaned CSV is rewritten or an update is committed."""
+    return files_fingerprint([clean_csv_path, manifest_path(clean_csv_path)])
+
+
+def read_log(clean_csv_path):
+    """The committed log, keeping the last record of each sale, or None if
+    no update has been applied since the CSV was written."""
+    committed = read_manifest(clean_csv_path)['log_bytes']
+    if not committed:
+        return None
+    with open(log_path(clean_csv_path), 'rb') as f:
+        log = pd.read_csv(io.BytesIO(f.read(committed)))
+    return log.drop_duplicates(subset='TransactionID', keep='last')
+
+
+def read_clean_prices(clean_csv_path, chunksize=price_paid.DEFAULT_CHUNKSIZE):
+    """Yield the cleaned prices in chunks with the update log laid over them."""
+    log = read_log(clean_csv_path)
+    for chunk in pd.read_csv(clean_csv_path, chunksize=chunksize):
+        if log is not None:
+            chunk = chunk[~chunk['TransactionID'].isin(log['TransactionID'])]
+        yield chunk
+    if log is not None:
+        yield log[log['Record_Status'] != 'D'].drop(columns='Record_Status')
+
+
+@traced(rows_in=len, arg=1)
+def append(clean_csv_path, records, entry):
+    """Append one update's records (the CSV's columns plus Record_Status) to
+    the log and commit it, with `entry` (which must hold its 'sha256'), to
+    the manifest."""
+    manifest = read_manifest(clean_csv_path)
+    path = log_path(clean_csv_path)
+    with open(path, 'ab') as f:
+        # Drop anything an interrupted update wrote past the committed length.
+        f.truncate(manifest['log_bytes'])
+        records.to_csv(f, header=not manifest['log_bytes'], index=False)
+        f.flush()
+        os.fsync(f.fileno())
+        manifest['log_bytes'] = f.tell()
+    manifest['log_rows'] += len(records)
+    manifest['applied'].append(entry)
+    _write_manifest(clean_csv_path, manifest)
+
+
+@traced(rows_out=lambda rows: rows)
+def compact(clean_csv_path, chunksize=price_paid.DEFAULT_CHUNKSIZE):
+    """Fold the log into the cleaned CSV, via a temporary file swapped in with
+    os.replace, and start an empty log. The applied hashes are kept. Returns
+    the rows in the new CSV."""
+    tmp = clean_csv_path + '.tmp'
+    header = pd.read_csv(clean_csv_path, nrows=0)
+    price_paid.write_price_frame(header, tmp)
+    rows = 0
+    for chunk in read_clean_prices(clean_csv_path, chunksize):
+        price_paid.write_price_frame(chunk[header.columns], tmp, append=True)
+        rows += len(chunk)
+    os.replace(tmp, clean_csv_path)
+    # Until the manifest is rewritten, readers lay the old log over the
+    # compacted CSV, which gives the same rows.
+    manifest = read_manifest(clean_csv_path)
+    manifest['log_bytes'] = manifest['log_rows'] = 0
+    _write_manifest(clean_csv_path, manifest)
+    if os.path.exists(log_path(clean_csv_path)):
+        os.remove(log_path(clean_csv_path))
+    return rows
+
+
+def reset(clean_csv_path):
+    """Start an empty log for a freshly written CSV, forgetting every applied
+    update. Returns how many there were."""
+    applied = len(read_manifest(clean_csv_path)['applied'])
+    _write_manifest(clean_csv_path, _empty_manifest())
+    if os.path.exists(log_path(clean_csv_path)):
+        os.remove(log_path(clean_csv_path))
+    return applied
@@ -0,0 +1,147 @@
+# nebula/report_writer.py
+# PURPOSE: Write the market report as two things at once:
+#   - the human-facing Excel workbook, streamed row by row with xlsxwriter's
+#     constant_memory mode, so memory stays flat however long a sheet is;
+#   - a Parquet file per table (the "sidecar"), which later scripts read
+#     instead of parsing the workbook back with pd.read_excel.
+# Row-level sheets are capped at a row budget in the workbook; the sidecar
+# always holds every row. Both are written under temporary names and only
+# moved into place once the whole report has been written, so a failed run
+# leaves the previous report as it was.
+
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from nebula.instrument import traced
+
+DEFAULT_TABLES_DIR = os.path.join('reports', 'report_tables')
+MANIFEST_NAME = '_tables.json'
+# Rows of a row-level sheet written to the workbook; the rest are in the sidecar.
+DEFAULT_ROW_BUDGET = 100_000
+# Excel's own limit, header included.
+EXCEL_MAX_ROWS = 1_048_576
+EXCEL_MAX_SHEET_NAME = 31
+
+
+def table_filename(name):
+    """'Hex Hotspots 1km' -> 'hex_hotspots_1km.parquet'."""
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_') + '.parquet'
+
+
+def _cell_values(series):
+    """A column as a list of values xlsxwriter can write: missing values
+    become None (a blank cell) and NumPy scalars become Python ones."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        values = series.dt.tz_localize(None) if series.dt.tz is not None else series
+        return [None if pd.isna(v) else v.to_pydatetime() for v in values]
+    values = series.astype(object).where(series.notna(), None)
+    return [v.item() if isinstance(v, np.generic) else v for v in values]
+
+
+class ReportWriter:
+    """Collects report tables into one streamed workbook plus a folder of
+    Parquet tables. Use as a context manager:
+
+        with ReportWriter(xlsx_path) as report:
+            report.add('Development Growth by Year', growth_by_year, index=True)
+            report.add('Cleaned Data Used in Report', analysis_df, row_level=True)
+    """
+
+    def __init__(self, xlsx_path, tables_dir=DEFAULT_TABLES_DIR, row_budget=DEFAULT_ROW_BUDGET):
+        self.xlsx_path = xlsx_path
+        self.tables_dir = tables_dir
+        self.row_budget = row_budget
+        self.tables = {}
+        # Left behind by a run that was killed before it could clean up.
+        self.partial_dir = tables_dir + '.partial'
+        self.partial_xlsx = xlsx_path + '.partial'
+        shutil.rmtree(self.partial_dir, ignore_errors=True)
+        os.makedirs(self.partial_dir)
+        self.workbook = xlsxwriter.Workbook(self.partial_xlsx, {
+            'constant_memory': True,
+            'default_date_format': 'yyyy-mm-dd',
+        })
+        self.header_format = self.workbook.add_format({'bold': True, 'border': 1})
+        self.note_format = self.workbook.add_format({'italic': True})
+
+    @traced(rows_in=len, rows_out=lambda shown: shown, arg=2)
+    def add(self, name, df, index=False, row_level=False):
+        """Write one table as a sheet and as a Parquet file. With index=True
+        the index is written as leading column(s), as DataFrame.to_excel does.
+        Row-level tables are cut to the row budget in the workbook only.
+        Returns the number of rows written to the sheet."""
+        if len(name) > EXCEL_MAX_SHEET_NAME:
+            raise ValueError(f"Sheet name {name!r} is longer than Excel's {EXCEL_MAX_SHEET_NAME} characters.")
+        if index:
+            df = df.reset_index()
+        filename = table_filename(name)
+        df.to_parquet(os.path.join(self.partial_dir, filename), index=False)
+
+        limit = EXCEL_MAX_ROWS - 3  # leave room for the header and a note
+        if row_level:
+            limit = min(limit, self.row_budget)
+        sheet_rows = min(len(df), limit)
+
+        # constant_memory mode flushes each row as soon as the next one starts,
+        # so the sheet has to be written strictly top to bottom.
+        worksheet = self.workbook.add_worksheet(name)
+        worksheet.write_row(0, 0, [str(c) for c in df.columns], self.header_format)
+        head = df.iloc[:sheet_rows]
+        columns = [_cell_values(head[c]) for c in head.columns]
+        for row, values in enumerate(zip(*columns), start=1):
+            worksheet.write_row(row, 0, values)
+        if sheet_rows < len(df):
+            worksheet.write(sheet_rows + 2, 0,
+                            f"Showing the first {sheet_rows:,} of {len(df):,} rows; "
+                            f"every row is in {os.path.join(self.tables_dir, filename)}.",
+                            self.note_format)
+
+        self.tables[name] = {'file': filename, 'rows': len(df), 'sheet_rows': sheet_rows}
+        return sheet_rows
+
+    def close(self, complete=True):
+        """Finish the workbook. A complete report replaces the previous
+        workbook and tables folder; an incomplete one is thrown away, so
+        readers never see a half-written one."""
+        try:
+            self.workbook.close()
+            if complete:
+                with open(os.path.join(self.partial_dir, MANIFEST_NAME), 'w') as f:
+                    json.dump(self.tables, f, indent=2)
+                # A folder can't be swapped in one rename, so move the old one
+                # aside first; tables from an older report don't linger.
+                old_dir = self.tables_dir + '.old'
+                shutil.rmtree(old_dir, ignore_errors=True)
+                if os.path.exists(self.tables_dir):
+                    os.replace(self.tables_dir, old_dir)
+                os.replace(self.partial_dir, self.tables_dir)
+                shutil.rmtree(old_dir, ignore_errors=True)
+                os.replace(self.partial_xlsx, self.xlsx_path)
+        finally:
+            shutil.rmtree(self.partial_dir, ignore_errors=True)
+            if os.path.exists(self.partial_xlsx):
+                os.remove(self.partial_xlsx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+
+@traced(rows_out=len)
+def read_table(name, tables_dir=DEFAULT_TABLES_DIR, columns=None):
+    """Read one report table from the sidecar by its sheet name. Raises
+    FileNotFoundError if the report has not been written, and ValueError if
+    it has no such table."""
+    with open(os.path.join(tables_dir, MANIFEST_NAME)) as f:
+        tables = json.load(f)
+    if name not in tables:
+        raise ValueError(f"The report has no table called {name!r}; it has {', '.join(tables)}.")
+    return pd.read_parquet(os.path.join(tables_dir, tables[name]['file']), columns=columns)
@@ -0,0 +1,85 @@
+# nebula/sectors.py
+# PURPOSE: Assign free-text site addresses to a known town/village "Sector".
+# The gazetteer is compiled once into a token index (first word -> candidate
+# names), so matching cost grows with the length of the address rather than
+# with the number of names, unlike a big '|'-joined regex.
+#
+# Matching rules:
+#   - names only match whole words ("MILTON" does not match "HAMILTON ROAD");
+#   - the leftmost match in the address wins, and at the same position the
+#     longest name wins ("GREAT SHELFORD" beats "SHELFORD");
+#   - each distinct address string is only matched once and then cached.
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from nebula.instrument import traced
+
+CAMBRIDGESHIRE_SECTORS = [
+    'FULBOURN', 'GREAT SHELFORD', 'HISTON', 'OAKINGTON', 'IMPINGTON', 'TEVERSHAM',
+    'LINTON', 'WATERBEACH', 'SAWSTON', 'MELDRETH', 'MELBOURN', 'FOXTON',
+    'HARDWICK', 'CALDECOTE', 'SWAVESEY', 'PAPWORTH EVERARD', 'MILTON', 'HARSTON',
+    'BASSINGBOURN', 'COTTENHAM', 'GAMLINGAY', 'COMBERTON', 'BARTON', 'ROYSTON', 'SANDY'
+]
+
+_TOKEN = re.compile(r"[A-Z0-9']+")
+DEFAULT_BATCH_SIZE = 50_000
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.upper())
+
+
+class SectorMatcher:
+    """A compiled gazetteer of sector names."""
+
+    def __init__(self, names=CAMBRIDGESHIRE_SECTORS):
+        self.names = list(dict.fromkeys(n for n in names if isinstance(n, str) and n.strip()))
+        self._index = {}
+        for name in self.names:
+            tokens = tuple(tokenize(name))
+            if tokens:
+                self._index.setdefault(tokens[0], []).append((tokens, name))
+        # Longest names first, so the first hit at a position is the longest one.
+        for candidates in self._index.values():
+            candidates.sort(key=lambda item: len(item[0]), reverse=True)
+        self._cache = {}
+
+    def match_one(self, address):
+        """The sector for one address, or None."""
+        if not isinstance(address, str):
+            return None
+        cached = self._cache.get(address, False)
+        if cached is not False:
+            return cached
+        tokens = tokenize(address)
+        result = None
+        for i, token in enumerate(tokens):
+            for name_tokens, name in self._index.get(token, ()):
+                if tuple(tokens[i:i + len(name_tokens)]) == name_tokens:
+                    result = name
+                    break
+            if result is not None:
+                break
+        self._cache[address] = result
+        return result
+
+    @traced(rows_in=len, rows_out=lambda sectors: int(sectors.notna().sum()), arg=1)
+    def match(self, addresses, batch_size=DEFAULT_BATCH_SIZE):
+        """Match a Series (or list) of addresses. Returns a Series of sector
+        names aligned with the input, NaN where nothing matched.
+
+        Only the distinct address strings are matched, batch_size at a time,
+        and the results are broadcast back to every row."""
+        addresses = pd.Series(addresses)
+        codes, uniques = pd.factorize(addresses, use_na_sentinel=True)
+        sectors = np.empty(len(uniques), dtype=object)
+        for start in range(0, len(uniques), batch_size):
+            batch = uniques[start:start + batch_size]
+            sectors[start:start + len(batch)] = [self.match_one(a) for a in batch]
+        matched = pd.Series(np.nan, index=addresses.index, dtype=object)
+        has_address = codes >= 0
+        matched[has_address] = sectors[codes[has_address]]
+        return matched.where(matched.notna())
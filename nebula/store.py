@@ -0,0 +1,303 @@
+# nebula/store.py
+# PURPOSE: A persistent, indexed SQLite store of the Cambridgeshire brownfield
+# sites and price data. Each source file is only reloaded when its
+# fingerprint changes, and then incrementally: the new rows are staged next
+# to the table and matched to the stored ones by key (SiteReference or
+# TransactionID), so only rows that were added, changed or removed are
+# written, and the price cube is adjusted by just those rows. The report
+# aggregations run as SQL inside the database instead of pulling every row
+# into pandas.
+
+import hashlib
+import os
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from nebula import cube, price_updates
+from nebula.fingerprint import files_fingerprint
+from nebula.instrument import traced
+from nebula.price_paid import postcode_district
+from nebula.sectors import CAMBRIDGESHIRE_SECTORS, SectorMatcher
+
+DEFAULT_STORE_PATH = os.path.join('1_data_acquisition', 'cache', 'nebula_store.sqlite')
+SINCE_DATE = '2010-01-01'
+
+SITE_INDEXES = {
+    'ix_sites_status_date': 'sites (PlanningStatus, PermissionDate)',
+    'ix_sites_sector': 'sites (Sector)',
+    'ix_sites_year': 'sites (Year)',
+    'ix_sites_reference': 'sites (SiteReference)',
+}
+PRICE_INDEXES = {
+    'ix_prices_date': 'prices (DateOfTransfer)',
+    'ix_prices_year': 'prices (Year)',
+    'ix_prices_district': 'prices (PostcodeDistrict)',
+    'ix_prices_transaction': 'prices (TransactionID)',
+}
+# Added to the prices table by append_prices; they are not in the CSV.
+DERIVED_PRICE_COLUMNS = ['Year', 'PostcodeDistrict']
+# Added to the prices by process_price_data.py --within-boundary.
+LOCATED_COLUMNS = ['Easting', 'Northing']
+
+
+def connect(path=DEFAULT_STORE_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    engine = create_engine(f'sqlite:///{path}')
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS loads (name TEXT PRIMARY KEY, fingerprint TEXT, rows INTEGER)")
+    return engine
+
+
+def loaded_fingerprint(engine, name):
+    """The fingerprint recorded by the last load called `name`, or None."""
+    with engine.connect() as conn:
+        row = conn.execute(text("SELECT fingerprint FROM loads WHERE name = :name"), {'name': name}).fetchone()
+    return row[0] if row else None
+
+
+def record_load(conn, name, fingerprint, rows):
+    conn.execute(text("INSERT OR REPLACE INTO loads (name, fingerprint, rows) VALUES (:n, :f, :r)"),
+                 {'n': name, 'f': fingerprint, 'r': rows})
+
+
+def _create_indexes(conn, indexes):
+    for name, target in indexes.items():
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")]
+
+
+def _stage(conn, table, key):
+    """An empty copy of `table` (same columns and types) to load new rows
+    into before _sync_table."""
+    staged = f'{table}_staged'
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {staged}")
+    conn.exec_driver_sql(f"CREATE TABLE {staged} AS SELECT * FROM {table} WHERE 0")
+    conn.exec_driver_sql(f"CREATE INDEX ix_{staged}_key ON {staged} ({key})")
+    return staged
+
+
+def _sync_table(conn, table, staged, key, fetch=False):
+    """Make `table` hold exactly the rows of `staged`, then drop `staged`.
+    Rows are looked up by `key` and compared on every column, so unchanged
+    rows are left alone, removed and changed rows are deleted and new and
+    changed rows inserted. Returns (removed, added) as row counts, or as
+    DataFrames with fetch=True."""
+    # Leading with the key lets SQLite look each row up through its index;
+    # IS rather than = so that NULLs compare equal.
+    same = " AND ".join(f'b."{c}" IS a."{c}"'
+                        for c in [key] + _table_columns(conn, table))
+
+    def unmatched(a, b):
+        return f"SELECT a.rowid FROM {a} a WHERE NOT EXISTS (SELECT 1 FROM {b} b WHERE {same})"
+    removed_rows = f"SELECT * FROM {table} WHERE rowid IN ({unmatched(table, staged)})"
+    added_rows = f"SELECT * FROM {staged} WHERE rowid IN ({unmatched(staged, table)})"
+    if fetch:
+        removed = pd.read_sql_query(text(removed_rows), conn)
+        added = pd.read_sql_query(text(added_rows), conn)
+    conn.exec_driver_sql(f"CREATE TEMP TABLE sync_added AS {added_rows}")
+    deleted = conn.exec_driver_sql(f"DELETE FROM {table} WHERE rowid IN ({unmatched(table, staged)})").rowcount
+    inserted = conn.exec_driver_sql(f"INSERT INTO {table} SELECT * FROM temp.sync_added").rowcount
+    conn.exec_driver_sql("DROP TABLE temp.sync_added")
+    conn.exec_driver_sql(f"DROP TABLE {staged}")
+    return (removed, added) if fetch else (deleted, inserted)
+
+
+def _gazetteer_hash(sectors):
+    return hashlib.sha256('|'.join(sectors).encode()).hexdigest()[:16]
+
+
+@traced(rows_out=lambda rows: rows)
+def load_sites(engine, master_csv_path, sectors=CAMBRIDGESHIRE_SECTORS):
+    """Load the master brownfield CSV into the `sites` table, tagging each
+    site with its Sector and permission Year. Skipped (returns None) when the
+    CSV and gazetteer are unchanged since the last load; otherwise only the
+    sites that differ are rewritten, and the number of sites in the CSV is
+    returned."""
+    fingerprint = files_fingerprint([master_csv_path], gazetteer=_gazetteer_hash(sectors))
+    if loaded_fingerprint(engine, 'sites') == fingerprint:
+        return None
+
+    sites = pd.read_csv(master_csv_path)
+    permission_dates = pd.to_datetime(sites['PermissionDate'], errors='coerce')
+    sites['PermissionDate'] = permission_dates.dt.strftime('%Y-%m-%d')
+    sites['Dwellings'] = pd.to_numeric(sites['Dwellings'], errors='coerce')
+    sites['Sector'] = SectorMatcher(sectors).match(sites['Address'])
+    sites['Year'] = permission_dates.dt.year.astype('Int64')
+
+    with engine.begin() as conn:
+        if _table_columns(conn, 'sites') == list(sites.columns):
+            staged = _stage(conn, 'sites', 'SiteReference')
+            sites.to_sql(staged, conn, if_exists='append', index=False)
+            _sync_table(conn, 'sites', staged, 'SiteReference')
+        else:
+            # First load, or the master CSV's columns changed.
+            sites.to_sql('sites', conn, if_exists='replace', index=False)
+        _create_indexes(conn, SITE_INDEXES)
+        record_load(conn, 'sites', fingerprint, len(sites))
+    return len(sites)
+
+
+@traced(rows_out=lambda rows: rows)
+def load_prices(engine, price_csv_path, chunksize=500_000):
+    """Load the cleaned price CSV, with any monthly updates logged against it
+    (see nebula/price_updates.py), into the `prices` table in chunks. Skipped
+    (returns None) when neither has changed; otherwise returns the rows
+    loaded. The rows are staged and synced by TransactionID, and the
+    aggregate cube (see nebula/cube.py) is adjusted by the rows that changed;
+    on the first load, or if the CSV's columns changed, both are built from
+    scratch."""
+    fingerprint = price_updates.fingerprint(price_csv_path)
+    if loaded_fingerprint(engine, 'prices') == fingerprint:
+        return None
+
+    rows = 0
+    header = list(pd.read_csv(price_csv_path, nrows=0).columns)
+    with engine.begin() as conn:
+        if _table_columns(conn, 'prices') == header + DERIVED_PRICE_COLUMNS:
+            staged = _stage(conn, 'prices', 'TransactionID')
+            for chunk in price_updates.read_clean_prices(price_csv_path, chunksize):
+                append_prices(conn, chunk, table=staged)
+                rows += len(chunk)
+            removed, added = _sync_table(conn, 'prices', staged, 'TransactionID', fetch=True)
+            cube.apply(conn, removed, sign=-1)
+            cube.apply(conn, added)
+        else:
+            conn.exec_driver_sql("DROP TABLE IF EXISTS prices")
+            cube.reset(conn)
+            for chunk in price_updates.read_clean_prices(price_csv_path, chunksize):
+                append_prices(conn, chunk)
+                cube.apply(conn, chunk)
+                rows += len(chunk)
+        _create_indexes(conn, PRICE_INDEXES)
+        record_load(conn, 'prices', fingerprint, rows)
+    return rows
+
+
+def append_prices(conn, df, table='prices'):
+    """Append cleaned price rows (Price, DateOfTransfer, Postcode, ...) to
+    the `prices` table, adding the Year and PostcodeDistrict columns."""
+    df = df.copy()
+    dates = pd.to_datetime(df['DateOfTransfer'], errors='coerce')
+    df['DateOfTransfer'] = dates.dt.strftime('%Y-%m-%d')
+    df['Year'] = dates.dt.year.astype('Int64')
+    df['PostcodeDistrict'] = postcode_district(df['Postcode'])
+    df.to_sql(table, conn, if_exists='append', index=False)
+
+
+# --- Report queries. Sites without a known Sector are excluded throughout. ---
+_ANALYSIS_FILTER = """
+    PlanningStatus = 'permissioned'
+    AND PermissionDate >= :since
+    AND Sector IS NOT NULL
+"""
+
+
+def has_rows(engine, table):
+    """True if `table` exists in the store and is not empty."""
+    with engine.connect() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :t"),
+                              {'t': table}).fetchone()
+        return bool(exists) and conn.exec_driver_sql(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None
+
+
+def count_sites(engine, where="1 = 1", **params):
+    with engine.connect() as conn:
+        return conn.execute(text(f"SELECT COUNT(*) FROM sites WHERE {where}"), params).scalar()
+
+
+def yearly_growth(engine, since=SINCE_DATE):
+    """Permissions granted and dwellings planned per year, newest first."""
+    sql = f"""
+        SELECT Year,
+               COUNT(SiteReference) AS Total_Permissions_Granted,
+               SUM(COALESCE(Dwellings, 0)) AS Total_Dwellings_in_Plans
+        FROM sites
+        WHERE {_ANALYSIS_FILTER}
+        GROUP BY Year
+        ORDER BY Year DESC
+    """
+    with engine.connect() as conn:
+        return pd.read_sql_query(text(sql), conn, params={'since': since}, index_col='Year')
+
+
+def sector_hotspots(engine, since=SINCE_DATE):
+    """Dwellings approved and project counts per sector, for sites providing
+    at least one dwelling, with each sector's share of all dwellings."""
+    sql = f"""
+        SELECT Sector,
+               SUM(Dwellings) AS Total_Dwellings_Approved,
+               COUNT(*) AS Number_of_Projects
+        FROM sites
+        WHERE {_ANALYSIS_FILTER} AND Dwellings >= 1
+        GROUP BY Sector
+        ORDER BY Total_Dwellings_Approved DESC
+    """
+    with engine.connect() as conn:
+        hotspots = pd.read_sql_query(text(sql), conn, params={'since': since}, index_col='Sector')
+    total = hotspots['Total_Dwellings_Approved'].sum()
+    hotspots['%_of_Total_Dwellings'] = ((hotspots['Total_Dwellings_Approved'] / total) * 100).round(2)
+    return hotspots
+
+
+def development_sites(engine, since=SINCE_DATE):
+    """Location and dwellings of every permissioned site since `since` that
+    provides at least one dwelling, whether or not it has a known Sector."""
+    sql = """
+        SELECT SiteReference, Sector, longitude, latitude, Dwellings
+        FROM sites
+        WHERE PlanningStatus = 'permissioned' AND PermissionDate >= :since AND Dwellings >= 1
+        ORDER BY rowid
+    """
+    with engine.connect() as conn:
+        return pd.read_sql_query(text(sql), conn, params={'since': since})
+
+
+def prices_located(engine):
+    """True if the stored prices were geocoded and kept by the boundary
+    filter, i.e. carry Easting/Northing; False if they were kept by postcode
+    prefix alone or none have been loaded."""
+    with engine.connect() as conn:
+        columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(prices)")}
+    return set(LOCATED_COLUMNS) <= columns
+
+
+@traced(rows_out=lambda sales: len(sales) if sales is not None else None)
+def located_sales(engine):
+    """Easting, Northing and Price of every stored sale, or None if the
+    prices have no coordinates."""
+    if not prices_located(engine):
+        return None
+    with engine.connect() as conn:
+        return pd.read_sql_query(text("SELECT Easting, Northing, Price FROM prices"), conn)
+
+
+@traced(rows_out=len)
+def recent_sales(engine, days):
+    """Sales in the last `days` days of the price data (up to its latest
+    sale), with Easting/Northing when the prices were geocoded. Empty if no
+    prices have been loaded."""
+    if not has_rows(engine, 'prices'):
+        return pd.DataFrame(columns=['Price', 'DateOfTransfer', 'Postcode'])
+    located = LOCATED_COLUMNS if prices_located(engine) else []
+    with engine.connect() as conn:
+        sql = f"""
+            SELECT {', '.join(['Price', 'DateOfTransfer', 'Postcode'] + located)}
+            FROM prices
+            WHERE DateOfTransfer > date((SELECT MAX(DateOfTransfer) FROM prices), :offset)
+        """
+        return pd.read_sql_query(text(sql), conn, params={'offset': f'-{int(days)} days'})
+
+
+@traced(rows_out=len)
+def analysis_sites(engine, since=SINCE_DATE):
+    """The site rows behind the report, for the detail sheet."""
+    sql = f"SELECT * FROM sites WHERE {_ANALYSIS_FILTER} ORDER BY rowid"
+    with engine.connect() as conn:
+        df = pd.read_sql_query(text(sql), conn, params={'since': since}, parse_dates=['PermissionDate'])
+    df['Dwellings'] = df['Dwellings'].fillna(0)
+    return df
@@ -0,0 +1,136 @@
+# run_pipeline.py
+# PURPOSE: One entry point for the whole project. Runs the numbered scripts
+# as a dependency graph, skipping any stage whose script, the shared nebula/
+# code, its settings and input files are unchanged since its last successful
+# run. The price processing
+# branch runs alongside the boundary/brownfield branch; after the national
+# file is filtered, the monthly updates in land_registry_data/monthly/ are
+# applied on top (see nebula/price_updates.py). Each stage that runs
+# writes a trace of its steps to reports/traces/, and those are merged into
+# one run trace, reports/run_trace.json (Chrome trace format).
+#
+# USAGE: python run_pipeline.py [stage ...] [--force] [--dry-run] [--jobs N]
+#                               [--price-mode stream|parallel|cache|full] [--workers N]
+#                               [--within-boundary] [--profile cprofile|pyinstrument]
+
+import argparse
+import glob
+import os
+import sys
+
+from nebula import instrument, price_updates
+from nebula.pipeline import Pipeline, Stage
+
+RAW_DIR = os.path.join('1_data_acquisition', 'raw_data')
+GML_DIR = os.path.join(RAW_DIR, 'land_registry_data')
+REPORTS_DIR = 'reports'
+
+PRICE_PAID_PATH = os.path.join(GML_DIR, 'pp-complete.csv')
+# Monthly update files, applied in name order, so name them by month.
+MONTHLY_DIR = os.path.join(GML_DIR, 'monthly')
+NATIONAL_SITES_PATH = os.path.join(RAW_DIR, 'brownfield_registers', 'uk_brownfield_sites.csv')
+POSTCODES_PATH = os.path.join(RAW_DIR, 'postcodes', 'ONSPD.csv')
+BOUNDARY_PATH = os.path.join('1_data_acquisition', 'cache', 'boundary', 'boundary.wkb')
+GML_PATHS = [
+    os.path.join(GML_DIR, council, 'Land_Registry_Cadastral_Parcels.gml')
+    for council in ('Cambridge_City_Council', 'East_Cambridgeshire_District_Council',
+                    'South_Cambridgeshire_District_Council')
+]
+CLEAN_PRICE_PATH = os.path.join(REPORTS_DIR, 'Cambridgeshire_Price_Data_2010-2023.csv')
+# Which monthly updates have been applied to the cleaned prices, and the log
+# they wrote (only there once an update has been applied).
+PRICE_UPDATES_MANIFEST_PATH = price_updates.manifest_path(CLEAN_PRICE_PATH)
+PRICE_UPDATES_LOG_PATH = price_updates.log_path(CLEAN_PRICE_PATH)
+MASTER_CSV_PATH = os.path.join(REPORTS_DIR, 'Master_Cambridgeshire_Data.csv')
+REPORT_XLSX_PATH = os.path.join(REPORTS_DIR, 'Cambridgeshire_Market_Analysis_FINAL.xlsx')
+# Parquet copies of the report's tables; the visualisation stages read these, not the workbook.
+REPORT_TABLES_DIR = os.path.join(REPORTS_DIR, 'report_tables')
+REPORT_TABLE_PATHS = [
+    os.path.join(REPORT_TABLES_DIR, name)
+    for name in ('_tables.json', 'development_growth_by_year.parquet', 'hotspot_analysis_by_sector.parquet',
+                 'hex_hotspots_1km.parquet', 'hex_hotspots_5km.parquet', 'cleaned_data_used_in_report.parquet')
+]
+# Only written when the sales carry coordinates, i.e. with --within-boundary.
+SPEND_TABLE_PATHS = [os.path.join(REPORT_TABLES_DIR, name)
+                     for name in ('hex_spend_1km.parquet', 'hex_spend_5km.parquet')]
+
+
+def build_stages(price_mode='stream', workers=None, within_boundary=False):
+    # Most of the logic lives in nebula/, so a change there reruns every stage.
+    code = sorted(glob.glob(os.path.join('nebula', '*.py')))
+    price_args = ['--mode', price_mode]
+    price_inputs = [PRICE_PAID_PATH]
+    # Folding the log into the cleaned CSV would change the prices stage's
+    # output and make it rerun, so the log is left to grow until pp-complete.csv
+    # changes and the prices stage starts a fresh one.
+    update_args = ['--mode', 'delta', '--delta-dir', MONTHLY_DIR, '--no-compact']
+    update_inputs = [CLEAN_PRICE_PATH] + sorted(glob.glob(os.path.join(MONTHLY_DIR, '*.csv')))
+    # The sales as the later stages see them: the cleaned CSV with the updates laid over it.
+    prices = [CLEAN_PRICE_PATH, PRICE_UPDATES_MANIFEST_PATH, PRICE_UPDATES_LOG_PATH]
+    report_tables = list(REPORT_TABLE_PATHS)
+    if workers:
+        price_args += ['--workers', str(workers)]
+    if within_boundary:
+        # Filtering by the real boundary makes the prices stage wait for it.
+        price_args += ['--within-boundary', '--postcodes', POSTCODES_PATH]
+        update_args += ['--within-boundary', '--postcodes', POSTCODES_PATH]
+        price_inputs += [POSTCODES_PATH, BOUNDARY_PATH]
+        update_inputs += [POSTCODES_PATH, BOUNDARY_PATH]
+        report_tables += SPEND_TABLE_PATHS
+    return [
+        Stage('prices', os.path.join('2_data_processing', 'process_price_data.py'),
+              inputs=price_inputs, outputs=[CLEAN_PRICE_PATH], args=price_args, code=code),
+        Stage('price_updates', os.path.join('2_data_processing', 'process_price_data.py'),
+              inputs=update_inputs, outputs=[PRICE_UPDATES_MANIFEST_PATH], args=update_args, code=code),
+        Stage('brownfield', os.path.join('2_data_processing', 'load_and_combine.py'),
+              inputs=GML_PATHS + [NATIONAL_SITES_PATH], outputs=[MASTER_CSV_PATH, BOUNDARY_PATH], code=code),
+        # The report and correlation stages read the sales from the analytical
+        # store, which is a cache of these files: each syncs it from them first.
+        Stage('report', os.path.join('3_analysis_and_outputs', 'generate_market_report.py'),
+              inputs=[MASTER_CSV_PATH] + prices, outputs=[REPORT_XLSX_PATH] + report_tables, code=code),
+        Stage('correlation', os.path.join('4_visualisation', 'create_correlation_flowchart.py'),
+              inputs=prices + REPORT_TABLE_PATHS,
+              outputs=[os.path.join(REPORTS_DIR, 'Development_vs_Market_Spend_Flowchart.png')], code=code),
+        Stage('visuals', os.path.join('4_visualisation', 'create_final_visuals.py'),
+              inputs=report_tables + [MASTER_CSV_PATH],
+              outputs=[os.path.join(REPORTS_DIR, 'Yearly_Development_Growth.png'),
+                       os.path.join(REPORTS_DIR, 'Final_Interactive_Dashboard_Map.html')], code=code),
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the Project Nebula pipeline.")
+    parser.add_argument('stages', nargs='*',
+                        help="Stages to bring up to date (default: all). Their upstream stages are included.")
+    parser.add_argument('--force', action='store_true', help="Run every selected stage even if up to date.")
+    parser.add_argument('--dry-run', action='store_true', help="Only show which stages would run.")
+    parser.add_argument('--jobs', type=int, default=None, help="Maximum stages to run at once.")
+    parser.add_argument('--price-mode', default='stream', choices=['stream', 'parallel', 'cache', 'full'],
+                        help="Mode passed to process_price_data.py.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes for the parallel price scan.")
+    parser.add_argument('--within-boundary', action='store_true',
+                        help="Filter sales by the custom boundary via a local postcode lookup "
+                             f"({POSTCODES_PATH}) instead of by postcode prefix.")
+    parser.add_argument('--profile', choices=instrument.PROFILERS,
+                        help="Also profile each stage that runs, saving the profile next to its trace "
+                             f"in {instrument.DEFAULT_TRACE_DIR} (add --force to profile up-to-date stages).")
+    args = parser.parse_args()
+
+    # The scripts use paths relative to the repository root.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if args.profile:
+        os.environ[instrument.PROFILE_ENV] = args.profile
+    pipeline = Pipeline(build_stages(args.price_mode, args.workers, args.within_boundary),
+                        trace_dir=instrument.DEFAULT_TRACE_DIR)
+    unknown = [s for s in args.stages if s not in pipeline.stages]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)}; choose from {', '.join(pipeline.stages)}")
+
+    print("\n--- PROJECT NEBULA PIPELINE ---")
+    results = pipeline.run(args.stages or None, force=args.force, jobs=args.jobs, dry_run=args.dry_run)
+    print("\nSummary: " + ", ".join(f"{name} {status}" for name, status in results.items()))
+    if pipeline.runs:
+        instrument.merge_traces(pipeline.runs, instrument.RUN_TRACE_PATH)
+        print(f"Run trace: {instrument.RUN_TRACE_PATH}")
+    sys.exit(1 if any(status in ('failed', 'blocked') for status in results.values()) else 0)